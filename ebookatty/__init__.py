@@ -19,11 +19,69 @@
 #  You should have received a copy of the GNU Lesser General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 #########################################################################
-"""__init__ module for application."""
+"""
+__init__ module for application.
 
-from ebookatty.metadata import MetadataFetcher, fetch_metadata
-from ebookatty.cli import execute
+Public names are imported from their submodule on first access, so
+``import ebookatty`` loads neither the parsers nor the command line
+interface until they are used.
+"""
+
+from importlib import import_module
 
 __version__ = "0.3.1"
 
-__all__ = ["MetadataFetcher", "execute", "fetch_metadata"]
+# Public names mapped to the submodule that defines them.
+LAZY_ATTRIBUTES = {
+    "BookMetadata": "ebookatty.record",
+    "MetadataFetcher": "ebookatty.metadata",
+    "execute": "ebookatty.cli",
+    "extract_many": "ebookatty.batch",
+    "extract_many_async": "ebookatty.aio",
+    "fetch_metadata": "ebookatty.metadata",
+    "fetch_metadata_async": "ebookatty.aio",
+    "iter_metadata": "ebookatty.batch",
+}
+
+__all__ = [
+    "BookMetadata",
+    "MetadataFetcher",
+    "execute",
+    "extract_many",
+    "extract_many_async",
+    "fetch_metadata",
+    "fetch_metadata_async",
+    "iter_metadata",
+]
+
+
+def __getattr__(name: str):
+    """
+    Import a public name from its submodule on first access.
+
+    Parameters
+    ----------
+    name : str
+        the attribute looked up on the package
+
+    Returns
+    -------
+    Any
+        the attribute, cached on the package for later lookups
+
+    Raises
+    ------
+    AttributeError
+        if the package has no such attribute
+    """
+    module = LAZY_ATTRIBUTES.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(import_module(module), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    """List the module attributes, including those not imported yet."""
+    return sorted({*globals(), *LAZY_ATTRIBUTES})
@@ -0,0 +1,102 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+########################################################################
+#  Copyright (C) 2021  alexpdev
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#########################################################################
+"""Asyncio interface for extracting metadata without blocking the event loop."""
+
+import asyncio
+from concurrent.futures import Executor
+from functools import partial
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Union
+
+from ebookatty.batch import BatchResult, extract
+from ebookatty.metadata import Source, fetch_metadata
+
+
+async def fetch_metadata_async(
+    path: Source,
+    executor: Optional[Executor] = None,
+    format: Optional[str] = None,
+    fields: Optional[Iterable[str]] = None,
+) -> Dict[str, str]:
+    """
+    Retreive metadata for an ebook without blocking the running event loop.
+
+    All file reads and parsing run on `executor`, the event loop only
+    awaits the result.
+
+    Parameters
+    ----------
+    path : Source
+        file path of the ebook, or its contents as a bytes-like object or
+        seekable binary file object.
+    executor : Optional[Executor]
+        thread or process pool used for parsing, defaults to the loop's
+        default executor
+    format : Optional[str]
+        format hint, guessed from the source when omitted
+    fields : Optional[Iterable[str]]
+        only extract these fields, all of them when omitted
+
+    Returns
+    -------
+    Dict[str, str]
+        Ebook metadata available, or None if it could not be extracted.
+    """
+    loop = asyncio.get_running_loop()
+    func = partial(fetch_metadata, path, format=format, fields=fields)
+    return await loop.run_in_executor(executor, func)
+
+
+async def extract_many_async(
+    paths: Iterable[Union[str, Path]],
+    limit: int = 8,
+    executor: Optional[Executor] = None,
+    fields: Optional[Iterable[str]] = None,
+) -> List[BatchResult]:
+    """
+    Extract metadata from many ebooks with at most `limit` in flight.
+
+    Parameters
+    ----------
+    paths : Iterable[Union[str, Path]]
+        file paths of the ebooks
+    limit : int
+        maximum number of files parsed concurrently
+    executor : Optional[Executor]
+        thread or process pool used for parsing, defaults to the loop's
+        default executor
+    fields : Optional[Iterable[str]]
+        only extract these fields, all of them when omitted
+
+    Returns
+    -------
+    List[BatchResult]
+        one result per path in input order, failures are reported in the
+        result instead of being raised
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(limit)
+    func = partial(extract, fields=tuple(fields) if fields else None)
+
+    async def run(path):
+        async with semaphore:
+            return await loop.run_in_executor(executor, func, path)
+
+    return await asyncio.gather(*(run(path) for path in paths))
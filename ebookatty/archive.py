@@ -0,0 +1,285 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+########################################################################
+#  Copyright (C) 2021  alexpdev
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#########################################################################
+"""
+Minimal zip reader that touches only the central directory and the
+members that are actually read.
+
+`zipfile.ZipFile` builds a `ZipInfo` object for every entry in the
+archive.  EPUB metadata lives in just two members, so this reader locates
+the end-of-central-directory record, reads the central directory in one
+request and decompresses nothing but the members that are opened.
+Archives using features it does not handle (ZIP64, encryption, split
+archives, compression other than stored or deflate) raise
+`UnsupportedArchive` so callers can fall back to `zipfile`.
+"""
+
+import io
+import struct
+import zipfile
+import zlib
+from typing import BinaryIO, Dict, List, NamedTuple
+
+EOCD_SIGNATURE = b"PK\x05\x06"
+CENTRAL_SIGNATURE = b"PK\x01\x02"
+LOCAL_SIGNATURE = b"PK\x03\x04"
+EOCD = struct.Struct("<4s4H2LH")
+CENTRAL = struct.Struct("<4s6H3L5H2L")
+LOCAL = struct.Struct("<4s5H3L2H")
+MAX_COMMENT = 0xFFFF
+CHUNK_SIZE = 1 << 16
+
+
+class UnsupportedArchive(Exception):
+    """Raised for archives the minimal reader cannot handle."""
+
+
+class Member(NamedTuple):
+    """Location and encoding of one archive member."""
+
+    method: int
+    flags: int
+    crc: int
+    compressed_size: int
+    size: int
+    offset: int
+
+
+class MemberReader(io.RawIOBase):
+    """
+    Raw stream that inflates a single archive member on demand.
+
+    Parameters
+    ----------
+    fd : BinaryIO
+        the archive file
+    start : int
+        offset of the member's compressed data
+    member : Member
+        central directory record of the member
+    """
+
+    def __init__(self, fd: BinaryIO, start: int, member: Member):
+        """
+        Construct the reader.
+        """
+        super().__init__()
+        self.fd = fd
+        self.pos = start
+        self.remaining = member.compressed_size
+        self.member = member
+        self.crc = 0
+        self.pending = b""
+        self.inflater = zlib.decompressobj(-15) if member.method == 8 else None
+
+    def readable(self) -> bool:
+        """Return True, member readers are always readable."""
+        return True
+
+    def next_chunk(self) -> bytes:
+        """
+        Read and decompress the next block of the member.
+
+        Returns
+        -------
+        bytes
+            decompressed data, empty once the member is exhausted
+        """
+        if not self.remaining:
+            data = self.inflater.flush() if self.inflater else b""
+            self.inflater = None
+            if not data and self.crc != self.member.crc:
+                raise zipfile.BadZipFile("Bad CRC-32 for archive member")
+        else:
+            self.fd.seek(self.pos)
+            data = self.fd.read(min(CHUNK_SIZE, self.remaining))
+            if not data:
+                raise EOFError("archive member is truncated")
+            self.pos += len(data)
+            self.remaining -= len(data)
+            if self.inflater:
+                data = self.inflater.decompress(data)
+        self.crc = zlib.crc32(data, self.crc)
+        return data
+
+    def readinto(self, buffer) -> int:
+        """
+        Fill `buffer` with decompressed member data.
+
+        Parameters
+        ----------
+        buffer : writable bytes-like object
+            destination buffer
+
+        Returns
+        -------
+        int
+            number of bytes written, 0 at the end of the member
+        """
+        while not self.pending:
+            if not self.remaining and self.inflater is None:
+                if self.crc != self.member.crc:
+                    raise zipfile.BadZipFile("Bad CRC-32 for archive member")
+                return 0
+            self.pending = self.next_chunk()
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+
+class CentralDirectory:
+    """
+    Read-only view of a zip archive built from its central directory.
+
+    Parameters
+    ----------
+    fd : BinaryIO
+        seekable archive file, left open on `close` when not owned
+    owned : bool
+        close `fd` together with the archive
+    """
+
+    def __init__(self, fd: BinaryIO, owned: bool = False):
+        """
+        Construct the archive view and index its central directory.
+        """
+        self.fd = fd
+        self.owned = owned
+        self.bytes_read = 0
+        self.members = self.read_directory()
+
+    def read_directory(self) -> Dict[str, Member]:
+        """
+        Locate the end-of-central-directory record and index every member.
+
+        Returns
+        -------
+        Dict[str, Member]
+            member names mapped to their location
+
+        Raises
+        ------
+        UnsupportedArchive
+            if the archive uses features this reader does not handle
+        """
+        fd = self.fd
+        size = fd.seek(0, io.SEEK_END)
+        tail_size = min(size, EOCD.size + MAX_COMMENT)
+        fd.seek(size - tail_size)
+        tail = fd.read(tail_size)
+        pos = tail.rfind(EOCD_SIGNATURE, 0, len(tail) - EOCD.size + 4)
+        while pos >= 0:
+            record = EOCD.unpack_from(tail, pos)
+            if pos + EOCD.size + record[-1] == len(tail):
+                break
+            pos = tail.rfind(EOCD_SIGNATURE, 0, pos + 3)
+        if pos < 0:
+            raise UnsupportedArchive("end of central directory not found")
+        _, disk, cd_disk, disk_entries, entries, cd_size, cd_offset, _ = record
+        if disk or cd_disk or disk_entries != entries:
+            raise UnsupportedArchive("split archives are not supported")
+        if entries == 0xFFFF or cd_size == 0xFFFFFFFF or cd_offset == 0xFFFFFFFF:
+            raise UnsupportedArchive("zip64 archives are not supported")
+        fd.seek(cd_offset)
+        directory = fd.read(cd_size)
+        self.bytes_read = len(tail) + len(directory)
+        members = {}
+        pos = 0
+        for _ in range(entries):
+            if directory[pos : pos + 4] != CENTRAL_SIGNATURE:
+                raise UnsupportedArchive("central directory is not where expected")
+            fields = CENTRAL.unpack_from(directory, pos)
+            flags, method, crc, csize, usize = fields[3], fields[4], *fields[7:10]
+            name_len, extra_len, comment_len = fields[10:13]
+            start = pos + CENTRAL.size
+            raw = directory[start : start + name_len]
+            name = raw.decode("utf-8" if flags & 0x800 else "cp437")
+            members[name] = Member(method, flags, crc, csize, usize, fields[16])
+            pos = start + name_len + extra_len + comment_len
+        return members
+
+    def namelist(self) -> List[str]:
+        """
+        Return the names of all archive members.
+
+        Returns
+        -------
+        List[str]
+            member names in directory order
+        """
+        return list(self.members)
+
+    def open(self, name: str) -> io.BufferedReader:
+        """
+        Open an archive member for streaming reads.
+
+        Parameters
+        ----------
+        name : str
+            member name
+
+        Returns
+        -------
+        io.BufferedReader
+            binary stream of the decompressed member
+
+        Raises
+        ------
+        KeyError
+            if the member does not exist
+        UnsupportedArchive
+            if the member is encrypted or uses an unsupported compression
+        """
+        member = self.members[name]
+        if member.flags & 0x1:
+            raise UnsupportedArchive("encrypted members are not supported")
+        if member.method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            raise UnsupportedArchive(f"compression method {member.method}")
+        self.fd.seek(member.offset)
+        header = self.fd.read(LOCAL.size)
+        if len(header) < LOCAL.size or header[:4] != LOCAL_SIGNATURE:
+            raise zipfile.BadZipFile(f"bad local file header for {name!r}")
+        fields = LOCAL.unpack(header)
+        start = member.offset + LOCAL.size + fields[9] + fields[10]
+        return io.BufferedReader(MemberReader(self.fd, start, member))
+
+    def read(self, name: str) -> bytes:
+        """
+        Read and decompress an entire archive member.
+
+        Parameters
+        ----------
+        name : str
+            member name
+
+        Returns
+        -------
+        bytes
+            the member contents
+        """
+        with self.open(name) as stream:
+            return stream.read()
+
+    def close(self) -> None:
+        """
+        Release the archive, closing the file if it is owned.
+        """
+        if self.owned:
+            self.fd.close()
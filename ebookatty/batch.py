@@ -0,0 +1,440 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+########################################################################
+#  Copyright (C) 2021  alexpdev
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#########################################################################
+"""Batch extraction of metadata from many ebooks across worker pools."""
+
+import os
+from collections import deque
+from glob import iglob
+from itertools import islice
+from pathlib import Path
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from ebookatty.metadata import MetadataFetcher
+from ebookatty.trace import collect, summarize
+
+if TYPE_CHECKING:  # pragma: nocover
+    from ebookatty.cache import MetadataCache
+    from ebookatty.epub import OpfLocator
+    from ebookatty.record import BookMetadata
+
+# Executor classes of `concurrent.futures`, imported only for worker pools.
+EXECUTORS = {"process": "ProcessPoolExecutor", "thread": "ThreadPoolExecutor"}
+
+_worker_locator = None
+
+
+def worker_locator() -> "OpfLocator":
+    """
+    Return the OPF locator shared by every extraction in this process.
+
+    Each worker process learns from the books it parses, thread pools and
+    the calling thread share a single locator.
+
+    Returns
+    -------
+    OpfLocator
+        the locator of this process
+    """
+    global _worker_locator
+    if _worker_locator is None:
+        from ebookatty.epub import OpfLocator
+
+        _worker_locator = OpfLocator()
+    return _worker_locator
+
+
+class ExtractionError(Exception):
+    """Raised or yielded when metadata could not be extracted from a file."""
+
+
+class BatchResult(NamedTuple):
+    """
+    Outcome of extracting metadata from a single ebook.
+
+    Exactly one of ``metadata`` and ``error`` is set.  ``metadata`` is a
+    dictionary, or a `ebookatty.record.BookMetadata` when records were
+    requested.  Errors are kept as text so results can always be sent back
+    from worker processes.  When tracing was requested, ``trace`` holds the
+    totals of every stage run for the file, see `ebookatty.trace.summarize`.
+    """
+
+    path: str
+    metadata: Optional[Union[Dict[str, str], "BookMetadata"]]
+    error: Optional[str]
+    trace: Optional[Dict[str, Dict[str, float]]] = None
+
+
+def extract(
+    path: str,
+    cache: Optional["MetadataCache"] = None,
+    fields: Optional[Tuple[str, ...]] = None,
+    trace: bool = False,
+    locate_opf: bool = False,
+    records: bool = False,
+) -> BatchResult:
+    """
+    Extract metadata from one ebook, capturing any failure.
+
+    Parameters
+    ----------
+    path : str
+        path to the ebook file
+    cache : Optional[MetadataCache]
+        cache consulted before the file is parsed
+    fields : Optional[Tuple[str, ...]]
+        only extract these fields
+    trace : bool
+        record the duration and size of each parsing stage
+    locate_opf : bool
+        guess the OPF location of EPUBs with the `worker_locator`
+    records : bool
+        return a `ebookatty.record.BookMetadata` instead of a dictionary,
+        the cache is not consulted
+
+    Returns
+    -------
+    BatchResult
+        the metadata or a description of the error
+    """
+    if trace:
+        with collect() as events:
+            result = extract(path, cache, fields, False, locate_opf, records)
+        return result._replace(trace=summarize(events))
+    locator = worker_locator() if locate_opf else None
+    try:
+        if cache is not None and not records:
+            metadata = cache.fetch(path, locator)
+            if fields:
+                from ebookatty.record import project
+
+                metadata = project(metadata, fields)
+            return BatchResult(str(path), metadata, None)
+        with MetadataFetcher(path, None, fields, locator, records) as fetcher:
+            if records:
+                return BatchResult(str(path), fetcher.get_record(), None)
+            return BatchResult(str(path), fetcher.get_metadata(), None)
+    except Exception as err:
+        return BatchResult(str(path), None, f"{type(err).__name__}: {err}")
+
+
+def extract_chunk(
+    paths: List[str],
+    cache: Optional["MetadataCache"] = None,
+    fields: Optional[Tuple[str, ...]] = None,
+    trace: bool = False,
+    locate_opf: bool = False,
+    records: bool = False,
+) -> List[BatchResult]:
+    """
+    Extract metadata from a chunk of ebooks inside a single worker task.
+
+    Parameters
+    ----------
+    paths : List[str]
+        paths to the ebook files
+    cache : Optional[MetadataCache]
+        cache consulted before each file is parsed
+    fields : Optional[Tuple[str, ...]]
+        only extract these fields
+    trace : bool
+        record the stages of each file
+    locate_opf : bool
+        guess the OPF location of EPUBs with the `worker_locator`
+    records : bool
+        return records instead of dictionaries
+
+    Returns
+    -------
+    List[BatchResult]
+        results in the same order as `paths`
+    """
+    return [
+        extract(path, cache, fields, trace, locate_opf, records) for path in paths
+    ]
+
+
+def chunked(paths: Iterable[str], size: int) -> Generator:
+    """
+    Split an iterable of paths into lists of at most `size` items.
+
+    Parameters
+    ----------
+    paths : Iterable[str]
+        the paths to split
+    size : int
+        maximum number of paths per chunk
+
+    Yields
+    ------
+    Generator[List[str]]
+        the next chunk of paths
+    """
+    paths = iter(paths)
+    while True:
+        chunk = list(islice(paths, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def iter_extract(
+    paths: Iterable[str],
+    workers: Optional[int] = None,
+    executor: str = "process",
+    ordered: bool = True,
+    chunksize: Optional[int] = None,
+    cache: Optional["MetadataCache"] = None,
+    fields: Optional[Iterable[str]] = None,
+    trace: bool = False,
+    locate_opf: bool = False,
+    records: bool = False,
+) -> Generator:
+    """
+    Extract metadata from many ebooks and yield the results as they finish.
+
+    Paths are consumed lazily and only a bounded number of chunks is in
+    flight at any time, so arbitrarily large libraries can be processed
+    without queueing every file up front.
+
+    Parameters
+    ----------
+    paths : Iterable[str]
+        paths to the ebook files
+    workers : Optional[int]
+        number of workers, defaults to the number of CPUs.  A value of 1
+        runs everything in the calling thread.
+    executor : str
+        ``"process"`` or ``"thread"``
+    ordered : bool
+        yield results in input order instead of completion order
+    chunksize : Optional[int]
+        paths handed to a worker per task, defaults to 16 for process
+        pools and 1 for thread pools
+    cache : Optional[MetadataCache]
+        cache consulted before each file is parsed, shared by all workers
+    fields : Optional[Iterable[str]]
+        only extract these fields, all of them when omitted
+    trace : bool
+        attach the stage totals of each file to its result
+    locate_opf : bool
+        guess the OPF location of EPUBs, with one `ebookatty.epub.OpfLocator`
+        per worker process that learns from the books it parses
+    records : bool
+        return each file's metadata as a `ebookatty.record.BookMetadata`,
+        which takes less memory than the dictionary when many results are
+        kept.  Records are not cached, so `cache` is ignored.
+
+    Yields
+    ------
+    Generator[BatchResult]
+        the result for each path
+    """
+    if executor not in EXECUTORS:
+        raise ValueError(
+            f"unknown executor {executor!r}, expected one of {list(EXECUTORS)}"
+        )
+    workers = workers or os.cpu_count() or 1
+    fields = tuple(fields) if fields else None
+    if workers <= 1:
+        for path in paths:
+            yield extract(path, cache, fields, trace, locate_opf, records)
+        return
+    import concurrent.futures
+    from concurrent.futures import FIRST_COMPLETED, wait
+
+    if chunksize is None:
+        chunksize = 16 if executor == "process" else 1
+    chunks = chunked(paths, chunksize)
+    limit = workers * 4
+    pool_class = getattr(concurrent.futures, EXECUTORS[executor])
+    options = (cache, fields, trace, locate_opf, records)
+    with pool_class(max_workers=workers) as pool:
+        pending = deque()
+        for chunk in islice(chunks, limit):
+            pending.append(pool.submit(extract_chunk, chunk, *options))
+        while pending:
+            if ordered:
+                done = [pending.popleft()]
+            else:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                done = [f for f in pending if f in finished]
+                for future in done:
+                    pending.remove(future)
+            for future in done:
+                for chunk in islice(chunks, 1):
+                    pending.append(pool.submit(extract_chunk, chunk, *options))
+                yield from future.result()
+
+
+def extract_many(
+    paths: Iterable[str],
+    workers: Optional[int] = None,
+    executor: str = "process",
+    ordered: bool = True,
+    chunksize: Optional[int] = None,
+    cache: Optional["MetadataCache"] = None,
+    fields: Optional[Iterable[str]] = None,
+    trace: bool = False,
+    locate_opf: bool = False,
+    records: bool = False,
+) -> List[BatchResult]:
+    """
+    Extract metadata from many ebooks in parallel.
+
+    A failure in one file is recorded in its result and does not stop the
+    rest of the batch.
+
+    Parameters
+    ----------
+    paths : Iterable[str]
+        paths to the ebook files
+    workers : Optional[int]
+        number of workers, defaults to the number of CPUs
+    executor : str
+        ``"process"`` or ``"thread"``
+    ordered : bool
+        keep results in input order instead of completion order
+    chunksize : Optional[int]
+        paths handed to a worker per task
+    cache : Optional[MetadataCache]
+        cache consulted before each file is parsed
+    fields : Optional[Iterable[str]]
+        only extract these fields, all of them when omitted
+    trace : bool
+        attach the stage totals of each file to its result
+    locate_opf : bool
+        guess the OPF location of EPUBs, see `iter_extract`
+    records : bool
+        return records instead of dictionaries, see `iter_extract`
+
+    Returns
+    -------
+    List[BatchResult]
+        one result per path
+    """
+    return list(
+        iter_extract(
+            paths,
+            workers,
+            executor,
+            ordered,
+            chunksize,
+            cache,
+            fields,
+            trace,
+            locate_opf,
+            records,
+        )
+    )
+
+
+def expand_paths(paths_or_globs: Union[str, Path, Iterable[str]]) -> Generator:
+    """
+    Lazily expand file paths and glob patterns into matching file paths.
+
+    Parameters
+    ----------
+    paths_or_globs : Union[str, Path, Iterable[str]]
+        a single path or pattern, or an iterable of them
+
+    Yields
+    ------
+    Generator[str]
+        each matching path
+    """
+    if isinstance(paths_or_globs, (str, Path)):
+        paths_or_globs = [paths_or_globs]
+    for pattern in paths_or_globs:
+        yield from iglob(str(pattern), recursive=True)
+
+
+def iter_metadata(
+    paths_or_globs: Union[str, Path, Iterable[str]],
+    workers: int = 1,
+    executor: str = "process",
+    ordered: bool = True,
+    cache: Optional["MetadataCache"] = None,
+    fields: Optional[Iterable[str]] = None,
+    trace: bool = False,
+    locate_opf: bool = False,
+    records: bool = False,
+) -> Generator:
+    """
+    Lazily yield the metadata for every ebook matching the paths or globs.
+
+    Nothing is collected in memory, each pair is produced as soon as its
+    file has been parsed.
+
+    Parameters
+    ----------
+    paths_or_globs : Union[str, Path, Iterable[str]]
+        a single path or pattern, or an iterable of them
+    workers : int
+        number of workers, 1 parses in the calling thread
+    executor : str
+        ``"process"`` or ``"thread"``
+    ordered : bool
+        yield in input order instead of completion order
+    cache : Optional[MetadataCache]
+        cache consulted before each file is parsed
+    fields : Optional[Iterable[str]]
+        only extract these fields, all of them when omitted
+    trace : bool
+        add the stage totals of each file to its metadata as ``"trace"``
+    locate_opf : bool
+        guess the OPF location of EPUBs, see `iter_extract`
+    records : bool
+        yield `ebookatty.record.BookMetadata` instead of dictionaries.  The
+        stage totals of `trace` are then left out.
+
+    Yields
+    ------
+    Generator[Tuple[str, Union[Dict[str, str], BookMetadata, ExtractionError]]]
+        the path and either its metadata or the error it raised
+    """
+    paths = expand_paths(paths_or_globs)
+    results = iter_extract(
+        paths,
+        workers,
+        executor,
+        ordered,
+        cache=cache,
+        fields=fields,
+        trace=trace,
+        locate_opf=locate_opf,
+        records=records,
+    )
+    for result in results:
+        if result.error is not None:
+            yield result.path, ExtractionError(result.error)
+        elif trace and not records:
+            yield result.path, {**result.metadata, "trace": result.trace}
+        else:
+            yield result.path, result.metadata
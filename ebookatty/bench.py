@@ -0,0 +1,619 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+########################################################################
+#  Copyright (C) 2021  alexpdev
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#########################################################################
+"""
+Benchmark harness for parse latency, throughput and peak memory.
+
+Run with ``python -m ebookatty.bench``, or ``python -m ebookatty.bench
+--imports`` to check the import time of the entry points against their
+budgets.
+"""
+
+import argparse
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+from ebookatty import epub, mobi
+from ebookatty.cli import execute
+from ebookatty.metadata import fetch_metadata
+from ebookatty.synth import PROFILES, generate_corpus
+
+try:
+    import resource
+except ImportError:  # pragma: nocover
+    resource = None
+
+# Only present in a source checkout, installed copies benchmark the
+# `DEFAULT_PROFILE` synthetic corpus instead.
+BOOKS_DIR = Path(__file__).resolve().parent.parent / "tests" / "testbooks"
+
+DEFAULT_PROFILE = "typical"
+
+PACKAGE_ROOT = Path(__file__).resolve().parent.parent
+
+# Modules only specific options need, none of the entry points may load them.
+HEAVY_MODULES = ("asyncio", "concurrent.futures", "cProfile", "csv", "sqlite3", "tracemalloc")
+
+
+class BenchResult(NamedTuple):
+    """Timing summary for one benchmark target."""
+
+    name: str
+    files: int
+    seconds: float
+    files_per_sec: float
+    p50_ms: float
+    p99_ms: float
+    peak_rss_kb: Optional[int]
+
+
+class ImportBudget(NamedTuple):
+    """Allowed import time and modules of one entry point."""
+
+    name: str
+    statement: str
+    budget_ms: float
+    forbidden: Tuple[str, ...]
+
+
+class ImportResult(NamedTuple):
+    """Measured import time of one entry point."""
+
+    name: str
+    ms: float
+    budget_ms: float
+    modules: int
+    loaded: Tuple[str, ...]
+
+    @property
+    def passed(self) -> bool:
+        """True when the import met its time budget loading no forbidden module."""
+        return self.ms <= self.budget_ms and not self.loaded
+
+
+# Budgets are generous wall clock limits, the forbidden modules are what
+# keeps the import graph lazy.
+IMPORT_BUDGETS = [
+    ImportBudget(
+        "ebookatty",
+        "import ebookatty",
+        30.0,
+        ("argparse", "ebookatty.metadata", "ebookatty.standards", *HEAVY_MODULES),
+    ),
+    ImportBudget(
+        "fetch_metadata",
+        "from ebookatty import fetch_metadata",
+        50.0,
+        ("argparse", "ebookatty.epub", "ebookatty.mobi", "ebookatty.standards", *HEAVY_MODULES),
+    ),
+    ImportBudget(
+        "epub",
+        "import ebookatty.epub",
+        100.0,
+        ("argparse", "ebookatty.cli", "ebookatty.mobi", *HEAVY_MODULES),
+    ),
+    ImportBudget(
+        "mobi",
+        "import ebookatty.mobi",
+        100.0,
+        ("argparse", "ebookatty.cli", "ebookatty.epub", "zipfile", *HEAVY_MODULES),
+    ),
+    ImportBudget("cli", "import ebookatty.cli", 150.0, HEAVY_MODULES),
+]
+
+TARGETS = ("epub.Epub", "mobi.Kindle", "fetch_metadata", "cli")
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """
+    Return the nearest-rank percentile of `values`.
+
+    Parameters
+    ----------
+    values : List[float]
+        the measurements
+    pct : float
+        percentile between 0 and 100
+
+    Returns
+    -------
+    float
+        the percentile value, 0 for no measurements
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def peak_rss() -> Optional[int]:
+    """
+    Return the peak resident set size of this process in kilobytes.
+
+    The figure is the high-water mark of the whole process, which is why
+    every target is run in a process of its own, see `run_isolated`.
+
+    Returns
+    -------
+    Optional[int]
+        peak RSS, or None where the platform does not report it
+    """
+    if resource is None:  # pragma: nocover
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":  # pragma: nocover
+        rss //= 1024
+    return rss
+
+
+def bench_files(
+    name: str, func: Callable, paths: List[Path], repeat: int = 1
+) -> BenchResult:
+    """
+    Time `func` on every path and summarize the per-file latencies.
+
+    Parameters
+    ----------
+    name : str
+        label of the benchmark target
+    func : Callable
+        called with each path
+    paths : List[Path]
+        the ebooks to parse
+    repeat : int
+        number of passes over `paths`
+
+    Returns
+    -------
+    BenchResult
+        throughput, latency percentiles and peak RSS of the process
+    """
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for path in paths:
+            begin = time.perf_counter()
+            func(path)
+            latencies.append(time.perf_counter() - begin)
+    total = time.perf_counter() - start
+    return summarize(name, latencies, total)
+
+
+def bench_cli(paths: List[Path], directory: Path, repeat: int = 1) -> BenchResult:
+    """
+    Time the command line interface end to end over the corpus.
+
+    Each run writes JSON Lines output so terminal rendering is excluded.
+
+    Parameters
+    ----------
+    paths : List[Path]
+        the ebooks in the corpus
+    directory : Path
+        directory holding only the corpus, output is written next to it
+    repeat : int
+        number of runs
+
+    Returns
+    -------
+    BenchResult
+        throughput and percentiles of the per-run latency
+    """
+    latencies = []
+    out = directory.parent / "bench-output.jsonl"
+    argv = sys.argv
+    start = time.perf_counter()
+    try:
+        for _ in range(repeat):
+            sys.argv = ["ebookatty", str(directory / "*"), "-o", str(out)]
+            begin = time.perf_counter()
+            execute()
+            latencies.append(time.perf_counter() - begin)
+    finally:
+        sys.argv = argv
+        if out.exists():
+            out.unlink()
+    total = time.perf_counter() - start
+    result = summarize("cli", latencies, total)
+    return result._replace(
+        files=len(paths) * repeat, files_per_sec=len(paths) * repeat / total
+    )
+
+
+def measure_import(budget: ImportBudget, repeat: int = 5) -> ImportResult:
+    """
+    Time an import statement in fresh interpreters.
+
+    Parameters
+    ----------
+    budget : ImportBudget
+        the entry point and its limits
+    repeat : int
+        number of interpreters started, the fastest run is kept
+
+    Returns
+    -------
+    ImportResult
+        the import time and any forbidden module it loaded
+    """
+    code = (
+        "import sys, time\n"
+        "start = time.perf_counter()\n"
+        f"{budget.statement}\n"
+        "print(time.perf_counter() - start)\n"
+        "print('\\n'.join(sys.modules))\n"
+    )
+    timings = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", code],
+            cwd=PACKAGE_ROOT,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.split()
+        timings.append(float(output[0]) * 1000)
+    modules = set(output[1:])
+    return ImportResult(
+        name=budget.name,
+        ms=min(timings),
+        budget_ms=budget.budget_ms,
+        modules=len(modules),
+        loaded=tuple(name for name in budget.forbidden if name in modules),
+    )
+
+
+def bench_imports(repeat: int = 5) -> List[ImportResult]:
+    """
+    Measure every entry point of `IMPORT_BUDGETS`.
+
+    Parameters
+    ----------
+    repeat : int
+        interpreters started per entry point
+
+    Returns
+    -------
+    List[ImportResult]
+        one result per entry point
+    """
+    return [measure_import(budget, repeat) for budget in IMPORT_BUDGETS]
+
+
+def open_epub(path: Path) -> None:
+    """Parse an EPUB and release it."""
+    epub.Epub(path).close()
+
+
+def open_kindle(path: Path) -> None:
+    """Parse a Kindle file and release it."""
+    mobi.Kindle(path).close()
+
+
+def run_target(
+    name: str, paths: List[Path], directory: Path, repeat: int = 1
+) -> BenchResult:
+    """
+    Run one benchmark target of `TARGETS` in the calling process.
+
+    Parameters
+    ----------
+    name : str
+        the target
+    paths : List[Path]
+        the ebooks in the corpus
+    directory : Path
+        directory holding only the corpus
+    repeat : int
+        number of passes over the corpus
+
+    Returns
+    -------
+    BenchResult
+        the target's result
+    """
+    if name == "cli":
+        return bench_cli(paths, directory, repeat)
+    if name == "epub.Epub":
+        epubs = [p for p in paths if p.suffix == ".epub"]
+        return bench_files(name, open_epub, epubs, repeat)
+    if name == "mobi.Kindle":
+        kindles = [p for p in paths if p.suffix != ".epub"]
+        return bench_files(name, open_kindle, kindles, repeat)
+    return bench_files(name, fetch_metadata, paths, repeat)
+
+
+def run_isolated(
+    name: str, paths: List[Path], directory: Path, repeat: int = 1
+) -> BenchResult:
+    """
+    Run one benchmark target in a freshly started interpreter.
+
+    The peak RSS reported by the child covers that target alone, rather
+    than the high-water mark of every target run before it.
+
+    Parameters
+    ----------
+    name : str
+        the target
+    paths : List[Path]
+        the ebooks in the corpus
+    directory : Path
+        directory holding only the corpus
+    repeat : int
+        number of passes over the corpus
+
+    Returns
+    -------
+    BenchResult
+        the target's result
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(1, mp_context=context) as pool:
+        return pool.submit(run_target, name, paths, directory, repeat).result()
+
+
+def summarize(name: str, latencies: List[float], total: float) -> BenchResult:
+    """
+    Build a `BenchResult` from raw measurements.
+
+    Parameters
+    ----------
+    name : str
+        label of the benchmark target
+    latencies : List[float]
+        seconds spent per measured call
+    total : float
+        wall clock seconds for all calls
+
+    Returns
+    -------
+    BenchResult
+        the summary
+    """
+    return BenchResult(
+        name=name,
+        files=len(latencies),
+        seconds=total,
+        files_per_sec=len(latencies) / total if total else 0.0,
+        p50_ms=percentile(latencies, 50) * 1000,
+        p99_ms=percentile(latencies, 99) * 1000,
+        peak_rss_kb=peak_rss(),
+    )
+
+
+def replicate_corpus(books: List[Path], directory: Path, size: int) -> List[Path]:
+    """
+    Fill `directory` with `size` files cycled from the bundled books.
+
+    Parameters
+    ----------
+    books : List[Path]
+        source ebooks
+    directory : Path
+        target directory
+    size : int
+        number of files to create
+
+    Returns
+    -------
+    List[Path]
+        the created files
+    """
+    paths = []
+    for i in range(size):
+        source = books[i % len(books)]
+        target = directory / f"{i:07d}{source.suffix}"
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copyfile(source, target)
+        paths.append(target)
+    return paths
+
+
+def run(
+    books_dir: Optional[Path] = None,
+    corpus_size: int = 0,
+    repeat: int = 1,
+    synthetic: Optional[str] = None,
+) -> List[BenchResult]:
+    """
+    Run every benchmark target over the books and return the results.
+
+    Parameters
+    ----------
+    books_dir : Optional[Path]
+        directory holding the ebooks to benchmark, defaults to `BOOKS_DIR`
+        or, when that is not installed, a `DEFAULT_PROFILE` synthetic corpus
+    corpus_size : int
+        when non zero, benchmark a corpus of this many files built from
+        the books instead of the books themselves
+    repeat : int
+        number of passes over the corpus
+    synthetic : Optional[str]
+        benchmark a generated corpus of this `ebookatty.synth` profile
+        instead of the books
+
+    Returns
+    -------
+    List[BenchResult]
+        one result per benchmark target, each measured in its own process
+    """
+    if books_dir is None and not synthetic:
+        if BOOKS_DIR.is_dir():
+            books_dir = BOOKS_DIR
+        else:
+            synthetic = DEFAULT_PROFILE
+    with tempfile.TemporaryDirectory() as temp:
+        directory = Path(temp) / "corpus"
+        directory.mkdir()
+        if synthetic:
+            size = corpus_size or 100
+            corpus = generate_corpus(directory, size, profile=synthetic, per_dir=size)
+            paths = [path for path, _ in corpus]
+            directory = paths[0].parent
+        else:
+            books = sorted(p for p in Path(books_dir).iterdir() if p.is_file())
+            paths = replicate_corpus(books, directory, corpus_size or len(books))
+        return [
+            run_isolated(name, paths, directory, repeat) for name in TARGETS
+        ]
+
+
+def format_results(results: List[BenchResult]) -> str:
+    """
+    Render benchmark results as a text table.
+
+    Parameters
+    ----------
+    results : List[BenchResult]
+        the results to render
+
+    Returns
+    -------
+    str
+        the table
+    """
+    header = ("target", "files", "seconds", "files/s", "p50 ms", "p99 ms", "peak RSS KB")
+    rows = [header]
+    for r in results:
+        rows.append(
+            (
+                r.name,
+                str(r.files),
+                f"{r.seconds:.3f}",
+                f"{r.files_per_sec:.1f}",
+                f"{r.p50_ms:.3f}",
+                f"{r.p99_ms:.3f}",
+                str(r.peak_rss_kb),
+            )
+        )
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    return "\n".join(
+        "  ".join(cell.ljust(width) for cell, width in zip(row, widths))
+        for row in rows
+    )
+
+
+def format_imports(results: List[ImportResult]) -> str:
+    """
+    Render import measurements as a text table.
+
+    Parameters
+    ----------
+    results : List[ImportResult]
+        the results to render
+
+    Returns
+    -------
+    str
+        the table
+    """
+    header = ("entry point", "ms", "budget ms", "modules", "status")
+    rows = [header]
+    for r in results:
+        status = "ok" if r.passed else "over budget"
+        if r.loaded:
+            status += " (loads " + ", ".join(r.loaded) + ")"
+        rows.append((r.name, f"{r.ms:.1f}", f"{r.budget_ms:.0f}", str(r.modules), status))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    return "\n".join(
+        "  ".join(cell.ljust(width) for cell, width in zip(row, widths))
+        for row in rows
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> List[BenchResult]:
+    """
+    Execute the benchmark command line interface.
+
+    Parameters
+    ----------
+    argv : Optional[List[str]]
+        command line arguments, defaults to ``sys.argv[1:]``
+
+    Returns
+    -------
+    List[BenchResult]
+        the benchmark results, or `ImportResult` with ``--imports``
+    """
+    parser = argparse.ArgumentParser(
+        prog="python -m ebookatty.bench",
+        description="benchmark ebookatty parsers",
+    )
+    parser.add_argument(
+        "--books",
+        help="directory of ebooks to benchmark. Default is the test books of a source checkout, otherwise a synthetic corpus",
+    )
+    parser.add_argument(
+        "-n",
+        "--corpus-size",
+        help="number of files in the benchmarked corpus. Default is one copy of each book, or 100 synthetic books",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "-s",
+        "--synthetic",
+        help="benchmark a generated corpus of this profile instead of the books",
+        choices=sorted(PROFILES),
+    )
+    parser.add_argument(
+        "-r", "--repeat", help="number of passes over the corpus", type=int, default=1
+    )
+    parser.add_argument(
+        "--json", help="write the results to this file as JSON", action="store"
+    )
+    parser.add_argument(
+        "--imports",
+        help="measure the import time of the entry points in fresh interpreters, at least 5 runs each, and exit with status 1 if any exceeds its budget",
+        action="store_true",
+    )
+    args = parser.parse_args(argv)
+    if args.imports:
+        results = bench_imports(max(args.repeat, 5))
+        print(format_imports(results))
+    else:
+        books = Path(args.books) if args.books else None
+        results = run(books, args.corpus_size, args.repeat, args.synthetic)
+        print(format_results(results))
+    if args.json:
+        with open(args.json, "wt", encoding="utf-8") as fd:
+            json.dump([r._asdict() for r in results], fd, indent=2)
+    failed = [r.name for r in results if not getattr(r, "passed", True)]
+    if failed:
+        parser.exit(1, f"import budget exceeded: {', '.join(failed)}\n")
+    return results
+
+
+if __name__ == "__main__":
+    main()  # pragma: nocover
@@ -0,0 +1,315 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+########################################################################
+#  Copyright (C) 2021  alexpdev
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#########################################################################
+"""Persistent on-disk cache of extracted metadata backed by SQLite."""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, Optional, Union
+
+from ebookatty.metadata import MetadataFetcher
+
+if TYPE_CHECKING:  # pragma: nocover
+    from ebookatty.epub import OpfLocator
+
+CACHE_FILE = "metadata.sqlite3"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    digest TEXT,
+    metadata TEXT NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+"""
+
+_open_caches = {}
+
+
+def default_cache_dir() -> Path:
+    """
+    Return the default cache directory.
+
+    The ``EBOOKATTY_CACHE_DIR`` environment variable takes precedence,
+    then ``$XDG_CACHE_HOME/ebookatty`` and finally ``~/.cache/ebookatty``.
+
+    Returns
+    -------
+    Path
+        the cache directory
+    """
+    if os.environ.get("EBOOKATTY_CACHE_DIR"):
+        return Path(os.environ["EBOOKATTY_CACHE_DIR"])
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "ebookatty"
+
+
+def file_digest(path: Union[str, Path]) -> str:
+    """
+    Compute the content hash used to validate cache entries.
+
+    Parameters
+    ----------
+    path : Union[str, Path]
+        the file to hash
+
+    Returns
+    -------
+    str
+        hex digest of the file contents
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as fd:
+        for block in iter(lambda: fd.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _open_cache(directory: str, max_entries: int, use_hash: bool):
+    """
+    Return the cache instance for these settings within this process.
+
+    Used when a cache is sent to a worker process, so every worker keeps
+    a single connection open instead of one per task.
+    """
+    key = (directory, max_entries, use_hash)
+    if key not in _open_caches:
+        _open_caches[key] = MetadataCache(directory, max_entries, use_hash)
+    return _open_caches[key]
+
+
+class MetadataCache:
+    """
+    Cache of extracted metadata keyed by file path, size and mtime.
+
+    A stored entry is only returned while the file's size and modification
+    time (and, when `use_hash` is set, its content hash) are unchanged.
+    Once more than `max_entries` files are stored, the least recently used
+    entries are evicted.  Instances are safe to share between threads and
+    can be passed to worker processes.
+
+    Parameters
+    ----------
+    directory : Optional[Union[str, Path]]
+        directory holding the cache database, see `default_cache_dir`
+    max_entries : int
+        maximum number of files kept in the cache
+    use_hash : bool
+        also compare a hash of the file contents.  This reads every file in
+        full on lookup, so it is only worthwhile on filesystems with
+        unreliable modification times.
+    """
+
+    def __init__(
+        self,
+        directory: Optional[Union[str, Path]] = None,
+        max_entries: int = 250_000,
+        use_hash: bool = False,
+    ):
+        """
+        Construct the cache and open its database.
+        """
+        self.directory = Path(directory) if directory else default_cache_dir()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.use_hash = use_hash
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            self.directory / CACHE_FILE, timeout=30, check_same_thread=False
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.count = self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    def __reduce__(self):
+        """Reopen the cache by its settings when unpickled in a worker."""
+        return _open_cache, (str(self.directory), self.max_entries, self.use_hash)
+
+    def __len__(self) -> int:
+        """Return the number of cached files."""
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def __enter__(self):
+        """Enter the cache context."""
+        return self
+
+    def __exit__(self, *_):
+        """Close the cache when leaving the context."""
+        self.close()
+
+    def get(
+        self, path: Union[str, Path], stat: Optional[os.stat_result] = None
+    ) -> Optional[Dict[str, str]]:
+        """
+        Return the cached metadata for `path` if the file is unchanged.
+
+        Parameters
+        ----------
+        path : Union[str, Path]
+            path to the ebook file
+        stat : Optional[os.stat_result]
+            status of the file, taken now when omitted
+
+        Returns
+        -------
+        Optional[Dict[str, str]]
+            the stored metadata, or None if missing or stale
+        """
+        key = os.path.abspath(path)
+        if stat is None:
+            stat = os.stat(key)
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT size, mtime_ns, digest, metadata FROM entries WHERE path = ?",
+                (key,),
+            ).fetchone()
+            if row is None or (row[0], row[1]) != (stat.st_size, stat.st_mtime_ns):
+                self.misses += 1
+                return None
+        # The file is hashed without holding the lock.
+        if self.use_hash and row[2] != file_digest(key):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE entries SET accessed = ? WHERE path = ?", (time.time(), key)
+            )
+            self.hits += 1
+        return json.loads(row[3])
+
+    def put(
+        self,
+        path: Union[str, Path],
+        metadata: Dict[str, str],
+        stat: Optional[os.stat_result] = None,
+        digest: Optional[str] = None,
+    ) -> None:
+        """
+        Store the metadata for `path` along with its size and mtime.
+
+        Parameters
+        ----------
+        path : Union[str, Path]
+            path to the ebook file
+        metadata : Dict[str, str]
+            the extracted metadata
+        stat : Optional[os.stat_result]
+            status of the file taken before it was parsed, taken now when
+            omitted.  Passing the earlier status means a file rewritten
+            while it was parsed is stored as stale rather than fresh.
+        digest : Optional[str]
+            content hash taken before the file was parsed, computed now
+            when omitted and `use_hash` is set
+        """
+        key = os.path.abspath(path)
+        if stat is None:
+            stat = os.stat(key)
+        if digest is None and self.use_hash:
+            digest = file_digest(key)
+        with self.lock, self.conn:
+            existing = self.conn.execute(
+                "SELECT 1 FROM entries WHERE path = ?", (key,)
+            ).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                    digest,
+                    json.dumps(metadata),
+                    time.time(),
+                ),
+            )
+            if existing is None:
+                self.count += 1
+            if self.count > self.max_entries:
+                self.evict()
+
+    def evict(self) -> None:
+        """
+        Drop the least recently used entries once the cache is over its limit.
+
+        The cache is trimmed to 90% of `max_entries` so eviction does not
+        run again on every following insert.  Must be called with the lock
+        held.
+        """
+        self.count = self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        excess = self.count - int(self.max_entries * 0.9)
+        if self.count > self.max_entries and excess > 0:
+            self.conn.execute(
+                "DELETE FROM entries WHERE path IN "
+                "(SELECT path FROM entries ORDER BY accessed LIMIT ?)",
+                (excess,),
+            )
+            self.count -= excess
+
+    def fetch(
+        self, path: Union[str, Path], locator: Optional["OpfLocator"] = None
+    ) -> Dict[str, str]:
+        """
+        Return the metadata for `path`, parsing the file only on a miss.
+
+        Parameters
+        ----------
+        path : Union[str, Path]
+            path to the ebook file
+        locator : Optional[OpfLocator]
+            locator used when an EPUB has to be parsed
+
+        Returns
+        -------
+        Dict[str, str]
+            the ebook metadata
+        """
+        stat = os.stat(path)
+        metadata = self.get(path, stat)
+        if metadata is None:
+            digest = file_digest(path) if self.use_hash else None
+            with MetadataFetcher(path, locator=locator) as fetcher:
+                metadata = fetcher.get_metadata()
+            self.put(path, metadata, stat, digest)
+        return metadata
+
+    def clear(self) -> None:
+        """
+        Remove every entry from the cache.
+        """
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM entries")
+            self.count = 0
+
+    def close(self) -> None:
+        """
+        Close the cache database.
+        """
+        self.conn.close()
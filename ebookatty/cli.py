@@ -22,11 +22,20 @@
 import argparse
 import json
 import sys
+from collections import Counter
 from glob import glob
-from pathlib import Path
 from typing import List
 
-from ebookatty import MetadataFetcher
+from ebookatty.batch import expand_paths, iter_extract
+from ebookatty.metadata import format_output
+from ebookatty.standards import CSV_COLUMNS
+
+# The cache, index, profiling and writer modules pull in sqlite3, cProfile,
+# tracemalloc and csv, and are imported only by the options that use them.
+
+INDEX_COLUMNS = ["path", "status", "error", *CSV_COLUMNS]
+
+LOCATE_STAGES = ("epub.locate.hit", "epub.locate.miss")
 
 
 def find_matches(files: List[str]) -> List[str]:
@@ -49,12 +58,233 @@ def find_matches(files: List[str]) -> List[str]:
     return matches
 
 
+def comma_list(value: str) -> List[str]:
+    """
+    Split a comma separated command line value into its items.
+
+    Parameters
+    ----------
+    value : str
+        the argument value
+
+    Returns
+    -------
+    List[str]
+        the non empty items, stripped of whitespace
+    """
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def index_record(entry: dict, status: str) -> dict:
+    """
+    Flatten an index manifest entry into an output record.
+
+    Parameters
+    ----------
+    entry : dict
+        manifest entry from `ebookatty.index.LibraryIndex`
+    status : str
+        one of added, changed, removed or unchanged
+
+    Returns
+    -------
+    dict
+        the metadata with the file path and its index status
+    """
+    record = {"path": entry["path"], "status": status}
+    if entry.get("error"):
+        record["error"] = entry["error"]
+    record.update(entry.get("metadata") or {})
+    return record
+
+
+def execute_index(argv: List[str]):
+    """
+    Execute the ``index`` command.
+
+    Re-indexes a library directory, parsing only files that are new or
+    changed since the previous run.
+
+    Parameters
+    ----------
+    argv : List[str]
+        command line arguments following ``index``
+    """
+    parser = argparse.ArgumentParser(
+        prog="ebookatty index",
+        description="incrementally index an ebook library",
+        prefix_chars="-",
+    )
+    parser.add_argument("directory", help="root directory of the ebook library.")
+    parser.add_argument(
+        "-m",
+        "--manifest",
+        help="path of the index manifest. Default is .ebookatty-index.jsonl inside the library directory",
+        action="store",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="file path where the changed records will be written. Acceptable formats are the same as for the main command. Default is None",
+        action="store",
+    )
+    parser.add_argument(
+        "--merged",
+        help="write every indexed record instead of only the added, changed and removed files",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="number of worker processes used to extract metadata. Default is 1",
+        action="store",
+        type=int,
+        default=1,
+    )
+    args = parser.parse_args(argv)
+    from ebookatty.index import LibraryIndex, default_manifest
+    from ebookatty.writers import get_writer
+
+    writer = None
+    if args.output:
+        try:
+            writer = get_writer(args.output, columns=INDEX_COLUMNS)
+        except (ValueError, ImportError) as err:
+            parser.error(str(err))
+    index = LibraryIndex(args.manifest or default_manifest(args.directory))
+    known = set(index.stats)
+
+    def write_entry(entry):
+        status = "changed" if entry["path"] in known else "added"
+        writer.write(index_record(entry, status))
+
+    try:
+        on_entry = write_entry if (writer is not None and not args.merged) else None
+        delta = index.update(args.directory, workers=args.jobs, on_entry=on_entry)
+        if writer is not None and args.merged:
+            fresh = set(delta.added) | set(delta.changed)
+            for entry in index.entries():
+                status = "unchanged"
+                if entry["path"] in fresh:
+                    status = "added" if entry["path"] not in known else "changed"
+                writer.write(index_record(entry, status))
+        elif writer is not None:
+            for path in delta.removed:
+                writer.write({"path": path, "status": "removed"})
+    finally:
+        if writer is not None:
+            writer.close()
+    print(
+        f"added {len(delta.added)}, changed {len(delta.changed)}, "
+        f"removed {len(delta.removed)}, unchanged {delta.unchanged}"
+    )
+    return delta
+
+
+def execute_serve(argv: List[str]):
+    """
+    Execute the ``serve`` command.
+
+    Runs the metadata service until it receives SIGTERM or SIGINT, see
+    `ebookatty.server`.
+
+    Parameters
+    ----------
+    argv : List[str]
+        command line arguments following ``serve``
+    """
+    parser = argparse.ArgumentParser(
+        prog="ebookatty serve",
+        description="serve ebook metadata over HTTP from a warm worker pool",
+        prefix_chars="-",
+    )
+    parser.add_argument(
+        "--host",
+        help="loopback interface to listen on, such as 127.0.0.1, ::1 or localhost. Other interfaces are refused, the service is unauthenticated. Default is 127.0.0.1",
+        default="127.0.0.1",
+    )
+    parser.add_argument(
+        "-p",
+        "--port",
+        help="TCP port to listen on, 0 picks a free one. Default is 8080",
+        type=int,
+        default=8080,
+    )
+    parser.add_argument(
+        "-s",
+        "--socket",
+        help="listen on this Unix domain socket instead of a TCP port",
+        action="store",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="number of workers kept warm. Default is the number of CPUs",
+        type=int,
+    )
+    parser.add_argument(
+        "--executor",
+        help="run workers as processes or threads. Default is process",
+        choices=["process", "thread"],
+        default="process",
+    )
+    parser.add_argument(
+        "--max-requests",
+        help="requests handled at once, others wait up to --queue-timeout seconds. Default is four per worker",
+        type=int,
+    )
+    parser.add_argument(
+        "--queue-timeout",
+        help="seconds a request waits for a free slot before it is refused with 503. Default is 30",
+        type=float,
+        default=30.0,
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="directory holding the metadata cache shared by all requests. Default is ~/.cache/ebookatty",
+        action="store",
+    )
+    parser.add_argument(
+        "--no-cache",
+        help="parse every requested file instead of reusing cached metadata",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-q", "--quiet", help="do not log requests", action="store_true"
+    )
+    args = parser.parse_args(argv)
+    from ebookatty.cache import MetadataCache
+    from ebookatty.server import MetadataService, make_server, serve
+
+    cache = None if args.no_cache else MetadataCache(args.cache_dir)
+    service = MetadataService(
+        args.jobs, args.executor, cache, args.max_requests, args.queue_timeout
+    )
+    try:
+        try:
+            server = make_server(
+                service, args.host, args.port, args.socket, quiet=args.quiet
+            )
+        except (OSError, ValueError) as err:
+            parser.error(str(err))
+        print(f"serving on {server.url()}", file=sys.stderr, flush=True)
+        serve(server)
+    finally:
+        service.close()
+        if cache is not None:
+            cache.close()
+
+
 def execute():
     """
     Execute the program.
 
     This is the applications main entrypoint and CLI implementation.
     """
+    if sys.argv[1:2] == ["index"]:
+        return execute_index(sys.argv[2:])
+    if sys.argv[1:2] == ["serve"]:
+        return execute_serve(sys.argv[2:])
     parser = argparse.ArgumentParser(description="get ebook metadata", prefix_chars="-")
     parser.add_argument(
         "file",
@@ -64,50 +294,130 @@ def execute():
     parser.add_argument(
         "-o",
         "--output",
-        help="file path where metadata will be written. Acceptable formats include json and csv and are determined based on the file extension. Default is None",
+        help="file path where metadata will be written. Acceptable formats include json, jsonl (or ndjson), csv and, with pyarrow installed, arrow (or feather) and parquet, and are determined based on the file extension. Default is None",
+        action="store",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="number of worker processes used to extract metadata. Default is 1",
+        action="store",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--unordered",
+        help="emit each record as soon as its file is parsed instead of in input order. Only matters with --jobs",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--fields",
+        help="comma separated fields to extract, e.g. title,author,isbn. Other metadata is not decoded. Default is every field",
+        type=comma_list,
+    )
+    parser.add_argument(
+        "--columns",
+        help="comma separated columns of csv output, in order. Default is the common publication fields",
+        type=comma_list,
+    )
+    parser.add_argument(
+        "--cache",
+        help="reuse metadata cached by earlier runs for files whose size and modification time are unchanged",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="directory holding the metadata cache, implies --cache. Default is ~/.cache/ebookatty",
         action="store",
     )
+    parser.add_argument(
+        "--trace",
+        help="add the time and bytes spent in each parsing stage to every record. Printed to stderr when there is no output file",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--locate-opf",
+        help="guess the OPF location of EPUBs from the paths seen in earlier books, reading META-INF/container.xml only when the guess cannot be confirmed. With --trace, the hits and misses are reported on stderr",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--profile",
+        help="write cProfile, sampled stack and tracemalloc reports of the run, broken down by format, to this directory. Files are parsed in-process, --jobs is ignored",
+        action="store",
+        metavar="DIR",
+    )
     if len(sys.argv[1:]) == 0:
         sys.argv.append("-h")
     args = parser.parse_args(sys.argv[1:])
-    file_list = args.file
-    matches = find_matches(file_list)
-    datas = []
-    for match in matches:
-        fetcher = MetadataFetcher(match)
-        data = fetcher.get_metadata()
-        datas.append(data)
-        if not args.output:
-            fetcher.show_metadata()
+    cache = None
+    if args.cache or args.cache_dir:
+        from ebookatty.cache import MetadataCache
+
+        cache = MetadataCache(args.cache_dir)
+    writer = None
     if args.output:
-        path = Path(args.output)
-        if path.suffix == ".json":
-            json.dump(datas, open(path, "wt"))
-        elif path.suffix == ".csv":
-            d = set()
-            for row in datas:
-                for key in row.keys():
-                    d.add(key)
-            headers = list(d)
-            layers = [headers]
-            for row in datas:
-                layer = []
-                for header in headers:
-                    record = row.get(header, "")
-                    if isinstance(record, list):
-                        record = record[0]
-                    if isinstance(record, int):
-                        record = str(record)
-                    if isinstance(record, bytes):  # pragma: nocover
-                        try:
-                            record = str(record[0], encoding="utf8", errors="ignore")
-                        except:
-                            continue
-                    layer.append(record)
-                layers.append(layer)
-            with open(path, "wt", encoding="utf-8", errors="ignore") as fd:
-                for layer in layers:
-                    try:
-                        fd.write(",".join(layer) + "\n")
-                    except:
-                        continue
+        from ebookatty.writers import find_writer, get_writer
+
+        try:
+            if args.columns and not find_writer(args.output).supports_columns:
+                parser.error("--columns is only supported for csv output")
+            writer = get_writer(args.output, columns=args.columns or args.fields)
+        except (ValueError, ImportError) as err:
+            parser.error(str(err))
+    elif args.columns:
+        parser.error("--columns is only supported for csv output")
+    profiler = None
+    workers = args.jobs
+    if args.profile:
+        from ebookatty.profiling import Profiler
+
+        profiler = Profiler(args.profile)
+        workers = 1
+        profiler.start()
+    try:
+        paths = expand_paths(args.file)
+        if profiler is not None:
+            paths = profiler.track(paths)
+        results = iter_extract(
+            paths,
+            workers=workers,
+            ordered=not args.unordered,
+            cache=cache,
+            fields=args.fields,
+            trace=args.trace,
+            locate_opf=args.locate_opf,
+        )
+        located = Counter()
+        for result in results:
+            if result.trace:
+                located.update(key for key in result.trace if key in LOCATE_STAGES)
+            if result.error is not None:
+                print(f"{result.path}: {result.error}", file=sys.stderr)
+                continue
+            data = result.metadata
+            if writer is not None:
+                if writer.includes_path:
+                    data = {**data, "path": result.path}
+                if args.trace:
+                    data = {**data, "trace": result.trace}
+                writer.write(data)
+            else:
+                if args.trace:
+                    print(
+                        f"{result.path}: trace {json.dumps(result.trace)}",
+                        file=sys.stderr,
+                    )
+                if data:
+                    format_output(data)
+        if args.locate_opf and args.trace:
+            hits, misses = (located[key] for key in LOCATE_STAGES)
+            print(f"opf locator: {hits} hits, {misses} misses", file=sys.stderr)
+    finally:
+        if writer is not None:
+            writer.close()
+        if cache is not None:
+            cache.close()
+        if profiler is not None:
+            profiler.stop()
+            for path in profiler.report():
+                print(f"profile written to {path}", file=sys.stderr)
@@ -19,12 +19,141 @@
 #########################################################################
 """Epub module for extracting metadata from ebooks with the .epub extension."""
 
-import re
+import io
+import threading
 import zipfile
+from collections import Counter
 from pathlib import Path
+from typing import BinaryIO, Callable, Iterable, List, Optional, Union
 from xml.etree import ElementTree as ET
 
+from ebookatty.archive import CentralDirectory, UnsupportedArchive
+from ebookatty.record import (
+    BookMetadata,
+    completion_keys,
+    is_complete,
+    join_values,
+    project,
+    source_keys,
+)
 from ebookatty.standards import OPF_TAGS
+from ebookatty.trace import stage
+
+
+IGNORED_TEXT = (None, "None", "NONE")
+
+COMMON_OPF_PATHS = (
+    "OEBPS/content.opf",
+    "OPS/content.opf",
+    "content.opf",
+    "OEBPS/package.opf",
+    "OPS/package.opf",
+    "EPUB/package.opf",
+    "package.opf",
+    "OEBPS/volume.opf",
+    "metadata.opf",
+)
+
+
+def local_name(tag: str) -> str:
+    """
+    Strip the namespace from an ElementTree tag.
+
+    Parameters
+    ----------
+    tag : str
+        tag in ``{namespace}name`` or plain ``name`` form
+
+    Returns
+    -------
+    str
+        the tag name without its namespace
+    """
+    return tag.rpartition("}")[2]
+
+
+class OpfLocator:
+    """
+    Guess the OPF location from the archive name list before reading
+    ``META-INF/container.xml``.
+
+    Books from the same producer share their OPF path, so the locator tries
+    the paths it has already learned from container documents, most
+    frequent first, followed by `COMMON_OPF_PATHS`.  A guess is accepted
+    only when it is the sole ``.opf`` member of the archive, anything else
+    is resolved through the container document.  One instance can be
+    shared by every `Epub` of a run, including across threads.
+
+    Parameters
+    ----------
+    common : tuple
+        fixed candidate paths tried after the learned ones
+    max_learned : int
+        number of distinct learned paths kept
+    """
+
+    def __init__(self, common: tuple = COMMON_OPF_PATHS, max_learned: int = 32):
+        """
+        Construct the locator with empty counters.
+        """
+        self.common = common
+        self.max_learned = max_learned
+        self.learned = Counter()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def candidates(self) -> List[str]:
+        """
+        Return the paths to try, learned paths first.
+
+        Returns
+        -------
+        List[str]
+            candidate OPF member names
+        """
+        with self.lock:
+            learned = [path for path, _ in self.learned.most_common()]
+        return learned + [path for path in self.common if path not in learned]
+
+    def locate(self, names: List[str], read_container: Callable[[], str]) -> str:
+        """
+        Return the OPF member name, reading the container only on a miss.
+
+        The lookup is traced as the ``epub.locate.hit`` or
+        ``epub.locate.miss`` stage, so per-file traces tell the two apart.
+
+        Parameters
+        ----------
+        names : List[str]
+            member names of the archive
+        read_container : Callable[[], str]
+            returns the OPF path declared by ``META-INF/container.xml``
+
+        Returns
+        -------
+        str
+            the OPF member name
+        """
+        opfs = [name for name in names if name.lower().endswith(".opf")]
+        hit = len(opfs) == 1 and opfs[0] in self.candidates()
+        with stage("epub.locate.hit" if hit else "epub.locate.miss"):
+            if hit:
+                with self.lock:
+                    self.hits += 1
+                return opfs[0]
+            opf = read_container()
+        with self.lock:
+            self.misses += 1
+            if opf in self.learned or len(self.learned) < self.max_learned:
+                self.learned[opf] += 1
+        return opf
+
+    @property
+    def hit_rate(self) -> float:
+        """Fraction of lookups answered without reading the container."""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
 
 
 class Epub:
@@ -33,40 +162,277 @@ class Epub:
 
     Parameters
     ----------
-    path : str
-        path to the ebook file.
+    path : Union[str, Path, bytes, memoryview, BinaryIO]
+        path to the ebook file, the ebook contents as a bytes-like object
+        or a seekable binary file object.
+    fast : bool
+        read the archive through its central directory, decompressing only
+        the container and OPF documents.  Archives the fast reader cannot
+        handle are reopened with `zipfile`.
+    locator : Optional[OpfLocator]
+        guess the OPF location from the archive name list, reading
+        ``META-INF/container.xml`` only when the guess cannot be confirmed.
+    fields : Optional[Iterable[str]]
+        only extract these fields, see `ebookatty.record.project`.  Other
+        tags are skipped and parsing stops at the end of ``<metadata>``.
+    records : bool
+        build the typed `record` instead of the `metadata` dictionary,
+        which is then None.
+
+    The archive stays open until `close` is called, use the instance as a
+    context manager to release it promptly.  File objects supplied by the
+    caller are never closed.
     """
 
-    def __init__(self, path: str):
+    def __init__(
+        self,
+        path: Union[str, Path, bytes, memoryview, BinaryIO],
+        fast: bool = True,
+        locator: Optional[OpfLocator] = None,
+        fields: Optional[Iterable[str]] = None,
+        records: bool = False,
+    ):
         """
         Construct the Epub Class Instance.
         """
+        self.fields = tuple(fields) if fields else None
         self.tags = OPF_TAGS
-        self.path = Path(path)
-        self.epub_zip = zipfile.ZipFile(self.path)
-        self.stem = self.path.stem
-        self.suffix = self.path.suffix
-        self.opf = self.get_opf()
-        self.opf_data = self.epub_zip.read(self.opf).decode()
-        root = ET.fromstring(self.opf_data)
-        meta = self.iterer(root)
-        for key, val in meta.items():
+        if self.fields:
+            wanted = source_keys(self.fields)
+            self.tags = [tag for tag in OPF_TAGS if tag in wanted]
+        self.locator = locator
+        if isinstance(path, (bytes, bytearray, memoryview)):
+            self.path = None
+            self.source = io.BytesIO(path)
+        elif not isinstance(path, (str, Path)):
+            name = getattr(path, "name", None)
+            self.path = Path(name) if isinstance(name, str) else None
+            self.source = path
+        else:
+            self.path = Path(path)
+            self.source = None
+        self.stem = self.path.stem if self.path else ""
+        self.suffix = self.path.suffix if self.path else ""
+        self.epub_zip = None
+        try:
+            meta = self.read_package(fast)
+        except BaseException:
+            self.close()
+            raise
+        self.values = meta
+        self.record = None
+        self.metadata = None
+        with stage("epub.record"):
+            if records:
+                self.record = BookMetadata.from_values(meta)
+            else:
+                self.metadata = self.legacy_metadata(meta)
+
+    def legacy_metadata(self, values: dict) -> dict:
+        """
+        Join the parsed values into the metadata dictionary.
+
+        Parameters
+        ----------
+        values : dict
+            tag names mapped to the list of their text values
+
+        Returns
+        -------
+        dict
+            tag or field names mapped to their joined values
+        """
+        if self.fields:
+            values = project(values, self.fields)
+        meta = {}
+        for key, val in values.items():
             if val:
-                val = "; ".join([str(i) for i in set(val)])
+                val = join_values(val)
                 if val == "en":
                     val = "English"
-                meta[key] = val
-        if "creator" in meta:
+            meta[key] = val
+        if "creator" in meta and not self.fields:
             meta["author"] = meta["creator"]
-        self.metadata = meta
+        return meta
+
+    def __enter__(self):
+        """Return the instance, the archive is closed on exit."""
+        return self
+
+    def __exit__(self, *_):
+        """Close the archive."""
+        self.close()
+
+    def open_archive(self, fast: bool):
+        """
+        Open the zip archive of the ebook.
+
+        Parameters
+        ----------
+        fast : bool
+            use the central directory reader instead of `zipfile`
+
+        Returns
+        -------
+        Union[CentralDirectory, zipfile.ZipFile]
+            the open archive
+        """
+        with stage("epub.archive") as timer:
+            if not fast:
+                if self.source is None:
+                    return zipfile.ZipFile(self.path)
+                self.source.seek(0)
+                return zipfile.ZipFile(self.source)
+            if self.source is not None:
+                archive = CentralDirectory(self.source)
+            else:
+                fd = open(self.path, "rb")
+                try:
+                    archive = CentralDirectory(fd, owned=True)
+                except BaseException:
+                    fd.close()
+                    raise
+            timer.nbytes = archive.bytes_read
+            return archive
+
+    def read_package(self, fast: bool) -> dict:
+        """
+        Open the archive, locate the OPF document and parse its metadata.
+
+        Parameters
+        ----------
+        fast : bool
+            try the central directory reader first
+
+        Returns
+        -------
+        dict
+            tag names mapped to the list of their text values
+        """
+        if fast:
+            try:
+                self.epub_zip = self.open_archive(True)
+                return self.read_opf()
+            except UnsupportedArchive:
+                self.close()
+        self.epub_zip = self.open_archive(False)
+        return self.read_opf()
+
+    def read_opf(self) -> dict:
+        """
+        Locate the OPF document in the open archive and parse its metadata.
+
+        Returns
+        -------
+        dict
+            tag names mapped to the list of their text values
+        """
+        self.opf = self.find_opf()
+        with stage("epub.opf") as timer:
+            with self.epub_zip.open(self.opf) as opf:
+                meta = self.parse_metadata(opf)
+            timer.nbytes = self.member_size(self.opf)
+        return meta
+
+    def member_size(self, name: str) -> int:
+        """
+        Return the uncompressed size of an archive member.
+
+        Parameters
+        ----------
+        name : str
+            member name
+
+        Returns
+        -------
+        int
+            size in bytes
+        """
+        if isinstance(self.epub_zip, CentralDirectory):
+            return self.epub_zip.members[name].size
+        return self.epub_zip.getinfo(name).file_size
+
+    def close(self) -> None:
+        """
+        Release the archive and any file opened for it.
+
+        Safe to call more than once.
+        """
+        if self.epub_zip is not None:
+            self.epub_zip.close()
+            self.epub_zip = None
+
+    def parse_metadata(self, source) -> dict:
+        """
+        Extract metadata tags from the ``<metadata>`` section of the OPF.
+
+        The document is read as a byte stream and parsed incrementally, so
+        the encoding is taken from its XML declaration and the raw document
+        is never held in memory in full.  Parsing stops as soon as the
+        ``<metadata>`` element is complete, so the ``<manifest>``,
+        ``<spine>`` and ``<guide>`` sections that follow it are never read,
+        and the ``<metadata>`` subtree is released once its values have been
+        collected.  Documents without a ``<metadata>`` element are searched
+        in full.
+
+        Parameters
+        ----------
+        source : file object
+            readable binary OPF document
+
+        Returns
+        -------
+        dict
+            tag names mapped to the list of their text values
+        """
+        parser = ET.iterparse(source, events=("end",))
+        if self.fields:
+            return self.parse_fields(parser)
+        for _, elem in parser:
+            if local_name(elem.tag) == "metadata":
+                meta = self.iterer(elem)
+                elem.clear()
+                return meta
+        return self.iterer(parser.root)
+
+    def parse_fields(self, parser) -> dict:
+        """
+        Collect only the requested tags.
+
+        Elements are inspected as they are completed, so parsing ends at
+        the end of ``<metadata>``, or earlier once every requested field is
+        found when none of them can repeat, see
+        `ebookatty.record.completion_keys`.
+
+        Parameters
+        ----------
+        parser : iterator
+            ``end`` events of an `ET.iterparse` over the OPF document
+
+        Returns
+        -------
+        dict
+            requested tag names mapped to the list of their text values
+        """
+        meta = {}
+        groups = completion_keys(self.fields)
+        for _, elem in parser:
+            tag = local_name(elem.tag)
+            if tag in self.tags and elem.text not in IGNORED_TEXT:
+                meta.setdefault(tag, []).append(elem.text)
+                if groups is not None and is_complete(meta, groups):
+                    break
+            if tag == "metadata":
+                break
+        return meta
 
     def iterer(self, root: ET.Element) -> dict:
         """
         Iterate through elements looking for metadata tags.
 
-        Recursively iterate through each and every element checking it's tag
-        and attributes for metadata information and assigning the values to a
-        metadata dictionary and returning the final compiled result.
+        Walk `root` and all of its descendants in document order, checking
+        each tag for metadata information and assigning the values to a
+        metadata dictionary.
 
         Parameters
         ----------
@@ -78,20 +444,26 @@ class Epub:
         dict
             all metadata extracted from element and its children
         """
-        pattern = re.compile(r"\{.*\}(\w+)")
-        match = pattern.findall(root.tag)[0]
-        if match in self.tags and root.text not in [None, "None", "NONE"]:
-            meta = {match: [root.text]}
-        else:
-            meta = {}
-        for element in root:
-            if element != root:
-                data = self.iterer(element)
-                for k, v in data.items():
-                    meta.setdefault(k, [])
-                    meta[k].extend(v)
+        meta = {}
+        for element in root.iter():
+            tag = local_name(element.tag)
+            if tag in self.tags and element.text not in IGNORED_TEXT:
+                meta.setdefault(tag, []).append(element.text)
         return meta
 
+    def find_opf(self) -> str:
+        """
+        Return the OPF member name, consulting the locator when one is set.
+
+        Returns
+        -------
+        str
+            the path to the opf file contained in the ziparchive
+        """
+        if self.locator is None:
+            return self.get_opf()
+        return self.locator.locate(self.epub_zip.namelist(), self.get_opf)
+
     def get_opf(self) -> str:
         """
         Extract the path to the zipfile opf file.
@@ -108,8 +480,10 @@ class Epub:
             "pkg": "http://www.idpf.org/2007/opf",
             "dc": "http://purl.org/dc/elements/1.1/",
         }
-        txt = self.epub_zip.read("META-INF/container.xml")
-        tree = ET.fromstring(txt)
+        with stage("epub.container") as timer:
+            txt = self.epub_zip.read("META-INF/container.xml")
+            timer.nbytes = len(txt)
+            tree = ET.fromstring(txt)
         elems = tree.findall("n:rootfiles/n:rootfile", namespaces=ns)
         for elem in elems:
             if "full-path" in elem.attrib:
@@ -0,0 +1,278 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+########################################################################
+#  Copyright (C) 2021  alexpdev
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#########################################################################
+"""Incremental re-indexing of an ebook library with change detection."""
+
+import json
+import os
+from pathlib import Path
+from typing import Callable, Dict, Generator, List, NamedTuple, Optional, Tuple, Union
+
+from ebookatty.batch import iter_extract
+
+EBOOK_SUFFIXES = (".epub", ".mobi", ".azw", ".azw3", ".kfx", ".prc", ".pdb")
+
+MANIFEST_NAME = ".ebookatty-index.jsonl"
+
+
+class IndexDelta(NamedTuple):
+    """Files that differ between the manifest and the library on disk."""
+
+    added: List[str]
+    changed: List[str]
+    removed: List[str]
+    unchanged: int
+
+
+def scan_tree(root: Union[str, Path], suffixes: Tuple[str] = EBOOK_SUFFIXES) -> Dict:
+    """
+    Stat every ebook below `root` without opening any of them.
+
+    Subdirectories that cannot be read are skipped.  Ebooks that cannot
+    be stat'ed, such as dangling symlinks, are listed without a size or
+    modification time, so parsing them records the error in the manifest.
+
+    Parameters
+    ----------
+    root : Union[str, Path]
+        top of the library directory tree
+    suffixes : Tuple[str]
+        lower case file extensions that are considered ebooks
+
+    Returns
+    -------
+    Dict[str, Tuple[Optional[int], Optional[int]]]
+        absolute path mapped to its size and modification time in ns
+
+    Raises
+    ------
+    OSError
+        if `root` itself cannot be read
+    """
+    found = {}
+    root = os.path.abspath(root)
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif os.path.splitext(entry.name)[1].lower() in suffixes:
+                        found[entry.path] = stat_entry(entry)
+        except OSError:
+            if directory == root:
+                raise
+    return found
+
+
+def stat_entry(entry: os.DirEntry) -> Tuple[Optional[int], Optional[int]]:
+    """
+    Return the size and modification time of a directory entry.
+
+    Parameters
+    ----------
+    entry : os.DirEntry
+        entry produced by `os.scandir`
+
+    Returns
+    -------
+    Tuple[Optional[int], Optional[int]]
+        size and modification time in ns, both None if it cannot be stat'ed
+    """
+    try:
+        stat = entry.stat()
+    except OSError:
+        return None, None
+    return stat.st_size, stat.st_mtime_ns
+
+
+class LibraryIndex:
+    """
+    Manifest of previously indexed files and their metadata.
+
+    The manifest is a JSON Lines file with one entry per ebook.  Only the
+    size and modification time of each entry are held in memory; the
+    metadata itself is streamed from and back to disk when the manifest is
+    rewritten.
+
+    Parameters
+    ----------
+    manifest : Union[str, Path]
+        path of the manifest file, created on the first update.
+    """
+
+    def __init__(self, manifest: Union[str, Path]):
+        """
+        Construct the index and load the stat records from the manifest.
+        """
+        self.manifest = Path(manifest)
+        self.stats = {}
+        for entry in self.entries():
+            self.stats[entry["path"]] = (entry["size"], entry["mtime_ns"])
+
+    def entries(self) -> Generator:
+        """
+        Iterate over the entries stored in the manifest.
+
+        Yields
+        ------
+        Generator[dict]
+            each entry with its path, size, mtime_ns, metadata and error
+        """
+        if not self.manifest.exists():
+            return
+        with open(self.manifest, "rt", encoding="utf-8") as fd:
+            for line in fd:
+                if line.strip():
+                    yield json.loads(line)
+
+    def diff(self, current: Dict[str, Tuple[int, int]]) -> IndexDelta:
+        """
+        Compare a fresh scan of the library with the manifest.
+
+        Parameters
+        ----------
+        current : Dict[str, Tuple[int, int]]
+            output of `scan_tree`
+
+        Returns
+        -------
+        IndexDelta
+            new, modified and deleted files
+        """
+        added, changed = [], []
+        for path, stat in current.items():
+            if path not in self.stats:
+                added.append(path)
+            elif self.stats[path] != tuple(stat):
+                changed.append(path)
+        removed = [path for path in self.stats if path not in current]
+        unchanged = len(current) - len(added) - len(changed)
+        return IndexDelta(sorted(added), sorted(changed), sorted(removed), unchanged)
+
+    def update(
+        self,
+        root: Union[str, Path],
+        workers: int = 1,
+        executor: str = "process",
+        suffixes: Tuple[str] = EBOOK_SUFFIXES,
+        on_entry: Optional[Callable[[dict], None]] = None,
+    ) -> IndexDelta:
+        """
+        Re-index the library, parsing only new and modified files.
+
+        Deleted files are dropped from the manifest, which is then replaced
+        atomically.  Files that fail to parse are stored with their error
+        so they are retried only once they change.
+
+        Parameters
+        ----------
+        root : Union[str, Path]
+            top of the library directory tree
+        workers : int
+            number of workers used for parsing
+        executor : str
+            ``"process"`` or ``"thread"``
+        suffixes : Tuple[str]
+            lower case file extensions that are considered ebooks
+        on_entry : Optional[Callable[[dict], None]]
+            called with the manifest entry of each added or changed file
+            as soon as it has been parsed
+
+        Returns
+        -------
+        IndexDelta
+            new, modified and deleted files
+        """
+        current = scan_tree(root, suffixes)
+        delta = self.diff(current)
+        stale = set(delta.changed) | set(delta.removed)
+        self.manifest.parent.mkdir(parents=True, exist_ok=True)
+        temp = self.manifest.with_name(self.manifest.name + ".tmp")
+        with open(temp, "wt", encoding="utf-8") as fd:
+            for entry in self.entries():
+                if entry["path"] not in stale:
+                    fd.write(json.dumps(entry) + "\n")
+            paths = delta.added + delta.changed
+            for result in iter_extract(paths, workers, executor):
+                size, mtime_ns = current[result.path]
+                entry = {
+                    "path": result.path,
+                    "size": size,
+                    "mtime_ns": mtime_ns,
+                    "metadata": result.metadata,
+                    "error": result.error,
+                }
+                fd.write(json.dumps(entry) + "\n")
+                if on_entry is not None:
+                    on_entry(entry)
+        os.replace(temp, self.manifest)
+        self.stats = current
+        return delta
+
+
+def default_manifest(root: Union[str, Path]) -> Path:
+    """
+    Return the default manifest location for a library.
+
+    Parameters
+    ----------
+    root : Union[str, Path]
+        top of the library directory tree
+
+    Returns
+    -------
+    Path
+        manifest path inside the library root
+    """
+    return Path(root) / MANIFEST_NAME
+
+
+def index_library(
+    root: Union[str, Path],
+    manifest: Optional[Union[str, Path]] = None,
+    workers: int = 1,
+    executor: str = "process",
+    on_entry: Optional[Callable[[dict], None]] = None,
+) -> IndexDelta:
+    """
+    Update the manifest of the library at `root` and return the changes.
+
+    Parameters
+    ----------
+    root : Union[str, Path]
+        top of the library directory tree
+    manifest : Optional[Union[str, Path]]
+        manifest path, defaults to a hidden file inside `root`
+    workers : int
+        number of workers used for parsing
+    executor : str
+        ``"process"`` or ``"thread"``
+    on_entry : Optional[Callable[[dict], None]]
+        called with the manifest entry of each added or changed file
+
+    Returns
+    -------
+    IndexDelta
+        new, modified and deleted files
+    """
+    index = LibraryIndex(manifest or default_manifest(root))
+    return index.update(root, workers, executor, on_entry=on_entry)
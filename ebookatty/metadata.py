@@ -22,32 +22,280 @@ Module contains implementation specific to amazon formatted ebooks.
 
 Classes and functions for .azw, .azw3, and .kfx ebooks.
 """
-import shutil
+from importlib import import_module
 from pathlib import Path
-from typing import Dict, Generator, Union
+from typing import TYPE_CHECKING, BinaryIO, Dict, Generator, Iterable, Optional, Union
 
-from ebookatty import epub, mobi, standards
+if TYPE_CHECKING:  # pragma: nocover
+    from ebookatty.epub import OpfLocator
+    from ebookatty.record import BookMetadata
+
+Source = Union[str, Path, bytes, bytearray, memoryview, BinaryIO]
+
+# Parser classes by format, as module and class names so that a parser and
+# the tables it needs are only imported once a book of its format is read.
+PARSERS = {"epub": ("ebookatty.epub", "Epub"), "mobi": ("ebookatty.mobi", "Kindle")}
+
+FORMAT_ALIASES = {"azw": "mobi", "azw3": "mobi", "kfx": "mobi", "kindle": "mobi"}
+
+
+SIGNATURE_SIZE = 80
+
+EPUB_MIMETYPE = b"application/epub+zip"
+
+ZIP_SIGNATURE = b"PK\x03\x04"
+
+EPUB_CONTAINER = "META-INF/container.xml"
+
+PDB_IDENTITIES = (b"BOOKMOBI", b"TEXTREAD")
+
+
+class UnsupportedFormatError(ValueError):
+    """Raised when the contents of a file are not a supported ebook format."""
+
+
+def read_signature(source: Source) -> bytes:
+    """
+    Read the leading bytes used to identify the ebook format.
+
+    A single read of `SIGNATURE_SIZE` bytes is made, streams are returned
+    to their original position afterwards.
+
+    Parameters
+    ----------
+    source : Source
+        file path, bytes-like object or seekable binary stream
+
+    Returns
+    -------
+    bytes
+        the first bytes of the ebook
+    """
+    if isinstance(source, (str, Path)):
+        with open(source, "rb") as fd:
+            return fd.read(SIGNATURE_SIZE)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source[:SIGNATURE_SIZE])
+    pos = source.tell()
+    signature = source.read(SIGNATURE_SIZE)
+    source.seek(pos)
+    return signature
+
+
+def sniff_format(signature: bytes) -> Optional[str]:
+    """
+    Identify the ebook format from its leading bytes.
+
+    EPUB containers are zip archives and, when the archive starts with the
+    ``mimetype`` entry the specification requires, it must be stored with
+    the EPUB media type.  Zip archives without that entry cannot be told
+    apart from their first bytes and are reported as ``"zip"``, see
+    `has_container`.  Kindle files are Palm databases carrying the
+    ``BOOKMOBI`` or ``TEXtREAd`` identity at offset 60.
+
+    Parameters
+    ----------
+    signature : bytes
+        the first bytes of the file, see `read_signature`
+
+    Returns
+    -------
+    Optional[str]
+        ``"epub"``, ``"mobi"``, ``"zip"`` or None for unsupported content
+    """
+    if signature[:4] == ZIP_SIGNATURE:
+        if signature[30:38] != b"mimetype":
+            return "zip"
+        if signature[38 : 38 + len(EPUB_MIMETYPE)] == EPUB_MIMETYPE:
+            return "epub"
+        return None
+    if signature[60:68].upper() in PDB_IDENTITIES:
+        return "mobi"
+    return None
+
+
+def has_container(source: Source) -> bool:
+    """
+    Check whether a zip archive holds the EPUB container document.
+
+    Only the central directory is read.  Archives the minimal reader does
+    not handle are listed with `zipfile` instead, and anything that is not
+    a readable zip archive has no container.
+
+    Parameters
+    ----------
+    source : Source
+        file path, bytes-like object or seekable binary stream
+
+    Returns
+    -------
+    bool
+        True if ``META-INF/container.xml`` is a member of the archive
+    """
+    import io
+    import zipfile
+
+    from ebookatty.archive import CentralDirectory, UnsupportedArchive
+
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    if isinstance(source, (str, Path)):
+        with open(source, "rb") as fd:
+            return has_container(fd)
+    pos = source.tell()
+    try:
+        try:
+            return EPUB_CONTAINER in CentralDirectory(source).members
+        except UnsupportedArchive:
+            source.seek(0)
+            with zipfile.ZipFile(source) as archive:
+                return EPUB_CONTAINER in archive.namelist()
+    except (zipfile.BadZipFile, EOFError, ValueError):
+        return False
+    finally:
+        source.seek(pos)
+
+
+def guess_format(source: Source) -> str:
+    """
+    Determine which parser handles the ebook from its content.
+
+    The file extension is ignored, so misnamed files and files without an
+    extension are handled, and anything else is rejected before it is
+    parsed.
+
+    Parameters
+    ----------
+    source : Source
+        file path, bytes-like object or seekable binary stream
+
+    Returns
+    -------
+    str
+        ``"epub"`` or ``"mobi"``
+
+    Raises
+    ------
+    UnsupportedFormatError
+        if the content is not a supported ebook format
+    """
+    format = sniff_format(read_signature(source))
+    if format == "zip":
+        format = "epub" if has_container(source) else None
+    if format is None:
+        name = source if isinstance(source, (str, Path)) else type(source).__name__
+        raise UnsupportedFormatError(f"unsupported ebook format: {name}")
+    return format
+
+
+def get_parser(format: str) -> type:
+    """
+    Import and return the parser class of a format.
+
+    Parameters
+    ----------
+    format : str
+        a key of `PARSERS`
+
+    Returns
+    -------
+    type
+        the parser class
+    """
+    module, name = PARSERS[format]
+    return getattr(import_module(module), name)
+
+
+def open_ebook(
+    source: Source,
+    format: Optional[str] = None,
+    fields: Optional[Iterable[str]] = None,
+    locator: Optional["OpfLocator"] = None,
+    records: bool = False,
+):
+    """
+    Parse the ebook with the parser for its format.
+
+    Parameters
+    ----------
+    source : Source
+        file path, bytes-like object or seekable binary stream
+    format : Optional[str]
+        format hint such as ``"epub"``, ``"mobi"`` or ``"azw3"``, guessed
+        from the source when omitted
+    fields : Optional[Iterable[str]]
+        only extract these fields, all of them when omitted
+    locator : Optional[OpfLocator]
+        locator consulted for the OPF path of EPUBs, ignored otherwise
+    records : bool
+        build the parser's typed ``record`` instead of its ``metadata``
+
+    Returns
+    -------
+    Union[epub.Epub, mobi.Kindle]
+        the parsed ebook
+    """
+    if format is None:
+        format = guess_format(source)
+    format = format.lower().lstrip(".")
+    format = FORMAT_ALIASES.get(format, format)
+    if format not in PARSERS:
+        raise UnsupportedFormatError(f"unsupported ebook format {format!r}")
+    if isinstance(source, str):
+        source = Path(source)
+    if locator is not None and format == "epub":
+        return get_parser(format)(
+            source, fields=fields, locator=locator, records=records
+        )
+    return get_parser(format)(source, fields=fields, records=records)
 
 
 class MetadataFetcher:
     """Primary Entrypoint for extracting metadata from most ebook filetypes."""
 
-    def __init__(self, path: str):
+    def __init__(
+        self,
+        path: Source,
+        format: Optional[str] = None,
+        fields: Optional[Iterable[str]] = None,
+        locator: Optional["OpfLocator"] = None,
+        records: bool = False,
+    ):
         """
         Construct the MetadataFetcher Class and return Instance.
 
         Parameters
         ----------
-        path : str
-            The path to the ebook to extract from
+        path : Source
+            The path to the ebook to extract from, or its contents as a
+            bytes-like object or seekable binary file object
+        format : Optional[str]
+            format hint, guessed from the source when omitted
+        fields : Optional[Iterable[str]]
+            only extract these fields, e.g. ``["title", "author"]``.
+            Aliases such as ``author`` and ``creator`` are resolved for
+            every format, and the parsers skip everything else.
+        locator : Optional[OpfLocator]
+            guess the OPF location of EPUBs, see `ebookatty.epub.OpfLocator`.
+            Share one locator between fetchers so it learns across books.
+        records : bool
+            only build the typed record of `get_record`, `get_metadata`
+            then returns None.
         """
-        self.path = Path(path)
-        if self.path.suffix == ".epub":
-            self.meta = epub.Epub(self.path)
-        elif self.path.suffix in [".azw3", "azw", "kfx", ".mobi"]:
-            self.meta = mobi.Kindle(self.path)
-        else:
-            self.meta = mobi.Kindle(self.path)
+        self.path = Path(path) if isinstance(path, (str, Path)) else None
+        self.meta = open_ebook(path, format, fields, locator, records)
+
+    def __enter__(self):
+        """Return the instance, the ebook is closed on exit."""
+        return self
+
+    def __exit__(self, *_):
+        """Close the ebook."""
+        self.close()
+
+    def close(self):
+        """Release the file handles held by the ebook parser."""
+        self.meta.close()
 
     def show_metadata(self) -> Dict[str, str]:
         """
@@ -76,29 +324,64 @@ class MetadataFetcher:
         """
         return self.meta.metadata
 
+    def get_record(self) -> "BookMetadata":
+        """Retreive the typed metadata record of the ebook.
+
+        The record is built on first use unless the fetcher was created
+        with ``records=True``.
+
+        Returns
+        -------
+        BookMetadata
+            fixed fields and tuples of values, other keys under ``extra``
+        """
+        if self.meta.record is None:
+            from ebookatty.record import BookMetadata
+
+            self.meta.record = BookMetadata.from_values(self.meta.values)
+        return self.meta.record
+
 
-def fetch_metadata(path: Union[str | Path]) -> Dict[str, str]:
+def fetch_metadata(
+    path: Source,
+    cache=None,
+    format: Optional[str] = None,
+    fields: Optional[Iterable[str]] = None,
+    locator: Optional["OpfLocator"] = None,
+) -> Dict[str, str]:
     """Retreive metadata for ebook located at the supplied file path.
 
     Parameters
     ----------
-    path : Union[str | Path]
-        file path of the ebook.
+    path : Source
+        file path of the ebook, or its contents as a bytes-like object or
+        seekable binary file object.
+    cache : MetadataCache, optional
+        cache consulted before the file is parsed, see `ebookatty.cache`.
+        Only used for file paths.
+    format : Optional[str]
+        format hint, guessed from the source when omitted.
+    fields : Optional[Iterable[str]]
+        only extract these fields.  Cached metadata is always complete and
+        projected onto the fields after lookup.
+    locator : Optional[OpfLocator]
+        guess the OPF location of EPUBs, see `ebookatty.epub.OpfLocator`.
 
     Returns
     -------
     Dict[str, str]
         Ebook metadata available.
     """
-    path = Path(path)
     try:
-        if path.suffix.lower() == ".epub":
-            meta = epub.Epub(path)
-        elif path.suffix.lower() in [".azw3", "azw", "kfx", ".mobi"]:
-            meta = mobi.Kindle(path)
-        else:
-            meta = mobi.Kindle(path)
-        return meta.metadata
+        if cache is not None and isinstance(path, (str, Path)):
+            metadata = cache.fetch(path, locator)
+            if fields:
+                from ebookatty.record import project
+
+                metadata = project(metadata, fields)
+            return metadata
+        with open_ebook(path, format, fields, locator) as book:
+            return book.metadata
     except Exception:
         return None
 
@@ -117,7 +400,10 @@ def format_output(book: dict) -> str:
     str :
         Text data to output to STDOUT
     """
-    fields = standards.ALL_FIELDS
+    import shutil
+
+    from ebookatty.standards import ALL_FIELDS as fields
+
     termsize = shutil.get_terminal_size().columns
     long_tag = max([len(key) for key in book.keys()])
     tail_size = termsize - long_tag - 5
@@ -22,16 +22,36 @@ Module contains implementation specific to amazon formatted ebooks.
 
 Classes and functions for .azw, .azw3, and .kfx ebooks.
 """
-import io
+import bisect
+import mmap
 import re
 import struct
 from datetime import date
 from pathlib import Path
-
-from ebookatty.standards import EXTH_Types
+from typing import BinaryIO, Iterable, Optional, Tuple, Union
+
+from ebookatty.record import (
+    BookMetadata,
+    completion_keys,
+    is_complete,
+    join_values,
+    project,
+    source_keys,
+)
+from ebookatty.standards import EXTH_Types, mobi6_header, mobi8_header
+from ebookatty.trace import stage
 
 isoformat = date.isoformat
 
+Buffer = Union[bytes, bytearray, memoryview, mmap.mmap]
+BUFFER_TYPES = (bytes, bytearray, memoryview, mmap.mmap)
+ENGINES = ("mmap", "stream")
+
+# Metadata keys each EXTH record type can produce.  Source records (112)
+# carry an ISBN or calibre UUID instead of their own key.
+EXTH_KEYS = {idx: (name,) for idx, name in EXTH_Types.items()}
+EXTH_KEYS[112] = ("isbn", "uuid")
+
 
 class Metadata:
     """
@@ -115,44 +135,61 @@ class EXTHHeader:
     Header class for EXTH metadata fields.
     """
 
-    def __init__(self, raw: bytes, codec: str, title: str, data: Metadata):
+    def __init__(
+        self,
+        raw: Buffer,
+        codec: str,
+        title: str,
+        data: Metadata,
+        fields: Optional[Tuple[str, ...]] = None,
+    ):
         """
         Constructor for the EXTH header class.
 
         Parameters
         ----------
-        raw : bytes
-            the raw data
+        raw : Buffer
+            the raw data, records are read in place by offset
         codec : str
             the text encoding format string
         title : str
             title of the book
         data : Metadata
             metadata holder class
+        fields : Optional[Tuple[str, ...]]
+            only decode records that can fill these fields, stopping early
+            only when none of them can repeat
         """
         self._data = data
         self.codec = codec
-        self.doctype = raw[:4].decode()
-        self.length, self.num_items = struct.unpack(">LL", raw[4:12])
-        raw = raw[12:]
-        pos = 0
+        self.doctype = bytes(raw[:4]).decode()
+        self.length, self.num_items = struct.unpack_from(">LL", raw, 4)
+        pos = 12
         left = self.num_items
         self.set_data("title", title)
         self.set_data("doctype", self.doctype)
+        wanted = source_keys(fields) if fields else None
+        groups = completion_keys(fields) if fields else None
+        if groups is not None and is_complete(data.data, groups):
+            return
         while left > 0:
             left -= 1
-            idx, size = struct.unpack(">LL", raw[pos : pos + 8])
-            content = raw[pos + 8 : pos + size]
+            idx, size = struct.unpack_from(">LL", raw, pos)
+            start = pos
             pos += size
-            self.process_metadata(idx, content)
+            if wanted is not None and wanted.isdisjoint(EXTH_KEYS.get(idx, ())):
+                continue
+            self.process_metadata(idx, raw[start + 8 : pos])
+            if groups is not None and is_complete(data.data, groups):
+                break
 
-    def decode(self, content: bytes) -> str:
+    def decode(self, content: Buffer) -> str:
         """
         Decode raw bytes to string.
 
         Parameters
         ----------
-        content : bytes
+        content : Buffer
             the raw byte content to decode
 
         Returns
@@ -160,7 +197,7 @@ class EXTHHeader:
         str
             decoded bytes
         """
-        return content.decode(self.codec, "replace").strip()
+        return str(content, self.codec, "replace").strip()
 
     def set_data(self, *args) -> None:
         """
@@ -168,7 +205,7 @@ class EXTHHeader:
         """
         self._data.add_value(*args)
 
-    def process_metadata(self, idx: int, content: bytes):
+    def process_metadata(self, idx: int, content: Buffer):
         """
         Extract the appropriate metadata associated with the field.
 
@@ -176,7 +213,7 @@ class EXTHHeader:
         ----------
         idx : int
             the index of the record content
-        content : bytes
+        content : Buffer
             raw byte data of the record
         """
         if idx in EXTH_Types:
@@ -206,36 +243,129 @@ class EXTHHeader:
                     self.set_data(EXTH_Types[idx], item)
 
 
+class HeaderLayout:
+    """
+    Precompiled decoder for a record 0 field table.
+
+    The fields of a table are contiguous, so every prefix of the table is
+    decoded by a single `struct.Struct`.  One is compiled per prefix length
+    the first time a record of that size is seen.
+
+    Parameters
+    ----------
+    table : dict
+        field name mapped to its offset, struct format and size
+    """
+
+    def __init__(self, table: dict):
+        """
+        Construct the layout from a field table.
+        """
+        self.names = list(table)
+        self.codes = [fmt.lstrip("<>!=") for _, fmt, _ in table.values()]
+        self.ends = [offset + size for offset, _, size in table.values()]
+        self.structs = {}
+
+    def count(self, limit: int) -> int:
+        """
+        Return the number of leading fields that end within `limit` bytes.
+
+        Parameters
+        ----------
+        limit : int
+            number of bytes available
+
+        Returns
+        -------
+        int
+            number of complete fields
+        """
+        return bisect.bisect_right(self.ends, limit)
+
+    def unpack(self, raw: Buffer, limit: int = None) -> dict:
+        """
+        Decode every complete field of `raw` in one pass.
+
+        Parameters
+        ----------
+        raw : Buffer
+            the record to decode
+        limit : int
+            decode no further than this many bytes, defaults to the record
+
+        Returns
+        -------
+        dict
+            field names mapped to their values
+        """
+        available = len(raw) if limit is None else min(limit, len(raw))
+        count = self.count(available)
+        layout = self.structs.get(count)
+        if layout is None:
+            layout = struct.Struct(">" + "".join(self.codes[:count]))
+            self.structs[count] = layout
+        return dict(zip(self.names, layout.unpack_from(raw)))
+
+
+MOBI6_LAYOUT = HeaderLayout(mobi6_header)
+MOBI8_LAYOUT = HeaderLayout(mobi8_header)
+VERSION = struct.Struct(">L")
+LEGACY_HEADER_END = mobi6_header["exth_flags"][0] + 4
+
+
 class BookHeader:
     """
     Metadata header for the ebook.
     """
 
-    def __init__(self, raw: bytes, data: Metadata):
+    def __init__(
+        self, raw: Buffer, data: Metadata, fields: Optional[Tuple[str, ...]] = None
+    ):
         """
         Construct the metadata header.
 
+        Every field of the MOBI6 or, from version 8, MOBI8 header table is
+        decoded with a single ``unpack_from`` and the fields within the
+        declared header length are kept in `header_fields`.
+
         Parameters
         ----------
-        raw : bytes
+        raw : Buffer
             header section of the ebook
         data : Metadata
             dictionary holding the metadata
+        fields : Optional[Tuple[str, ...]]
+            only decode EXTH records that can fill these fields
         """
         self.raw = raw
-        (self.length, self.type, self.codepage, self.unique_id, self.version) = (
-            struct.unpack(">LLLLL", self.raw[20:40])
-        )
-        langcode = struct.unpack("!L", raw[0x5C:0x60])[0]
-        data.add_value("type", self.type)
-        data.add_value("doctype", self.raw[16:20].decode())
-        data.add_value("codepage", self.codepage)
-        data.add_value("unique_id", self.unique_id)
-        data.add_value("version", self.version)
-        data.add_value("langid", langcode & 0xFF)
-        data.add_value("version", (langcode >> 10) & 0xFF)
-        self.codec = self.get_codec()
-        self.title = self.get_title()
+        self.requested = fields
+        if len(raw) < LEGACY_HEADER_END:
+            raise struct.error(f"record 0 is too short for a MOBI header: {len(raw)}")
+        with stage("mobi.header") as timer:
+            (version,) = VERSION.unpack_from(raw, mobi6_header["version"][0])
+            layout = MOBI8_LAYOUT if version >= 8 else MOBI6_LAYOUT
+            values = layout.unpack(raw)
+            self.length = values["header_length"]
+            self.type = values["type"]
+            self.codepage = values["codepage"]
+            self.unique_id = values["unique_id"]
+            self.version = version
+            self.title_offset = values["title_offset"]
+            self.title_length = values["title_length"]
+            self.exth_flags = values["exth_flags"]
+            declared = layout.count(16 + self.length)
+            self.header_fields = dict(list(values.items())[:declared])
+            langcode = values["language_code"]
+            data.add_value("type", self.type)
+            data.add_value("doctype", bytes(self.raw[16:20]).decode())
+            data.add_value("codepage", self.codepage)
+            data.add_value("unique_id", self.unique_id)
+            data.add_value("version", self.version)
+            data.add_value("langid", langcode & 0xFF)
+            data.add_value("version", (langcode >> 10) & 0xFF)
+            self.codec = self.get_codec()
+            self.title = self.get_title()
+            timer.nbytes = min(16 + self.length, len(raw))
         self.exth = self.get_exth(data)
 
     def get_codec(self) -> str:
@@ -261,11 +391,11 @@ class BookHeader:
         str
             Ebook title.
         """
-        toff, tlen = struct.unpack(">II", self.raw[0x54:0x5C])
+        toff, tlen = self.title_offset, self.title_length
         tend = toff + tlen
         title = self.raw[toff:tend] if tend < len(self.raw) else "Unknown"
         if not isinstance(title, str):
-            title = title.decode(self.codec, "replace")
+            title = str(title, self.codec, "replace")
         return title
 
     def get_exth(self, data: bytes) -> Metadata:
@@ -284,11 +414,11 @@ class BookHeader:
         """
         data.add_value("title", self.title)
         data.add_value("codec", self.codec)
-        (flag,) = struct.unpack(">L", self.raw[0x80:0x84])
-        if flag & 0x40:
-            exth = EXTHHeader(
-                self.raw[16 + self.length :], self.codec, self.title, data
-            )
+        if self.exth_flags & 0x40:
+            with stage("mobi.exth") as timer:
+                raw = self.raw[16 + self.length :]
+                exth = EXTHHeader(raw, self.codec, self.title, data, self.requested)
+                timer.nbytes = exth.length
             return exth
 
 
@@ -297,24 +427,44 @@ class MetadataHeader(BookHeader):
     MetadataHeader class.
     """
 
-    def __init__(self, stream: io.BytesIO):
+    def __init__(
+        self,
+        stream: Union[BinaryIO, Buffer],
+        fields: Optional[Tuple[str, ...]] = None,
+    ):
         """
         Construct the MetadataHeader instance.
 
+        Only the PDB header, the section table entries for the first two
+        records and record 0 itself are read from the stream.  When a
+        buffer (``bytes``, ``mmap`` or ``memoryview``) is supplied instead
+        of a stream, the fields are unpacked in place and record 0 is
+        handed to the parsers as a zero-copy ``memoryview`` slice.
+
         Parameters
         ----------
-        stream : io.BytesIO
-            ebook byte stream
+        stream : Union[BinaryIO, Buffer]
+            seekable ebook byte stream or a buffer holding the ebook
+        fields : Optional[Tuple[str, ...]]
+            only decode EXTH records that can fill these fields
         """
         self.data = Metadata()
-        self.stream = stream
-        self.stream.seek(0)
-        self.ident = self.identity()
-        self.data.add_value("identity", self.ident)
-        self.num_sections = self.section_count()
-        if self.num_sections >= 2:
-            header = self.header()
-            BookHeader.__init__(self, header, self.data)
+        if isinstance(stream, BUFFER_TYPES):
+            self.stream = None
+            self.buffer = memoryview(stream)
+        else:
+            self.stream = stream
+            self.buffer = None
+            self.stream.seek(0)
+        with stage("mobi.read") as timer:
+            self.ident = self.identity()
+            self.data.add_value("identity", self.ident)
+            self.num_sections = self.section_count()
+            header = self.header() if self.num_sections >= 2 else None
+            # PDB header, two section table entries and record 0
+            timer.nbytes = 94 + len(header) if header is not None else 78
+        if header is not None:
+            BookHeader.__init__(self, header, self.data, fields)
 
     def identity(self) -> str:
         """
@@ -325,6 +475,8 @@ class MetadataHeader(BookHeader):
         str
             identity metadata field.
         """
+        if self.buffer is not None:
+            return bytes(self.buffer[60:68]).upper().decode()
         self.stream.seek(60)
         ident = self.stream.read(8).upper()
         return ident.decode()
@@ -338,6 +490,8 @@ class MetadataHeader(BookHeader):
         int
             number of sections
         """
+        if self.buffer is not None:
+            return struct.unpack_from(">H", self.buffer, 76)[0]
         self.stream.seek(76)
         return struct.unpack(">H", self.stream.read(2))[0]
 
@@ -355,16 +509,18 @@ class MetadataHeader(BookHeader):
         int
             value of next records
         """
+        if self.buffer is not None:
+            return struct.unpack_from(">L", self.buffer, 78 + number * 8)[0]
         self.stream.seek(78 + number * 8)
         return struct.unpack(">LBBBB", self.stream.read(8))[0]
 
-    def header(self) -> bytes:
+    def header(self) -> Buffer:
         """
         Return precise section of the ebook that makes the header.
 
         Returns
         -------
-        bytes
+        Buffer
             raw data for ebook header
         """
         section_headers = []
@@ -372,35 +528,141 @@ class MetadataHeader(BookHeader):
         section_headers.append(self.section_offset(1))
         end_off = section_headers[1]
         off = section_headers[0]
+        if self.buffer is not None:
+            return self.buffer[off:end_off]
         self.stream.seek(off)
         return self.stream.read(end_off - off)
 
+    def release(self) -> None:
+        """
+        Release any memoryviews held on the underlying buffer.
+
+        Must be called before the buffer (e.g. an ``mmap``) is closed.
+        """
+        for view in (getattr(self, "raw", None), self.buffer):
+            if isinstance(view, memoryview):
+                view.release()
+
 
 class Kindle:
     """Gather Epub Metadata."""
 
-    def __init__(self, path: str):
+    def __init__(
+        self,
+        path: Union[str, Path, Buffer, BinaryIO],
+        engine: str = "mmap",
+        fields: Optional[Iterable[str]] = None,
+        records: bool = False,
+    ):
         """
         Construct the EpubMeta Class Instance.
 
         Parameters
         ----------
-        path : str
-            path to ebook file.
-        """
-        self.path = Path(path)
-        self.stem = self.path.stem
-        self.suffix = self.path.suffix
-        self.data = self.path.read_bytes()
-        self.stream = io.BytesIO(self.data)
-        header = MetadataHeader(self.stream)
+        path : Union[str, Path, Buffer, BinaryIO]
+            path to ebook file, the ebook contents as a bytes-like object
+            or a seekable binary file object.
+        engine : str
+            ``"mmap"`` maps the file and parses the header in place,
+            ``"stream"`` seeks and reads only the header byte ranges.
+            Files that cannot be mapped fall back to ``"stream"``.  Only
+            used when `path` is a file path.
+        fields : Optional[Iterable[str]]
+            only extract these fields, see `ebookatty.record.project`.
+            Other EXTH records are not decoded, and reading stops early
+            when every field comes from the MOBI header.
+        records : bool
+            build the typed `record` instead of the `metadata` dictionary,
+            which is then None.
+        """
+        if engine not in ENGINES:
+            raise ValueError(f"unknown engine {engine!r}, expected one of {ENGINES}")
+        self.fields = tuple(fields) if fields else None
+        if isinstance(path, BUFFER_TYPES):
+            self.path = None
+            self.engine = "buffer"
+            header = MetadataHeader(path, self.fields)
+            header.release()
+        elif not isinstance(path, (str, Path)):
+            name = getattr(path, "name", None)
+            self.path = Path(name) if isinstance(name, str) else None
+            self.engine = "stream"
+            header = MetadataHeader(path, self.fields)
+        else:
+            self.path = Path(path)
+            self.engine = engine
+            with open(self.path, "rb") as stream:
+                header = None
+                if engine == "mmap":
+                    header = self.map_header(stream, self.fields)
+                if header is None:
+                    self.engine = "stream"
+                    header = MetadataHeader(stream, self.fields)
+        self.stem = self.path.stem if self.path else ""
+        self.suffix = self.path.suffix if self.path else ""
         metadata = header.data
-        metadata.add_value("name", self.stem)
-        metadata.add_value("filetype", self.suffix)
+        if self.path is not None:
+            metadata.add_value("name", self.stem)
+            metadata.add_value("filetype", self.suffix)
         data = metadata.data
-        for key, value in data.items():
-            value = set(value)
-            value = [str(i) for i in value]
-            value = "; ".join(value)
-            data[key] = value
-        self.metadata = data
+        self.values = data
+        self.record = None
+        self.metadata = None
+        with stage("mobi.record"):
+            if records:
+                self.record = BookMetadata.from_values(data)
+            else:
+                if self.fields:
+                    data = project(data, self.fields)
+                self.metadata = {key: join_values(value) for key, value in data.items()}
+
+    def __enter__(self):
+        """Return the instance."""
+        return self
+
+    def __exit__(self, *_):
+        """Close the instance."""
+        self.close()
+
+    def close(self) -> None:
+        """
+        Release resources held by the instance.
+
+        The file and header buffers are released as soon as the header is
+        parsed, so this only exists to share the `Epub` interface.
+        """
+
+    @staticmethod
+    def map_header(
+        stream: BinaryIO, fields: Optional[Tuple[str, ...]] = None
+    ) -> MetadataHeader:
+        """
+        Parse the header from a read-only memory map of the open file.
+
+        Parameters
+        ----------
+        stream : BinaryIO
+            the open ebook file
+        fields : Optional[Tuple[str, ...]]
+            only decode EXTH records that can fill these fields
+
+        Returns
+        -------
+        MetadataHeader
+            parsed header, or None when the file cannot be mapped
+        """
+        try:
+            mapped = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        header = None
+        try:
+            header = MetadataHeader(mapped, fields)
+        finally:
+            if header is not None:
+                header.release()
+            try:
+                mapped.close()
+            except BufferError:  # pragma: nocover
+                pass
+        return header
@@ -0,0 +1,377 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+########################################################################
+#  Copyright (C) 2021  alexpdev
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#########################################################################
+"""
+Profiling of a complete command line run, broken down by ebook format.
+
+`Profiler` keeps one `cProfile.Profile` per bucket: one per file format
+for the work done on each file, from parsing to writing its record, and
+``cli`` for everything else.  A sampling thread records the stack of the
+profiled thread, rooted at its bucket, and `tracemalloc` attributes the
+memory each bucket allocated and kept, with allocation sites taken from
+the first files of each bucket.  `Profiler.report` writes::
+
+    total.pstats          every bucket combined
+    <bucket>.pstats       one per bucket, e.g. epub.pstats
+    stacks.collapsed      sampled stacks for flamegraph.pl or speedscope
+    memory.txt            retained and peak memory, top allocation sites
+"""
+
+import cProfile
+import linecache
+import pstats
+import sys
+import threading
+import tracemalloc
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Generator, Iterable, List, Optional, Union
+
+DEFAULT_BUCKET = "cli"
+
+# Allocations made by the profiler itself are left out of the reports.
+IGNORED_FILES = frozenset((tracemalloc.__file__, __file__))
+
+
+def file_format(path: str) -> str:
+    """
+    Return the bucket name of an ebook, its format sniffed from the content.
+
+    Parameters
+    ----------
+    path : str
+        path to the ebook file
+
+    Returns
+    -------
+    str
+        ``"epub"`` or ``"mobi"``, ``"unknown"`` for unreadable files and
+        unsupported content
+    """
+    from ebookatty.metadata import guess_format
+
+    try:
+        return guess_format(path)
+    except (OSError, ValueError):
+        return "unknown"
+
+
+def frame_stack(frame) -> List[str]:
+    """
+    Describe the stack of `frame`, outermost call first.
+
+    Parameters
+    ----------
+    frame : FrameType
+        the innermost frame
+
+    Returns
+    -------
+    List[str]
+        ``module:function`` for every frame of the stack
+    """
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{Path(code.co_filename).stem}:{code.co_name}")
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+class StackSampler(threading.Thread):
+    """
+    Thread sampling the stack of another thread at a fixed interval.
+
+    Parameters
+    ----------
+    profiler : Profiler
+        supplies the bucket each sample is rooted at
+    thread_id : int
+        identifier of the sampled thread
+    interval : float
+        seconds between samples
+    """
+
+    def __init__(self, profiler: "Profiler", thread_id: int, interval: float):
+        """
+        Construct the sampler thread.
+        """
+        super().__init__(name="ebookatty-sampler", daemon=True)
+        self.profiler = profiler
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        """Sample until `stop` is called."""
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                stack = [self.profiler.bucket, *frame_stack(frame)]
+                self.samples[";".join(stack)] += 1
+            del frame
+
+    def stop(self):
+        """Stop sampling and wait for the thread to finish."""
+        self.stopped.set()
+        self.join()
+
+
+class Profiler:
+    """
+    Profile a run in the calling thread, one bucket per ebook format.
+
+    Work is attributed to ``cli`` until `switch` or `track` moves it to
+    another bucket.  Only the calling thread is profiled, so extraction
+    has to run in it rather than in worker pools.
+
+    Parameters
+    ----------
+    directory : Union[str, Path]
+        directory the reports are written to, created if missing
+    interval : float
+        seconds between stack samples
+    top : int
+        allocation sites listed per bucket in ``memory.txt``
+    sampled : int
+        times each bucket is entered with a `tracemalloc` snapshot for its
+        allocation sites.  Snapshots are expensive, so later visits only
+        record the retained and peak memory.
+    """
+
+    def __init__(
+        self,
+        directory: Union[str, Path],
+        interval: float = 0.001,
+        top: int = 25,
+        sampled: int = 8,
+    ):
+        """
+        Construct the profiler.
+        """
+        self.directory = Path(directory)
+        self.interval = interval
+        self.top = top
+        self.sampled = sampled
+        self.bucket = DEFAULT_BUCKET
+        self.profiles: Dict[str, cProfile.Profile] = {}
+        self.files: Counter = Counter()
+        self.visits: Counter = Counter()
+        self.allocated: Dict[str, Counter] = {}
+        self.retained: Counter = Counter()
+        self.peaks: Dict[str, int] = {}
+        self.traced = 0
+        self.snapshot = None
+        self.sampler = None
+        self.started_tracemalloc = False
+
+    def __enter__(self):
+        """Start profiling."""
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        """Stop profiling and write the reports."""
+        self.stop()
+        self.report()
+
+    def start(self) -> None:
+        """
+        Start the profile, allocation tracing and stack sampling.
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+        self.enter(self.bucket)
+        self.sampler = StackSampler(self, threading.get_ident(), self.interval)
+        self.sampler.start()
+        self.profile(self.bucket).enable()
+
+    def stop(self) -> None:
+        """
+        Stop every collector, attributing the remaining work to its bucket.
+        """
+        self.profile(self.bucket).disable()
+        self.account()
+        self.sampler.stop()
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+            self.started_tracemalloc = False
+
+    def profile(self, bucket: str) -> cProfile.Profile:
+        """
+        Return the profile of a bucket, creating it on first use.
+
+        Parameters
+        ----------
+        bucket : str
+            bucket name
+
+        Returns
+        -------
+        cProfile.Profile
+            the bucket's profile
+        """
+        if bucket not in self.profiles:
+            self.profiles[bucket] = cProfile.Profile()
+        return self.profiles[bucket]
+
+    def enter(self, bucket: str) -> None:
+        """
+        Start measuring the memory of a bucket that becomes active.
+
+        Only the first `sampled` visits of each bucket take a snapshot.
+
+        Parameters
+        ----------
+        bucket : str
+            bucket name
+        """
+        self.snapshot = None
+        if self.visits[bucket] < self.sampled:
+            self.snapshot = tracemalloc.take_snapshot()
+        self.visits[bucket] += 1
+        tracemalloc.reset_peak()
+        self.traced = tracemalloc.get_traced_memory()[0]
+
+    def account(self) -> None:
+        """
+        Attribute the memory allocated since the bucket became active to it.
+        """
+        current, peak = tracemalloc.get_traced_memory()
+        self.peaks[self.bucket] = max(self.peaks.get(self.bucket, 0), peak)
+        self.retained[self.bucket] += current - self.traced
+        sites = self.allocated.setdefault(self.bucket, Counter())
+        if self.snapshot is not None:
+            snapshot = tracemalloc.take_snapshot()
+            for stat in snapshot.compare_to(self.snapshot, "lineno"):
+                frame = stat.traceback[0]
+                if stat.size_diff > 0 and frame.filename not in IGNORED_FILES:
+                    sites[frame] += stat.size_diff
+            self.snapshot = None
+
+    def switch(self, bucket: Optional[str]) -> None:
+        """
+        Attribute the following work to `bucket`.
+
+        Parameters
+        ----------
+        bucket : Optional[str]
+            bucket name, None for ``cli``
+        """
+        bucket = bucket or DEFAULT_BUCKET
+        if bucket == self.bucket:
+            return
+        self.profile(self.bucket).disable()
+        self.account()
+        self.bucket = bucket
+        self.enter(bucket)
+        self.profile(bucket).enable()
+
+    def track(self, paths: Iterable[str]) -> Generator:
+        """
+        Attribute the work done on each path to the bucket of its format.
+
+        Paths must be consumed in the profiled thread, one at a time, as
+        `ebookatty.batch.iter_extract` does with a single worker.  The
+        work done between two paths, including writing the record of the
+        earlier one, counts towards the format of the earlier path.
+
+        Parameters
+        ----------
+        paths : Iterable[str]
+            ebook paths
+
+        Yields
+        ------
+        Generator[str]
+            each path, unchanged
+        """
+        for path in paths:
+            bucket = file_format(path)
+            self.files[bucket] += 1
+            self.switch(bucket)
+            yield path
+        self.switch(None)
+
+    def report(self) -> List[Path]:
+        """
+        Write every report to the output directory.
+
+        Returns
+        -------
+        List[Path]
+            the files written
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        written = []
+        total = None
+        for bucket, profile in self.profiles.items():
+            path = self.directory / f"{bucket}.pstats"
+            profile.dump_stats(path)
+            written.append(path)
+            if total is None:
+                total = pstats.Stats(profile)
+            else:
+                total.add(profile)
+        path = self.directory / "total.pstats"
+        total.dump_stats(path)
+        written.append(path)
+        path = self.directory / "stacks.collapsed"
+        with open(path, "wt", encoding="utf-8") as fd:
+            for stack, count in sorted(self.sampler.samples.items()):
+                fd.write(f"{stack} {count}\n")
+        written.append(path)
+        path = self.directory / "memory.txt"
+        with open(path, "wt", encoding="utf-8") as fd:
+            fd.write(self.format_memory())
+        written.append(path)
+        return written
+
+    def format_memory(self) -> str:
+        """
+        Render the peak memory and top allocation sites of every bucket.
+
+        Returns
+        -------
+        str
+            one section per bucket
+        """
+        lines = [
+            "Retained: net bytes allocated while each bucket was active.  Sites: "
+            f"bytes still live when the bucket ended, from its first {self.sampled} "
+            "visits.  Peaks are of all traced memory.",
+            "",
+        ]
+        for bucket, sites in self.allocated.items():
+            files = self.files.get(bucket, 0)
+            lines.append(
+                f"[{bucket}] files: {files}  "
+                f"retained: {self.retained[bucket] / 1024:.1f} KiB  "
+                f"peak: {self.peaks.get(bucket, 0) / 1024:.1f} KiB"
+            )
+            for frame, size in sites.most_common(self.top):
+                source = linecache.getline(frame.filename, frame.lineno).strip()
+                lines.append(
+                    f"{size / 1024:10.1f} KiB  {frame.filename}:{frame.lineno}  {source}"
+                )
+            lines.append("")
+        return "\n".join(lines)
@@ -0,0 +1,431 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+########################################################################
+#  Copyright (C) 2021  alexpdev
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#########################################################################
+"""Compact, format independent metadata record shared by the parsers."""
+
+import sys
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple, Union
+
+from ebookatty.standards import FIELD_ALIASES, SINGLE_VALUED_FIELDS
+
+# Record fields holding a single value, mapped to the source keys they are
+# read from in order of preference.  MOBI files use EXTH names, EPUB files
+# use Dublin Core element names.
+SCALAR_FIELDS = {
+    "title": ("title", "updatedtitle"),
+    "isbn": ("isbn",),
+    "publisher": ("publisher",),
+    "language": ("language",),
+    "description": ("description",),
+    "published": ("published", "date", "pubdate"),
+    "rights": ("rights",),
+    "asin": ("asin",),
+}
+
+# Record fields holding every distinct value of their source keys.
+MULTI_FIELDS = {
+    "authors": ("author", "creator"),
+    "contributors": ("contributor",),
+    "subjects": ("subject",),
+    "identifiers": ("identifier", "uuid"),
+}
+
+# Fields whose values repeat across a library, stored as interned strings
+# so every record of the same author, publisher or subject shares them.
+SHARED_FIELDS = frozenset(
+    ("publisher", "language", "rights", *MULTI_FIELDS.keys())
+) - {"identifiers"}
+
+# Key tuples of the `extra` mapping, shared by every record with the same
+# set of keys.  Books of one format carry the same keys, so this stays small.
+KEY_LAYOUTS = {}
+MAX_KEY_LAYOUTS = 4096
+
+SOURCE_KEYS = frozenset(
+    key for keys in (*SCALAR_FIELDS.values(), *MULTI_FIELDS.values()) for key in keys
+)
+
+
+def unique(values: Iterable) -> Tuple[str, ...]:
+    """
+    Return the distinct values as strings, in first-seen order.
+
+    Parameters
+    ----------
+    values : Iterable
+        raw values, possibly repeated
+
+    Returns
+    -------
+    Tuple[str, ...]
+        the distinct values
+    """
+    return tuple(dict.fromkeys(str(value) for value in values))
+
+
+def shared(values: Iterable) -> Tuple[str, ...]:
+    """
+    Return the distinct values as interned strings, in first-seen order.
+
+    Parameters
+    ----------
+    values : Iterable
+        raw values, possibly repeated
+
+    Returns
+    -------
+    Tuple[str, ...]
+        the distinct values
+    """
+    return tuple(sys.intern(value) for value in unique(values))
+
+
+def compact(values: Iterable) -> Union[str, Tuple[str, ...]]:
+    """
+    Return the distinct values, a single value as a plain string.
+
+    Parameters
+    ----------
+    values : Iterable
+        raw values, possibly repeated
+
+    Returns
+    -------
+    Union[str, Tuple[str, ...]]
+        the interned value, or a tuple of interned values
+    """
+    found = shared(values)
+    return found[0] if len(found) == 1 else found
+
+
+def reintern(value):
+    """
+    Intern a string, or every string of a tuple of values.
+
+    Parameters
+    ----------
+    value : Union[None, str, Tuple]
+        a record value
+
+    Returns
+    -------
+    Union[None, str, Tuple]
+        an equal value made of interned strings
+    """
+    if isinstance(value, str):
+        return sys.intern(value)
+    if isinstance(value, tuple):
+        return tuple(reintern(item) for item in value)
+    return value
+
+
+def source_keys(fields: Iterable[str]) -> FrozenSet[str]:
+    """
+    Return every parser key that can fill one of the requested fields.
+
+    Parameters
+    ----------
+    fields : Iterable[str]
+        requested field names
+
+    Returns
+    -------
+    FrozenSet[str]
+        the field names and all of their aliases
+    """
+    return frozenset(
+        key for field in fields for key in FIELD_ALIASES.get(field, (field,))
+    )
+
+
+def completion_keys(fields: Iterable[str]) -> Optional[Tuple[Tuple[str, ...], ...]]:
+    """
+    Return the key groups that must be found before parsing can stop.
+
+    Parameters
+    ----------
+    fields : Iterable[str]
+        requested field names
+
+    Returns
+    -------
+    Optional[Tuple[Tuple[str, ...], ...]]
+        the aliases of each field, or None unless every key is one of
+        `SINGLE_VALUED_FIELDS`, in which case the whole document has to be
+        read so that repeated values are not missed
+    """
+    groups = tuple(FIELD_ALIASES.get(field, (field,)) for field in fields)
+    if any(key not in SINGLE_VALUED_FIELDS for keys in groups for key in keys):
+        return None
+    return groups
+
+
+def is_complete(found: Dict, groups: Tuple[Tuple[str, ...], ...]) -> bool:
+    """
+    Return True once every group has at least one key with a value.
+
+    Parameters
+    ----------
+    found : Dict
+        keys that already have a value
+    groups : Tuple[Tuple[str, ...], ...]
+        output of `completion_keys`
+
+    Returns
+    -------
+    bool
+        True when parsing can stop
+    """
+    return all(any(key in found for key in keys) for keys in groups)
+
+
+def project(values: Dict, fields: Iterable[str]) -> Dict:
+    """
+    Keep only the requested fields, filling each from its first alias found.
+
+    Parameters
+    ----------
+    values : Dict
+        parser keys mapped to their values
+    fields : Iterable[str]
+        requested field names, in output order
+
+    Returns
+    -------
+    Dict
+        requested field names mapped to their values, missing ones omitted
+    """
+    projected = {}
+    for field in fields:
+        for key in FIELD_ALIASES.get(field, (field,)):
+            if values.get(key):
+                projected[field] = values[key]
+                break
+    return projected
+
+
+def key_layout(keys: Tuple[str, ...]) -> Tuple[str, ...]:
+    """
+    Return the shared instance of a tuple of `extra` keys.
+
+    Parameters
+    ----------
+    keys : Tuple[str, ...]
+        the keys in insertion order
+
+    Returns
+    -------
+    Tuple[str, ...]
+        an equal tuple, shared between records where possible
+    """
+    layout = KEY_LAYOUTS.get(keys)
+    if layout is None:
+        layout = tuple(sys.intern(key) for key in keys)
+        if len(KEY_LAYOUTS) < MAX_KEY_LAYOUTS:
+            KEY_LAYOUTS[layout] = layout
+    return layout
+
+
+def join_values(values: Iterable) -> str:
+    """
+    Join the distinct values in first-seen order, as used by legacy dicts.
+
+    Parameters
+    ----------
+    values : Iterable
+        raw values, possibly repeated
+
+    Returns
+    -------
+    str
+        the values separated by ``"; "``
+    """
+    return "; ".join(unique(values))
+
+
+class BookMetadata:
+    """
+    Typed metadata record of one ebook.
+
+    Common fields are stored in slots and multi-valued fields as tuples.
+    Every other key found in the ebook is available from the `extra`
+    mapping, stored as a values tuple alongside a key tuple shared by all
+    records with the same keys.  Values that repeat across a library are
+    interned, so a record takes less memory than the equivalent metadata
+    dictionary even though multi-valued fields are not joined.
+
+    Parameters
+    ----------
+    title : Optional[str]
+        book title
+    authors : Tuple[str, ...]
+        authors or creators in document order
+    isbn : Optional[str]
+        ISBN as found in the book
+    publisher : Optional[str]
+        publisher name
+    language : Optional[str]
+        language as declared by the book
+    description : Optional[str]
+        description or blurb
+    subjects : Tuple[str, ...]
+        subject headings
+    published : Optional[str]
+        publication date as found in the book
+    rights : Optional[str]
+        copyright statement
+    identifiers : Tuple[str, ...]
+        other identifiers such as UUIDs
+    asin : Optional[str]
+        Amazon identifier
+    contributors : Tuple[str, ...]
+        contributors other than the authors
+    extra : Optional[Dict[str, Union[str, Tuple[str, ...]]]]
+        any other keys mapped to their value, or a tuple of their distinct
+        values when there is more than one
+    """
+
+    __slots__ = (*SCALAR_FIELDS, *MULTI_FIELDS, "extra_keys", "extra_values")
+
+    FIELDS = (*SCALAR_FIELDS, *MULTI_FIELDS)
+
+    def __init__(
+        self,
+        title: Optional[str] = None,
+        authors: Tuple[str, ...] = (),
+        isbn: Optional[str] = None,
+        publisher: Optional[str] = None,
+        language: Optional[str] = None,
+        description: Optional[str] = None,
+        subjects: Tuple[str, ...] = (),
+        published: Optional[str] = None,
+        rights: Optional[str] = None,
+        identifiers: Tuple[str, ...] = (),
+        asin: Optional[str] = None,
+        contributors: Tuple[str, ...] = (),
+        extra: Optional[Dict[str, Union[str, Tuple[str, ...]]]] = None,
+    ):
+        """
+        Construct the record.
+        """
+        self.title = title
+        self.authors = tuple(authors)
+        self.isbn = isbn
+        self.publisher = publisher
+        self.language = language
+        self.description = description
+        self.subjects = tuple(subjects)
+        self.published = published
+        self.rights = rights
+        self.identifiers = tuple(identifiers)
+        self.asin = asin
+        self.contributors = tuple(contributors)
+        extra = extra or {}
+        self.extra_keys = key_layout(tuple(extra))
+        self.extra_values = tuple(extra.values())
+
+    @property
+    def extra(self) -> Dict[str, Union[str, Tuple[str, ...]]]:
+        """Keys without a dedicated field, mapped to their values."""
+        return dict(zip(self.extra_keys, self.extra_values))
+
+    @classmethod
+    def from_values(cls, values: Dict[str, List]) -> "BookMetadata":
+        """
+        Build a record from parser output of keys mapped to value lists.
+
+        Parameters
+        ----------
+        values : Dict[str, List]
+            metadata keys mapped to every value found for them
+
+        Returns
+        -------
+        BookMetadata
+            the record
+        """
+        fields = {}
+        for field, keys in SCALAR_FIELDS.items():
+            for key in keys:
+                if values.get(key):
+                    value = str(values[key][0])
+                    if field in SHARED_FIELDS:
+                        value = sys.intern(value)
+                    fields[field] = value
+                    break
+        for field, keys in MULTI_FIELDS.items():
+            found = [value for key in keys for value in values.get(key, ())]
+            if found:
+                fields[field] = shared(found) if field in SHARED_FIELDS else unique(found)
+        fields["extra"] = {
+            key: compact(value)
+            for key, value in values.items()
+            if key not in SOURCE_KEYS and value
+        }
+        return cls(**fields)
+
+    def as_dict(self) -> Dict:
+        """
+        Return the record as a dictionary, omitting empty fields.
+
+        Returns
+        -------
+        Dict
+            field names mapped to their values, `extra` merged in
+        """
+        data = {}
+        for field in self.FIELDS:
+            value = getattr(self, field)
+            if value:
+                data[field] = value
+        for key, value in zip(self.extra_keys, self.extra_values):
+            data.setdefault(key, value)
+        return data
+
+    def __eq__(self, other) -> bool:
+        """Compare all fields of two records."""
+        if not isinstance(other, BookMetadata):
+            return NotImplemented
+        return self.__getstate__() == other.__getstate__()
+
+    def __repr__(self) -> str:
+        """Show the populated fields."""
+        fields = ", ".join(
+            f"{field}={getattr(self, field)!r}"
+            for field in self.FIELDS
+            if getattr(self, field)
+        )
+        return f"BookMetadata({fields})"
+
+    def __getstate__(self) -> tuple:
+        """Return the field values for pickling."""
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+    def __setstate__(self, state: tuple):
+        """
+        Restore the field values after unpickling.
+
+        Unpickled strings are never interned, so shared values are interned
+        again and records sent back from worker processes keep sharing them.
+        """
+        for field, value in zip(self.__slots__, state):
+            if field in SHARED_FIELDS or field == "extra_values":
+                value = reintern(value)
+            setattr(self, field, value)
+        self.extra_keys = key_layout(self.extra_keys)
@@ -0,0 +1,864 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+########################################################################
+#  Copyright (C) 2021  alexpdev
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#########################################################################
+"""
+Long running metadata extraction service over HTTP.
+
+The service keeps a warm worker pool and a shared `MetadataCache`, so a
+request costs a round trip instead of an interpreter start.  It listens
+on a localhost TCP port or on a Unix domain socket and answers:
+
+``GET /health``
+    pool size and the number of requests in flight.
+``POST /metadata`` with ``{"paths": [...], "fields": [...]}``
+    one result per path, in order, parsed across the pool in chunks.
+``POST /metadata?format=epub&fields=title,author`` with the raw ebook
+    the result for the ebook sent as the request body.
+
+Every result is ``{"path", "metadata", "error"}`` with exactly one of
+``metadata`` and ``error`` set.
+"""
+
+import concurrent.futures
+import json
+import os
+import signal
+import socket
+import socketserver
+import stat
+import sys
+import threading
+from contextlib import contextmanager
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+from urllib.parse import parse_qs, urlsplit
+
+from ebookatty.batch import EXECUTORS, BatchResult, chunked, extract_chunk
+from ebookatty.cache import MetadataCache
+from ebookatty.metadata import MetadataFetcher
+
+# Bodies are read while a request slot is held, so at most `max_requests`
+# of them are in memory at once.
+MAX_BODY_SIZE = 32 << 20
+MAX_CHUNK_SIZE = 16
+
+# Seconds a kept alive connection may sit idle before it is closed.
+IDLE_TIMEOUT = 30
+
+LOOPBACK_NAMES = ("localhost",)
+
+
+class ServiceBusy(Exception):
+    """Raised when no request slot frees up within the queue timeout."""
+
+
+def ignore_interrupts() -> None:
+    """
+    Leave SIGINT to the server process, run in each worker process.
+
+    A Ctrl+C reaches the whole process group, the server then shuts the
+    pool down after answering the requests in progress.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def warm_worker() -> int:
+    """
+    Import both parsers so the first request does not pay for it.
+
+    Returns
+    -------
+    int
+        the worker's process id
+    """
+    import ebookatty.epub  # noqa: F401
+    import ebookatty.mobi  # noqa: F401
+
+    return os.getpid()
+
+
+def extract_bytes(
+    data: bytes,
+    format: Optional[str] = None,
+    fields: Optional[Tuple[str, ...]] = None,
+) -> BatchResult:
+    """
+    Extract metadata from an ebook held in memory, capturing any failure.
+
+    Parameters
+    ----------
+    data : bytes
+        the ebook contents
+    format : Optional[str]
+        format hint, guessed from the contents when omitted
+    fields : Optional[Tuple[str, ...]]
+        only extract these fields
+
+    Returns
+    -------
+    BatchResult
+        the metadata or a description of the error, without a path
+    """
+    try:
+        with MetadataFetcher(data, format, fields) as fetcher:
+            return BatchResult(None, fetcher.get_metadata(), None)
+    except Exception as err:
+        return BatchResult(None, None, f"{type(err).__name__}: {err}")
+
+
+class MetadataService:
+    """
+    Worker pool, cache and concurrency limit shared by every request.
+
+    Parameters
+    ----------
+    workers : Optional[int]
+        number of workers, defaults to the number of CPUs
+    executor : str
+        ``"process"`` or ``"thread"``
+    cache : Optional[MetadataCache]
+        cache consulted before a path is sent to the pool
+    max_requests : Optional[int]
+        requests handled at once, defaults to four per worker.  Others
+        wait for a slot up to `queue_timeout` seconds.
+    queue_timeout : float
+        seconds a request may wait for a slot before it is refused
+    """
+
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        executor: str = "process",
+        cache: Optional[MetadataCache] = None,
+        max_requests: Optional[int] = None,
+        queue_timeout: float = 30.0,
+    ):
+        """
+        Construct the service and start its workers.
+        """
+        if executor not in EXECUTORS:
+            raise ValueError(
+                f"unknown executor {executor!r}, expected one of {list(EXECUTORS)}"
+            )
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = executor
+        self.cache = cache
+        self.max_requests = max_requests or self.workers * 4
+        self.queue_timeout = queue_timeout
+        self.slots = threading.BoundedSemaphore(self.max_requests)
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        pool_class = getattr(concurrent.futures, EXECUTORS[executor])
+        if executor == "process":
+            self.pool = pool_class(self.workers, initializer=ignore_interrupts)
+        else:
+            self.pool = pool_class(self.workers)
+        self.warm()
+
+    def warm(self) -> None:
+        """
+        Start every worker and import the parsers in it.
+        """
+        futures = [self.pool.submit(warm_worker) for _ in range(self.workers)]
+        for future in futures:
+            future.result()
+
+    @contextmanager
+    def slot(self):
+        """
+        Hold one of the `max_requests` request slots.
+
+        Raises
+        ------
+        ServiceBusy
+            if no slot frees up within `queue_timeout` seconds
+        """
+        if not self.slots.acquire(timeout=self.queue_timeout):
+            raise ServiceBusy(f"{self.max_requests} requests already in progress")
+        with self.lock:
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+            self.slots.release()
+
+    def status(self) -> Dict:
+        """
+        Describe the service for the health endpoint.
+
+        Returns
+        -------
+        Dict
+            pool settings and current load
+        """
+        status = {
+            "status": "ok",
+            "workers": self.workers,
+            "executor": self.executor,
+            "max_requests": self.max_requests,
+            "in_flight": self.in_flight,
+            "cache": self.cache is not None,
+        }
+        if self.cache is not None:
+            status["cache_hits"] = self.cache.hits
+            status["cache_misses"] = self.cache.misses
+        return status
+
+    def lookup(self, path: str) -> Optional[BatchResult]:
+        """
+        Answer a path from the cache without involving the pool.
+
+        Parameters
+        ----------
+        path : str
+            path to the ebook file
+
+        Returns
+        -------
+        Optional[BatchResult]
+            the cached result, None on a miss or without a cache
+        """
+        if self.cache is None:
+            return None
+        try:
+            metadata = self.cache.get(path)
+        except OSError as err:
+            return BatchResult(path, None, f"{type(err).__name__}: {err}")
+        if metadata is None:
+            return None
+        return BatchResult(path, metadata, None)
+
+    def extract_paths(
+        self, paths: List[str], fields: Optional[Iterable[str]] = None
+    ) -> List[BatchResult]:
+        """
+        Extract the metadata of a batch of files.
+
+        Cached files are answered at once, the rest are split into one
+        chunk per worker, up to `MAX_CHUNK_SIZE` paths each, and parsed
+        in parallel.
+
+        Parameters
+        ----------
+        paths : List[str]
+            paths to the ebook files
+        fields : Optional[Iterable[str]]
+            only extract these fields, all of them when omitted
+
+        Returns
+        -------
+        List[BatchResult]
+            one result per path, in order
+        """
+        from ebookatty.record import project
+
+        fields = tuple(fields) if fields else None
+        results = [self.lookup(path) for path in paths]
+        if fields:
+            results = [
+                result._replace(metadata=project(result.metadata, fields))
+                if result is not None and result.metadata is not None
+                else result
+                for result in results
+            ]
+        missing = [i for i, result in enumerate(results) if result is None]
+        size = min(MAX_CHUNK_SIZE, max(1, -(-len(missing) // self.workers)))
+        pending = []
+        for chunk in chunked(missing, size):
+            batch = [paths[i] for i in chunk]
+            future = self.pool.submit(extract_chunk, batch, self.cache, fields)
+            pending.append((chunk, future))
+        for chunk, future in pending:
+            for i, result in zip(chunk, future.result()):
+                results[i] = result
+        return results
+
+    def extract_data(
+        self,
+        data: bytes,
+        format: Optional[str] = None,
+        fields: Optional[Iterable[str]] = None,
+    ) -> BatchResult:
+        """
+        Extract the metadata of an ebook sent in a request.
+
+        Parameters
+        ----------
+        data : bytes
+            the ebook contents
+        format : Optional[str]
+            format hint, guessed from the contents when omitted
+        fields : Optional[Iterable[str]]
+            only extract these fields, all of them when omitted
+
+        Returns
+        -------
+        BatchResult
+            the metadata or a description of the error
+        """
+        fields = tuple(fields) if fields else None
+        return self.pool.submit(extract_bytes, data, format, fields).result()
+
+    def close(self) -> None:
+        """
+        Wait for running work to finish and stop the workers.
+        """
+        self.pool.shutdown(wait=True)
+
+
+def result_json(result: BatchResult) -> Dict:
+    """
+    Convert a result to its JSON representation.
+
+    Parameters
+    ----------
+    result : BatchResult
+        the extraction result
+
+    Returns
+    -------
+    Dict
+        the path, metadata and error of the result
+    """
+    return {"path": result.path, "metadata": result.metadata, "error": result.error}
+
+
+def split_fields(value) -> Optional[List[str]]:
+    """
+    Normalize a fields parameter given as a list or comma separated text.
+
+    Parameters
+    ----------
+    value : Union[str, List[str], None]
+        the parameter value
+
+    Returns
+    -------
+    Optional[List[str]]
+        the non empty field names, None when there are none
+    """
+    if isinstance(value, str):
+        value = value.split(",")
+    fields = [str(field).strip() for field in value or () if str(field).strip()]
+    return fields or None
+
+
+class BadRequest(Exception):
+    """Raised for requests the service cannot interpret."""
+
+
+class MetadataHandler(BaseHTTPRequestHandler):
+    """
+    HTTP handler of the metadata endpoints.
+
+    Connections are kept alive between requests, so a client can send
+    every upload through one connection.  A connection left idle for
+    `IDLE_TIMEOUT` seconds, or while the server shuts down, is closed.
+    """
+
+    protocol_version = "HTTP/1.1"
+    server_version = "ebookatty"
+    timeout = IDLE_TIMEOUT
+
+    def handle_one_request(self):
+        """Wait for the next request unless the server is shutting down."""
+        if not self.server.mark_idle(self.connection):
+            self.close_connection = True
+            return
+        super().handle_one_request()
+
+    def parse_request(self) -> bool:
+        """
+        Parse the request headers, the connection is busy from here on.
+
+        On TCP servers a request whose ``Host`` is not a loopback name or
+        address is refused with 421, so a web page cannot reach the service
+        through DNS rebinding.
+
+        Returns
+        -------
+        bool
+            True if the request should be answered
+        """
+        self.server.mark_busy(self.connection)
+        if not super().parse_request():
+            return False
+        if self.server.checks_host and not is_loopback(request_host(self.headers)):
+            self.close_connection = True
+            self.send_json(
+                HTTPStatus.MISDIRECTED_REQUEST,
+                {"error": "the Host header must name a loopback interface"},
+            )
+            return False
+        return True
+
+    def address_string(self) -> str:
+        """Return the client address, or the socket path for Unix sockets."""
+        if isinstance(self.client_address, tuple) and self.client_address:
+            return str(self.client_address[0])
+        return str(self.server.server_address)
+
+    def log_message(self, format: str, *args) -> None:
+        """Log requests to stderr unless the server is quiet."""
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+    def send_json(self, status: HTTPStatus, payload: Dict, headers: Dict = None):
+        """
+        Send a JSON response.
+
+        Parameters
+        ----------
+        status : HTTPStatus
+            response status
+        payload : Dict
+            the response body
+        headers : Dict
+            extra response headers
+        """
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        """Answer the health endpoint."""
+        if urlsplit(self.path).path != "/health":
+            self.send_json(HTTPStatus.NOT_FOUND, {"error": "not found"})
+            return
+        self.send_json(HTTPStatus.OK, self.server.service.status())
+
+    def content_length(self) -> int:
+        """
+        Return the declared size of the request body.
+
+        Returns
+        -------
+        int
+            the ``Content-Length``, 0 when it is missing
+
+        Raises
+        ------
+        BadRequest
+            if the length is not a non-negative integer or the body is
+            sent with a transfer encoding
+        """
+        if self.headers.get("Transfer-Encoding"):
+            raise BadRequest("request bodies must be sent with a Content-Length")
+        value = (self.headers.get("Content-Length") or "0").strip()
+        if not value.isdigit():
+            raise BadRequest(f"invalid Content-Length: {value!r}")
+        return int(value)
+
+    def do_POST(self):
+        """
+        Answer the metadata endpoint.
+
+        The request slot is taken before the body is read, so the slots
+        also bound the memory held by request bodies.  Whenever a body is
+        left unread the connection is closed after the response.
+        """
+        url = urlsplit(self.path)
+        if url.path != "/metadata":
+            self.close_connection = True
+            self.send_json(HTTPStatus.NOT_FOUND, {"error": "not found"})
+            return
+        try:
+            length = self.content_length()
+        except BadRequest as err:
+            self.close_connection = True
+            self.send_json(HTTPStatus.BAD_REQUEST, {"error": str(err)})
+            return
+        if length > MAX_BODY_SIZE:
+            self.close_connection = True
+            self.send_json(
+                HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                {"error": f"request bodies are limited to {MAX_BODY_SIZE} bytes"},
+            )
+            return
+        query = parse_qs(url.query)
+        try:
+            with self.server.service.slot():
+                body = self.rfile.read(length)
+                if self.headers.get_content_type() == "application/json":
+                    status, payload = self.handle_paths(body)
+                else:
+                    status, payload = self.handle_data(body, query)
+        except BadRequest as err:
+            self.send_json(HTTPStatus.BAD_REQUEST, {"error": str(err)})
+        except ServiceBusy as err:
+            self.close_connection = True
+            self.send_json(
+                HTTPStatus.SERVICE_UNAVAILABLE, {"error": str(err)}, {"Retry-After": "1"}
+            )
+        else:
+            self.send_json(status, payload)
+
+    def handle_paths(self, body: bytes) -> Tuple[HTTPStatus, Dict]:
+        """
+        Extract the files listed in a JSON request.
+
+        Parameters
+        ----------
+        body : bytes
+            ``{"paths": [...], "fields": [...]}``, ``"path"`` is accepted
+            for a single file
+
+        Returns
+        -------
+        Tuple[HTTPStatus, Dict]
+            the status and ``{"results": [...]}``
+
+        Raises
+        ------
+        BadRequest
+            if the body is not a valid request
+        """
+        try:
+            request = json.loads(body)
+        except ValueError as err:
+            raise BadRequest(f"invalid JSON: {err}") from err
+        if not isinstance(request, dict):
+            raise BadRequest("expected a JSON object")
+        paths = request.get("paths")
+        if paths is None and "path" in request:
+            paths = [request["path"]]
+        if not isinstance(paths, list) or not all(isinstance(p, str) for p in paths):
+            raise BadRequest("'paths' must be a list of file paths")
+        fields = split_fields(request.get("fields"))
+        results = self.server.service.extract_paths(paths, fields)
+        return HTTPStatus.OK, {"results": [result_json(r) for r in results]}
+
+    def handle_data(self, body: bytes, query: Dict) -> Tuple[HTTPStatus, Dict]:
+        """
+        Extract the ebook sent as the request body.
+
+        Parameters
+        ----------
+        body : bytes
+            the ebook contents
+        query : Dict
+            parsed query string, may hold ``format`` and ``fields``
+
+        Returns
+        -------
+        Tuple[HTTPStatus, Dict]
+            200 and the result, or 422 when the ebook could not be parsed
+        """
+        if not body:
+            raise BadRequest("empty request body")
+        format = query.get("format", [None])[0]
+        fields = split_fields(query.get("fields", [None])[0])
+        result = self.server.service.extract_data(body, format, fields)
+        status = HTTPStatus.OK if result.error is None else HTTPStatus.UNPROCESSABLE_ENTITY
+        return status, result_json(result)
+
+
+class ServiceMixin:
+    """
+    Server settings shared by the TCP and Unix socket servers.
+
+    Request threads are joined on close, so requests in progress are
+    answered before the server shuts down.  Connections waiting for their
+    next request are shut down instead, so idle keep-alive clients do not
+    hold the server open.
+    """
+
+    daemon_threads = False
+    block_on_close = True
+    checks_host = False
+
+    def setup_service(self, service: MetadataService, quiet: bool) -> None:
+        """
+        Attach the service the handlers use.
+
+        Parameters
+        ----------
+        service : MetadataService
+            the shared service
+        quiet : bool
+            do not log requests
+        """
+        self.service = service
+        self.quiet = quiet
+        self.closing = False
+        self.idle = {}
+        self.idle_lock = threading.Lock()
+
+    def mark_idle(self, connection: socket.socket) -> bool:
+        """
+        Record that a connection is waiting for its next request.
+
+        Parameters
+        ----------
+        connection : socket.socket
+            the client connection
+
+        Returns
+        -------
+        bool
+            False once the server is closing, the connection must close
+        """
+        with self.idle_lock:
+            if self.closing:
+                return False
+            self.idle[connection] = True
+            return True
+
+    def mark_busy(self, connection: socket.socket) -> None:
+        """
+        Record that a connection has started a request.
+
+        Parameters
+        ----------
+        connection : socket.socket
+            the client connection
+        """
+        with self.idle_lock:
+            self.idle[connection] = False
+
+    def shutdown_request(self, request: socket.socket) -> None:
+        """Forget a finished connection and close it."""
+        with self.idle_lock:
+            self.idle.pop(request, None)
+        super().shutdown_request(request)
+
+    def server_close(self) -> None:
+        """
+        Shut down idle connections, then wait for the busy ones.
+        """
+        with self.idle_lock:
+            self.closing = True
+            idle = [conn for conn, waiting in self.idle.items() if waiting]
+        for connection in idle:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        super().server_close()
+
+    def url(self) -> str:
+        """Return the address clients connect to, for display."""
+        if isinstance(self.server_address, tuple):
+            host, port = self.server_address[:2]
+            return f"http://{host}:{port}"
+        return f"unix:{self.server_address}"
+
+
+def is_loopback(host: str) -> bool:
+    """
+    Check that a host name or address only refers to loopback interfaces.
+
+    Parameters
+    ----------
+    host : str
+        host name or IP address
+
+    Returns
+    -------
+    bool
+        True for ``localhost`` and loopback addresses such as 127.0.0.1
+    """
+    import ipaddress
+
+    if host.lower() in LOOPBACK_NAMES:
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def request_host(headers) -> str:
+    """
+    Return the host name a request is addressed to.
+
+    Parameters
+    ----------
+    headers : email.message.Message
+        the request headers
+
+    Returns
+    -------
+    str
+        the ``Host`` header without its port, empty if missing or invalid
+    """
+    try:
+        return urlsplit("//" + headers.get("Host", "").strip()).hostname or ""
+    except ValueError:
+        return ""
+
+
+class MetadataServer(ServiceMixin, ThreadingHTTPServer):
+    """
+    Metadata service listening on a loopback TCP port.
+
+    The service is unauthenticated and reads any path it is sent, so it
+    refuses to listen on other interfaces and to answer requests addressed
+    to other hosts.
+
+    Parameters
+    ----------
+    address : Tuple[str, int]
+        loopback host and port, port 0 picks a free one
+    service : MetadataService
+        the shared service
+    quiet : bool
+        do not log requests
+    """
+
+    checks_host = True
+
+    def __init__(
+        self, address: Tuple[str, int], service: MetadataService, quiet: bool = False
+    ):
+        """
+        Construct the server and bind its port.
+
+        Raises
+        ------
+        ValueError
+            if the host is not a loopback interface
+        """
+        if not is_loopback(address[0]):
+            raise ValueError(
+                f"refusing to listen on {address[0]}, only loopback interfaces "
+                "or a Unix socket are allowed"
+            )
+        if ":" in address[0]:
+            self.address_family = socket.AF_INET6
+        self.setup_service(service, quiet)
+        super().__init__(address, MetadataHandler)
+
+
+class UnixMetadataServer(ServiceMixin, socketserver.ThreadingUnixStreamServer):
+    """
+    Metadata service listening on a Unix domain socket.
+
+    A stale socket file left by a previous run is replaced, the socket
+    file is removed when the server is closed.
+
+    Parameters
+    ----------
+    path : Union[str, Path]
+        path of the socket file
+    service : MetadataService
+        the shared service
+    quiet : bool
+        do not log requests
+    """
+
+    def __init__(
+        self, path: Union[str, Path], service: MetadataService, quiet: bool = False
+    ):
+        """
+        Construct the server and bind its socket.
+        """
+        self.setup_service(service, quiet)
+        path = str(path)
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except OSError:
+                os.unlink(path)
+            else:
+                raise OSError(f"another server is listening on {path}")
+            finally:
+                probe.close()
+        super().__init__(path, MetadataHandler)
+
+    def server_close(self) -> None:
+        """Close the socket and remove its file."""
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+def make_server(
+    service: MetadataService,
+    host: str = "127.0.0.1",
+    port: int = 8080,
+    socket_path: Optional[Union[str, Path]] = None,
+    quiet: bool = False,
+) -> Union[MetadataServer, UnixMetadataServer]:
+    """
+    Create a server for the service, bound but not yet serving.
+
+    Parameters
+    ----------
+    service : MetadataService
+        the shared service
+    host : str
+        loopback interface to listen on
+    port : int
+        TCP port, 0 picks a free one
+    socket_path : Optional[Union[str, Path]]
+        listen on this Unix domain socket instead of a TCP port
+    quiet : bool
+        do not log requests
+
+    Returns
+    -------
+    Union[MetadataServer, UnixMetadataServer]
+        the server
+
+    Raises
+    ------
+    ValueError
+        if `host` is not a loopback interface
+    """
+    if socket_path is not None:
+        return UnixMetadataServer(socket_path, service, quiet)
+    return MetadataServer((host, port), service, quiet)
+
+
+def serve(server: Union[MetadataServer, UnixMetadataServer]) -> None:
+    """
+    Serve requests until SIGTERM or SIGINT is received.
+
+    On either signal the server stops accepting connections, answers the
+    requests in progress and closes its socket.  Must be called from the
+    main thread.
+
+    Parameters
+    ----------
+    server : Union[MetadataServer, UnixMetadataServer]
+        a server from `make_server`
+    """
+
+    def stop(signum, _):
+        print(f"received {signal.Signals(signum).name}, shutting down", file=sys.stderr)
+        threading.Thread(target=server.shutdown).start()
+
+    handlers = {sig: signal.signal(sig, stop) for sig in (signal.SIGTERM, signal.SIGINT)}
+    try:
+        server.serve_forever()
+    finally:
+        for sig, handler in handlers.items():
+            signal.signal(sig, handler)
+        server.server_close()
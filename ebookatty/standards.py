@@ -19,189 +19,193 @@
 ##############################################################################
 """Standards, encodings and mappings used for metadata translating."""
 
-"""palmdoc_header = {
-    "compression_type": (0x00, b">H", 2),
-    "fill0": (0x02, b">H", 2),
-    "text_length": (0x04, b">L", 4),
-    "text_records": (0x08, b">H", 2),
-    "max_section_size": (0x0A, b">H", 2),
-    "read_pos   ": (0x0C, b">L", 4),
+# Record 0 layouts of PalmDOC and MOBI files: field name mapped to its
+# offset from the start of the record, struct format and size in bytes.
+# The MOBI header proper starts at 0x10 and only extends as far as its
+# declared ``header_length``.
+palmdoc_header = {
+    "compression_type": (0x00, ">H", 2),
+    "fill0": (0x02, ">H", 2),
+    "text_length": (0x04, ">L", 4),
+    "text_records": (0x08, ">H", 2),
+    "max_section_size": (0x0A, ">H", 2),
+    "read_pos": (0x0C, ">L", 4),
 }
 
 mobi6_header = {
-    "compression_type": (0x00, b">H", 2),
-    "fill0": (0x02, b">H", 2),
-    "text_length": (0x04, b">L", 4),
-    "text_records": (0x08, b">H", 2),
-    "max_section_size": (0x0A, b">H", 2),
-    "crypto_type": (0x0C, b">H", 2),
-    "fill1": (0x0E, b">H", 2),
-    "magic": (0x10, b"4s", 4),
-    "header_length (from MOBI)": (0x14, b">L", 4),
-    "type": (0x18, b">L", 4),
-    "codepage": (0x1C, b">L", 4),
-    "unique_id": (0x20, b">L", 4),
-    "version": (0x24, b">L", 4),
-    "metaorthindex": (0x28, b">L", 4),
-    "metainflindex": (0x2C, b">L", 4),
-    "index_names": (0x30, b">L", 4),
-    "index_keys": (0x34, b">L", 4),
-    "extra_index0": (0x38, b">L", 4),
-    "extra_index1": (0x3C, b">L", 4),
-    "extra_index2": (0x40, b">L", 4),
-    "extra_index3": (0x44, b">L", 4),
-    "extra_index4": (0x48, b">L", 4),
-    "extra_index5": (0x4C, b">L", 4),
-    "first_nontext": (0x50, b">L", 4),
-    "title_offset": (0x54, b">L", 4),
-    "title_length": (0x58, b">L", 4),
-    "language_code": (0x5C, b">L", 4),
-    "dict_in_lang": (0x60, b">L", 4),
-    "dict_out_lang": (0x64, b">L", 4),
-    "min_version": (0x68, b">L", 4),
-    "first_resc_offset": (0x6C, b">L", 4),
-    "huff_offset": (0x70, b">L", 4),
-    "huff_num": (0x74, b">L", 4),
-    "huff_tbl_offset": (0x78, b">L", 4),
-    "huff_tbl_len": (0x7C, b">L", 4),
-    "exth_flags": (0x80, b">L", 4),
-    "fill3_a": (0x84, b">L", 4),
-    "fill3_b": (0x88, b">L", 4),
-    "fill3_c": (0x8C, b">L", 4),
-    "fill3_d": (0x90, b">L", 4),
-    "fill3_e": (0x94, b">L", 4),
-    "fill3_f": (0x98, b">L", 4),
-    "fill3_g": (0x9C, b">L", 4),
-    "fill3_h": (0xA0, b">L", 4),
-    "unknown0": (0xA4, b">L", 4),
-    "drm_offset": (0xA8, b">L", 4),
-    "drm_count": (0xAC, b">L", 4),
-    "drm_size": (0xB0, b">L", 4),
-    "drm_flags": (0xB4, b">L", 4),
-    "fill4_a": (0xB8, b">L", 4),
-    "fill4_b": (0xBC, b">L", 4),
-    "first_content": (0xC0, b">H", 2),
-    "last_content": (0xC2, b">H", 2),
-    "unknown0": (0xC4, b">L", 4),
-    "fcis_offset": (0xC8, b">L", 4),
-    "fcis_count": (0xCC, b">L", 4),
-    "flis_offset": (0xD0, b">L", 4),
-    "flis_count": (0xD4, b">L", 4),
-    "unknown1": (0xD8, b">L", 4),
-    "unknown2": (0xDC, b">L", 4),
-    "srcs_offset": (0xE0, b">L", 4),
-    "srcs_count": (0xE4, b">L", 4),
-    "unknown3": (0xE8, b">L", 4),
-    "unknown4": (0xEC, b">L", 4),
-    "fill5": (0xF0, b">H", 2),
-    "traildata_flags": (0xF2, b">H", 2),
-    "ncx_index": (0xF4, b">L", 4),
-    "unknown5": (0xF8, b">L", 4),
-    "unknown6": (0xFC, b">L", 4),
-    "datp_offset": (0x100, b">L", 4),
-    "unknown7": (0x104, b">L", 4),
-    "Unknown8": (0x108, b">L", 4),
-    "Unknown9": (0x10C, b">L", 4),
-    "Unknown10": (0x110, b">L", 4),
-    "Unknown11": (0x114, b">L", 4),
-    "Unknown12": (0x118, b">L", 4),
-    "Unknown13": (0x11C, b">L", 4),
-    "Unknown14": (0x120, b">L", 4),
-    "Unknown15": (0x124, b">L", 4),
-    "Unknown16": (0x128, b">L", 4),
-    "Unknown17": (0x12C, b">L", 4),
-    "Unknown18": (0x130, b">L", 4),
-    "Unknown19": (0x134, b">L", 4),
-    "Unknown20": (0x138, b">L", 4),
-    "Unknown21": (0x11C, b">L", 4),
+    "compression_type": (0x00, ">H", 2),
+    "fill0": (0x02, ">H", 2),
+    "text_length": (0x04, ">L", 4),
+    "text_records": (0x08, ">H", 2),
+    "max_section_size": (0x0A, ">H", 2),
+    "crypto_type": (0x0C, ">H", 2),
+    "fill1": (0x0E, ">H", 2),
+    "magic": (0x10, "4s", 4),
+    "header_length": (0x14, ">L", 4),
+    "type": (0x18, ">L", 4),
+    "codepage": (0x1C, ">L", 4),
+    "unique_id": (0x20, ">L", 4),
+    "version": (0x24, ">L", 4),
+    "metaorthindex": (0x28, ">L", 4),
+    "metainflindex": (0x2C, ">L", 4),
+    "index_names": (0x30, ">L", 4),
+    "index_keys": (0x34, ">L", 4),
+    "extra_index0": (0x38, ">L", 4),
+    "extra_index1": (0x3C, ">L", 4),
+    "extra_index2": (0x40, ">L", 4),
+    "extra_index3": (0x44, ">L", 4),
+    "extra_index4": (0x48, ">L", 4),
+    "extra_index5": (0x4C, ">L", 4),
+    "first_nontext": (0x50, ">L", 4),
+    "title_offset": (0x54, ">L", 4),
+    "title_length": (0x58, ">L", 4),
+    "language_code": (0x5C, ">L", 4),
+    "dict_in_lang": (0x60, ">L", 4),
+    "dict_out_lang": (0x64, ">L", 4),
+    "min_version": (0x68, ">L", 4),
+    "first_resc_offset": (0x6C, ">L", 4),
+    "huff_offset": (0x70, ">L", 4),
+    "huff_num": (0x74, ">L", 4),
+    "huff_tbl_offset": (0x78, ">L", 4),
+    "huff_tbl_len": (0x7C, ">L", 4),
+    "exth_flags": (0x80, ">L", 4),
+    "fill3_a": (0x84, ">L", 4),
+    "fill3_b": (0x88, ">L", 4),
+    "fill3_c": (0x8C, ">L", 4),
+    "fill3_d": (0x90, ">L", 4),
+    "fill3_e": (0x94, ">L", 4),
+    "fill3_f": (0x98, ">L", 4),
+    "fill3_g": (0x9C, ">L", 4),
+    "fill3_h": (0xA0, ">L", 4),
+    "unknown0": (0xA4, ">L", 4),
+    "drm_offset": (0xA8, ">L", 4),
+    "drm_count": (0xAC, ">L", 4),
+    "drm_size": (0xB0, ">L", 4),
+    "drm_flags": (0xB4, ">L", 4),
+    "fill4_a": (0xB8, ">L", 4),
+    "fill4_b": (0xBC, ">L", 4),
+    "first_content": (0xC0, ">H", 2),
+    "last_content": (0xC2, ">H", 2),
+    "unknown0b": (0xC4, ">L", 4),
+    "fcis_offset": (0xC8, ">L", 4),
+    "fcis_count": (0xCC, ">L", 4),
+    "flis_offset": (0xD0, ">L", 4),
+    "flis_count": (0xD4, ">L", 4),
+    "unknown1": (0xD8, ">L", 4),
+    "unknown2": (0xDC, ">L", 4),
+    "srcs_offset": (0xE0, ">L", 4),
+    "srcs_count": (0xE4, ">L", 4),
+    "unknown3": (0xE8, ">L", 4),
+    "unknown4": (0xEC, ">L", 4),
+    "fill5": (0xF0, ">H", 2),
+    "traildata_flags": (0xF2, ">H", 2),
+    "ncx_index": (0xF4, ">L", 4),
+    "unknown5": (0xF8, ">L", 4),
+    "unknown6": (0xFC, ">L", 4),
+    "datp_offset": (0x100, ">L", 4),
+    "unknown7": (0x104, ">L", 4),
+    "Unknown8": (0x108, ">L", 4),
+    "Unknown9": (0x10C, ">L", 4),
+    "Unknown10": (0x110, ">L", 4),
+    "Unknown11": (0x114, ">L", 4),
+    "Unknown12": (0x118, ">L", 4),
+    "Unknown13": (0x11C, ">L", 4),
+    "Unknown14": (0x120, ">L", 4),
+    "Unknown15": (0x124, ">L", 4),
+    "Unknown16": (0x128, ">L", 4),
+    "Unknown17": (0x12C, ">L", 4),
+    "Unknown18": (0x130, ">L", 4),
+    "Unknown19": (0x134, ">L", 4),
+    "Unknown20": (0x138, ">L", 4),
+    "Unknown21": (0x13C, ">L", 4),
 }
 
 mobi8_header = {
-    "compression_type": (0x00, b">H", 2),
-    "fill0": (0x02, b">H", 2),
-    "text_length": (0x04, b">L", 4),
-    "text_records": (0x08, b">H", 2),
-    "max_section_size": (0x0A, b">H", 2),
-    "crypto_type": (0x0C, b">H", 2),
-    "fill1": (0x0E, b">H", 2),
-    "magic": (0x10, b"4s", 4),
-    "header_length (from MOBI)": (0x14, b">L", 4),
-    "type": (0x18, b">L", 4),
-    "codepage": (0x1C, b">L", 4),
-    "unique_id": (0x20, b">L", 4),
-    "version": (0x24, b">L", 4),
-    "metaorthindex": (0x28, b">L", 4),
-    "metainflindex": (0x2C, b">L", 4),
-    "index_names": (0x30, b">L", 4),
-    "index_keys": (0x34, b">L", 4),
-    "extra_index0": (0x38, b">L", 4),
-    "extra_index1": (0x3C, b">L", 4),
-    "extra_index2": (0x40, b">L", 4),
-    "extra_index3": (0x44, b">L", 4),
-    "extra_index4": (0x48, b">L", 4),
-    "extra_index5": (0x4C, b">L", 4),
-    "first_nontext": (0x50, b">L", 4),
-    "title_offset": (0x54, b">L", 4),
-    "title_length": (0x58, b">L", 4),
-    "language_code": (0x5C, b">L", 4),
-    "dict_in_lang": (0x60, b">L", 4),
-    "dict_out_lang": (0x64, b">L", 4),
-    "min_version": (0x68, b">L", 4),
-    "first_resc_offset": (0x6C, b">L", 4),
-    "huff_offset": (0x70, b">L", 4),
-    "huff_num": (0x74, b">L", 4),
-    "huff_tbl_offset": (0x78, b">L", 4),
-    "huff_tbl_len": (0x7C, b">L", 4),
-    "exth_flags": (0x80, b">L", 4),
-    "fill3_a": (0x84, b">L", 4),
-    "fill3_b": (0x88, b">L", 4),
-    "fill3_c": (0x8C, b">L", 4),
-    "fill3_d": (0x90, b">L", 4),
-    "fill3_e": (0x94, b">L", 4),
-    "fill3_f": (0x98, b">L", 4),
-    "fill3_g": (0x9C, b">L", 4),
-    "fill3_h": (0xA0, b">L", 4),
-    "unknown0": (0xA4, b">L", 4),
-    "drm_offset": (0xA8, b">L", 4),
-    "drm_count": (0xAC, b">L", 4),
-    "drm_size": (0xB0, b">L", 4),
-    "drm_flags": (0xB4, b">L", 4),
-    "fill4_a": (0xB8, b">L", 4),
-    "fill4_b": (0xBC, b">L", 4),
-    "fdst_offset": (0xC0, b">L", 4),
-    "fdst_flow_count": (0xC4, b">L", 4),
-    "fcis_offset": (0xC8, b">L", 4),
-    "fcis_count": (0xCC, b">L", 4),
-    "flis_offset": (0xD0, b">L", 4),
-    "flis_count": (0xD4, b">L", 4),
-    "unknown1": (0xD8, b">L", 4),
-    "unknown2": (0xDC, b">L", 4),
-    "srcs_offset": (0xE0, b">L", 4),
-    "srcs_count": (0xE4, b">L", 4),
-    "unknown3": (0xE8, b">L", 4),
-    "unknown4": (0xEC, b">L", 4),
-    "fill5": (0xF0, b">H", 2),
-    "traildata_flags": (0xF2, b">H", 2),
-    "ncx_index": (0xF4, b">L", 4),
-    "fragment_index": (0xF8, b">L", 4),
-    "skeleton_index": (0xFC, b">L", 4),
-    "datp_offset": (0x100, b">L", 4),
-    "guide_index": (0x104, b">L", 4),
-    "Unknown5": (0x108, b">L", 4),
-    "Unknown6": (0x10C, b">L", 4),
-    "Unknown7": (0x110, b">L", 4),
-    "Unknown8": (0x114, b">L", 4),
-    "Unknown9": (0x118, b">L", 4),
-    "Unknown10": (0x11C, b">L", 4),
-    "Unknown11": (0x120, b">L", 4),
-    "Unknown12": (0x124, b">L", 4),
-    "Unknown13": (0x128, b">L", 4),
-    "Unknown14": (0x12C, b">L", 4),
-    "Unknown15": (0x130, b">L", 4),
-    "Unknown16": (0x134, b">L", 4),
-    "Unknown17": (0x138, b">L", 4),
-    "Unknown18": (0x11C, b">L", 4),
-}"""
+    "compression_type": (0x00, ">H", 2),
+    "fill0": (0x02, ">H", 2),
+    "text_length": (0x04, ">L", 4),
+    "text_records": (0x08, ">H", 2),
+    "max_section_size": (0x0A, ">H", 2),
+    "crypto_type": (0x0C, ">H", 2),
+    "fill1": (0x0E, ">H", 2),
+    "magic": (0x10, "4s", 4),
+    "header_length": (0x14, ">L", 4),
+    "type": (0x18, ">L", 4),
+    "codepage": (0x1C, ">L", 4),
+    "unique_id": (0x20, ">L", 4),
+    "version": (0x24, ">L", 4),
+    "metaorthindex": (0x28, ">L", 4),
+    "metainflindex": (0x2C, ">L", 4),
+    "index_names": (0x30, ">L", 4),
+    "index_keys": (0x34, ">L", 4),
+    "extra_index0": (0x38, ">L", 4),
+    "extra_index1": (0x3C, ">L", 4),
+    "extra_index2": (0x40, ">L", 4),
+    "extra_index3": (0x44, ">L", 4),
+    "extra_index4": (0x48, ">L", 4),
+    "extra_index5": (0x4C, ">L", 4),
+    "first_nontext": (0x50, ">L", 4),
+    "title_offset": (0x54, ">L", 4),
+    "title_length": (0x58, ">L", 4),
+    "language_code": (0x5C, ">L", 4),
+    "dict_in_lang": (0x60, ">L", 4),
+    "dict_out_lang": (0x64, ">L", 4),
+    "min_version": (0x68, ">L", 4),
+    "first_resc_offset": (0x6C, ">L", 4),
+    "huff_offset": (0x70, ">L", 4),
+    "huff_num": (0x74, ">L", 4),
+    "huff_tbl_offset": (0x78, ">L", 4),
+    "huff_tbl_len": (0x7C, ">L", 4),
+    "exth_flags": (0x80, ">L", 4),
+    "fill3_a": (0x84, ">L", 4),
+    "fill3_b": (0x88, ">L", 4),
+    "fill3_c": (0x8C, ">L", 4),
+    "fill3_d": (0x90, ">L", 4),
+    "fill3_e": (0x94, ">L", 4),
+    "fill3_f": (0x98, ">L", 4),
+    "fill3_g": (0x9C, ">L", 4),
+    "fill3_h": (0xA0, ">L", 4),
+    "unknown0": (0xA4, ">L", 4),
+    "drm_offset": (0xA8, ">L", 4),
+    "drm_count": (0xAC, ">L", 4),
+    "drm_size": (0xB0, ">L", 4),
+    "drm_flags": (0xB4, ">L", 4),
+    "fill4_a": (0xB8, ">L", 4),
+    "fill4_b": (0xBC, ">L", 4),
+    "fdst_offset": (0xC0, ">L", 4),
+    "fdst_flow_count": (0xC4, ">L", 4),
+    "fcis_offset": (0xC8, ">L", 4),
+    "fcis_count": (0xCC, ">L", 4),
+    "flis_offset": (0xD0, ">L", 4),
+    "flis_count": (0xD4, ">L", 4),
+    "unknown1": (0xD8, ">L", 4),
+    "unknown2": (0xDC, ">L", 4),
+    "srcs_offset": (0xE0, ">L", 4),
+    "srcs_count": (0xE4, ">L", 4),
+    "unknown3": (0xE8, ">L", 4),
+    "unknown4": (0xEC, ">L", 4),
+    "fill5": (0xF0, ">H", 2),
+    "traildata_flags": (0xF2, ">H", 2),
+    "ncx_index": (0xF4, ">L", 4),
+    "fragment_index": (0xF8, ">L", 4),
+    "skeleton_index": (0xFC, ">L", 4),
+    "datp_offset": (0x100, ">L", 4),
+    "guide_index": (0x104, ">L", 4),
+    "Unknown5": (0x108, ">L", 4),
+    "Unknown6": (0x10C, ">L", 4),
+    "Unknown7": (0x110, ">L", 4),
+    "Unknown8": (0x114, ">L", 4),
+    "Unknown9": (0x118, ">L", 4),
+    "Unknown10": (0x11C, ">L", 4),
+    "Unknown11": (0x120, ">L", 4),
+    "Unknown12": (0x124, ">L", 4),
+    "Unknown13": (0x128, ">L", 4),
+    "Unknown14": (0x12C, ">L", 4),
+    "Unknown15": (0x130, ">L", 4),
+    "Unknown16": (0x134, ">L", 4),
+    "Unknown17": (0x138, ">L", 4),
+    "Unknown18": (0x13C, ">L", 4),
+}
 
 id_map_strings = {
     1: "Drm Server Id",
@@ -498,6 +502,52 @@ PUBLICATION_METADATA_FIELDS = [
     "thumbnail",
 ]
 
+# Default CSV columns: the publication fields the parsers actually emit,
+# in a fixed order so every export has the same header.
+CSV_COLUMNS = [
+    "title",
+    "author",
+    "creator",
+    "contributor",
+    "publisher",
+    "published",
+    "date",
+    "language",
+    "isbn",
+    "asin",
+    "identifier",
+    "uuid",
+    "subject",
+    "description",
+    "rights",
+    "name",
+    "filetype",
+    "identity",
+    "doctype",
+    "type",
+    "codec",
+    "codepage",
+    "langid",
+    "unique_id",
+    "version",
+]
+
+# Requested field names mapped to the keys they are filled from, in order
+# of preference.  MOBI files use EXTH names, EPUB files Dublin Core names.
+FIELD_ALIASES = {
+    "author": ("author", "creator"),
+    "creator": ("creator", "author"),
+    "published": ("published", "date", "pubdate"),
+    "date": ("date", "published", "pubdate"),
+    "pubdate": ("pubdate", "published", "date"),
+    "title": ("title", "updatedtitle"),
+}
+
+# Keys a parser fills exactly once, from a fixed field of the MOBI header.
+# OPF elements and EXTH records may all repeat, so parsing only stops early
+# when every requested key is one of these.
+SINGLE_VALUED_FIELDS = frozenset(("codec", "codepage", "unique_id", "langid"))
+
 BOOK_STRUCTURE_FIELDS = [
     "toc",
     "spine",
@@ -0,0 +1,528 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+########################################################################
+#  Copyright (C) 2021  alexpdev
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#########################################################################
+"""
+Synthetic ebook generator for scale and load testing.
+
+Writes valid EPUB containers and PDB/MOBI files with configurable metadata
+sizes, including pathological shapes such as huge OPF manifests, thousands
+of EXTH records and deeply nested XML.  Run with ``python -m ebookatty.synth``.
+"""
+
+import argparse
+import random
+import struct
+import uuid
+import zipfile
+from pathlib import Path
+from typing import Generator, List, Optional, Sequence, Union
+from xml.sax.saxutils import escape
+
+WORDS = (
+    "river stone light garden winter harbor silver ember quiet north "
+    "letter machine orchard signal paper lantern meadow iron forest tide"
+).split()
+
+CONTAINER_XML = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<container version="1.0" '
+    'xmlns="urn:oasis:names:tc:opendocument:xmlns:container">\n'
+    "  <rootfiles>\n"
+    '    <rootfile full-path="{opf}" media-type="application/oebps-package+xml"/>\n'
+    "  </rootfiles>\n"
+    "</container>\n"
+)
+
+CHAPTER_XHTML = (
+    '<?xml version="1.0" encoding="utf-8"?>\n'
+    '<html xmlns="http://www.w3.org/1999/xhtml"><head><title>{title}</title>'
+    "</head><body><p>{text}</p></body></html>\n"
+)
+
+PROFILES = {
+    "typical": {},
+    "huge-opf": {"manifest_items": 20000, "subjects": 500, "description_size": 20000},
+    "many-exth": {"exth_records": 5000},
+    "deep-xml": {"nesting": 5000},
+    "cp1252": {"codepage": 1252},
+}
+
+DEFAULTS = {
+    "authors": 2,
+    "subjects": 5,
+    "description_size": 400,
+    "manifest_items": 10,
+    "nesting": 0,
+    "exth_records": 0,
+    "record_size": 4096,
+    "text_records": 4,
+    "codepage": 65001,
+}
+
+MOBI_HEADER_LENGTHS = {6: 232, 8: 264}
+
+CODECS = {1252: "cp1252", 65001: "utf-8"}
+
+
+def words(rng: random.Random, count: int) -> str:
+    """
+    Return `count` random words joined by spaces.
+
+    Parameters
+    ----------
+    rng : random.Random
+        random source
+    count : int
+        number of words
+
+    Returns
+    -------
+    str
+        the text
+    """
+    return " ".join(rng.choice(WORDS) for _ in range(count))
+
+
+def book_metadata(
+    rng: random.Random,
+    authors: int = 2,
+    subjects: int = 5,
+    description_size: int = 400,
+    codepage: int = 65001,
+    **_,
+) -> dict:
+    """
+    Generate the descriptive metadata for one synthetic book.
+
+    Parameters
+    ----------
+    rng : random.Random
+        random source
+    authors : int
+        number of authors
+    subjects : int
+        number of subjects
+    description_size : int
+        approximate length of the description in characters
+    codepage : int
+        1252 restricts the text to characters cp1252 can encode
+
+    Returns
+    -------
+    dict
+        title, authors, subjects, description, publisher, isbn, date and
+        language of the book
+    """
+    accent = "é" if codepage == 1252 else "ē"
+    return {
+        "title": words(rng, 3).title() + " " + accent,
+        "authors": [words(rng, 2).title() for _ in range(authors)],
+        "subjects": [f"{words(rng, 2)} {i}" for i in range(subjects)],
+        "description": words(rng, max(1, description_size // 6))[:description_size],
+        "publisher": words(rng, 2).title() + " Press",
+        "isbn": "978" + "".join(str(rng.randrange(10)) for _ in range(10)),
+        "date": f"{rng.randrange(1900, 2024)}-0{rng.randrange(1, 10)}-1{rng.randrange(10)}",
+        "language": "en",
+    }
+
+
+def build_opf(
+    meta: dict, manifest_items: int = 10, nesting: int = 0, **_
+) -> bytes:
+    """
+    Build an OPF package document.
+
+    Parameters
+    ----------
+    meta : dict
+        output of `book_metadata`
+    manifest_items : int
+        number of manifest and spine entries
+    nesting : int
+        depth of nested elements added to the metadata section
+
+    Returns
+    -------
+    bytes
+        the encoded OPF document
+    """
+    parts = [
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<package xmlns="http://www.idpf.org/2007/opf" version="2.0" '
+        'unique-identifier="uid">\n'
+        '  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/" '
+        'xmlns:opf="http://www.idpf.org/2007/opf">\n',
+        f"    <dc:title>{escape(meta['title'])}</dc:title>\n",
+    ]
+    for author in meta["authors"]:
+        parts.append(f'    <dc:creator opf:role="aut">{escape(author)}</dc:creator>\n')
+    for subject in meta["subjects"]:
+        parts.append(f"    <dc:subject>{escape(subject)}</dc:subject>\n")
+    parts.extend(
+        [
+            f"    <dc:description>{escape(meta['description'])}</dc:description>\n",
+            f"    <dc:publisher>{escape(meta['publisher'])}</dc:publisher>\n",
+            f"    <dc:date>{meta['date']}</dc:date>\n",
+            f"    <dc:language>{meta['language']}</dc:language>\n",
+            f'    <dc:identifier id="uid">urn:uuid:{meta["uuid"]}</dc:identifier>\n',
+            f'    <dc:identifier opf:scheme="ISBN">{meta["isbn"]}</dc:identifier>\n',
+            "    " + "<nest>" * nesting + "</nest>" * nesting + "\n",
+            "  </metadata>\n  <manifest>\n",
+        ]
+    )
+    for i in range(manifest_items):
+        parts.append(
+            f'    <item id="c{i}" href="text/c{i}.xhtml" '
+            'media-type="application/xhtml+xml"/>\n'
+        )
+    parts.append("  </manifest>\n  <spine>\n")
+    for i in range(manifest_items):
+        parts.append(f'    <itemref idref="c{i}"/>\n')
+    parts.append("  </spine>\n</package>\n")
+    return "".join(parts).encode("utf-8")
+
+
+def write_epub(
+    path: Union[str, Path], rng: random.Random, meta: Optional[dict] = None, **spec
+) -> dict:
+    """
+    Write a synthetic EPUB container.
+
+    Parameters
+    ----------
+    path : Union[str, Path]
+        output file path
+    rng : random.Random
+        random source
+    meta : Optional[dict]
+        metadata to embed, generated from `spec` when omitted
+    **spec
+        overrides for `DEFAULTS`
+
+    Returns
+    -------
+    dict
+        the embedded metadata
+    """
+    spec = {**DEFAULTS, **spec}
+    meta = meta or book_metadata(rng, **spec)
+    meta.setdefault("uuid", str(uuid.UUID(int=rng.getrandbits(128))))
+    opf = "OEBPS/content.opf"
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr(
+            zipfile.ZipInfo("mimetype"), "application/epub+zip", zipfile.ZIP_STORED
+        )
+        archive.writestr("META-INF/container.xml", CONTAINER_XML.format(opf=opf))
+        archive.writestr(opf, build_opf(meta, **spec))
+        for i in range(spec["manifest_items"]):
+            text = CHAPTER_XHTML.format(title=f"Chapter {i}", text=words(rng, 40))
+            archive.writestr(f"OEBPS/text/c{i}.xhtml", text)
+    return meta
+
+
+def exth_block(meta: dict, codec: str, exth_records: int = 0) -> bytes:
+    """
+    Build the EXTH header for a MOBI record 0.
+
+    Parameters
+    ----------
+    meta : dict
+        output of `book_metadata`
+    codec : str
+        text encoding of the records
+    exth_records : int
+        minimum number of records, extra subject records are added to
+        reach it
+
+    Returns
+    -------
+    bytes
+        the EXTH header padded to a multiple of four bytes
+    """
+    items = [(100, author) for author in meta["authors"]]
+    items += [
+        (101, meta["publisher"]),
+        (103, meta["description"]),
+        (104, meta["isbn"]),
+        (106, meta["date"]),
+        (524, meta["language"]),
+    ]
+    items += [(105, subject) for subject in meta["subjects"]]
+    for i in range(exth_records - len(items)):
+        items.append((105, f"filler subject {i}"))
+    records = b""
+    for idx, text in items:
+        data = text.encode(codec, "replace")
+        records += struct.pack(">LL", idx, 8 + len(data)) + data
+    header = b"EXTH" + struct.pack(">LL", 12 + len(records), len(items))
+    block = header + records
+    return block + b"\0" * (-len(block) % 4)
+
+
+def build_record0(
+    meta: dict,
+    version: int,
+    codepage: int,
+    text_length: int,
+    text_records: int,
+    record_size: int,
+    exth_records: int = 0,
+) -> bytes:
+    """
+    Build record 0 holding the PalmDOC, MOBI and EXTH headers and the title.
+
+    Parameters
+    ----------
+    meta : dict
+        output of `book_metadata`
+    version : int
+        MOBI format version, 6 or 8
+    codepage : int
+        1252 or 65001
+    text_length : int
+        total uncompressed text length
+    text_records : int
+        number of text records
+    record_size : int
+        maximum text record size
+    exth_records : int
+        minimum number of EXTH records
+
+    Returns
+    -------
+    bytes
+        the record
+    """
+    codec = CODECS[codepage]
+    length = MOBI_HEADER_LENGTHS[version]
+    exth = exth_block(meta, codec, exth_records)
+    title = meta["title"].encode(codec, "replace")
+    palmdoc = struct.pack(
+        ">HHLHHHH", 1, 0, text_length, text_records, record_size, 0, 0
+    )
+    mobi = bytearray(length)
+    mobi[0:4] = b"MOBI"
+
+    def put(offset, fmt, value):
+        struct.pack_into(fmt, mobi, offset - 16, value)
+
+    put(0x14, ">L", length)
+    put(0x18, ">L", 2)
+    put(0x1C, ">L", codepage)
+    put(0x20, ">L", int.from_bytes(meta["uuid"].encode()[:4], "big"))
+    put(0x24, ">L", version)
+    for offset in range(0x28, 0x50, 4):
+        put(offset, ">L", 0xFFFFFFFF)
+    put(0x50, ">L", text_records + 1)
+    put(0x54, ">L", 16 + length + len(exth))
+    put(0x58, ">L", len(title))
+    put(0x5C, ">L", 9 | (1 << 10))
+    put(0x68, ">L", version)
+    put(0x6C, ">L", text_records + 1)
+    put(0x80, ">L", 0x40)
+    put(0xA8, ">L", 0xFFFFFFFF)
+    if version >= 8:
+        put(0xC0, ">L", 0xFFFFFFFF)
+        put(0xF8, ">L", 0xFFFFFFFF)
+        put(0xFC, ">L", 0xFFFFFFFF)
+    else:
+        put(0xC0, ">H", 1)
+        put(0xC2, ">H", text_records)
+    put(0xF4, ">L", 0xFFFFFFFF)
+    return palmdoc + bytes(mobi) + exth + title + b"\0" * (4 - len(title) % 4)
+
+
+def write_mobi(
+    path: Union[str, Path],
+    rng: random.Random,
+    meta: Optional[dict] = None,
+    version: int = 6,
+    **spec,
+) -> dict:
+    """
+    Write a synthetic Palm database MOBI (version 6) or AZW3 (version 8).
+
+    Parameters
+    ----------
+    path : Union[str, Path]
+        output file path
+    rng : random.Random
+        random source
+    meta : Optional[dict]
+        metadata to embed, generated from `spec` when omitted
+    version : int
+        MOBI format version, 6 or 8
+    **spec
+        overrides for `DEFAULTS`
+
+    Returns
+    -------
+    dict
+        the embedded metadata
+    """
+    spec = {**DEFAULTS, **spec}
+    meta = meta or book_metadata(rng, **spec)
+    meta.setdefault("uuid", str(uuid.UUID(int=rng.getrandbits(128))))
+    codec = CODECS[spec["codepage"]]
+    size = spec["record_size"]
+    text = words(rng, spec["text_records"] * size // 6 + 1).encode(codec)
+    text = text[: spec["text_records"] * size]
+    texts = [text[i : i + size] for i in range(0, len(text), size)]
+    record0 = build_record0(
+        meta,
+        version,
+        spec["codepage"],
+        len(text),
+        len(texts),
+        size,
+        spec["exth_records"],
+    )
+    records = [record0] + texts + [b"\xe9\x8e\r\n"]
+    name = meta["title"].encode("ascii", "replace")[:31]
+    header = struct.pack(
+        ">32sHHLLLLLL4s4sLLH",
+        name,
+        0,
+        0,
+        0,
+        0,
+        0,
+        0,
+        0,
+        0,
+        b"BOOK",
+        b"MOBI",
+        2 * len(records) - 1,
+        0,
+        len(records),
+    )
+    offset = len(header) + 8 * len(records) + 2
+    table = b""
+    for i, record in enumerate(records):
+        table += struct.pack(">LL", offset, 2 * i)
+        offset += len(record)
+    with open(path, "wb") as fd:
+        fd.write(header + table + b"\0\0")
+        for record in records:
+            fd.write(record)
+    return meta
+
+
+WRITERS = {
+    "epub": (".epub", write_epub, {}),
+    "mobi": (".mobi", write_mobi, {"version": 6}),
+    "azw3": (".azw3", write_mobi, {"version": 8}),
+}
+
+
+def generate_corpus(
+    directory: Union[str, Path],
+    count: int,
+    formats: Sequence[str] = ("epub", "mobi", "azw3"),
+    profile: str = "typical",
+    seed: int = 0,
+    per_dir: int = 1000,
+    **spec,
+) -> Generator:
+    """
+    Write `count` synthetic ebooks below `directory`.
+
+    Files are spread over numbered subdirectories of at most `per_dir`
+    files each so corpora with millions of books stay browsable.
+
+    Parameters
+    ----------
+    directory : Union[str, Path]
+        output directory
+    count : int
+        number of ebooks to write
+    formats : Sequence[str]
+        formats cycled through, any of ``epub``, ``mobi`` and ``azw3``
+    profile : str
+        name of a shape in `PROFILES`
+    seed : int
+        random seed, the same seed reproduces the same corpus
+    per_dir : int
+        maximum number of files per subdirectory
+    **spec
+        overrides applied on top of the profile
+
+    Yields
+    ------
+    Generator[Tuple[Path, dict]]
+        each written path and the metadata embedded in it
+    """
+    rng = random.Random(seed)
+    spec = {**PROFILES[profile], **spec}
+    directory = Path(directory)
+    for i in range(count):
+        suffix, writer, extra = WRITERS[formats[i % len(formats)]]
+        folder = directory / f"{i // per_dir:05d}"
+        folder.mkdir(parents=True, exist_ok=True)
+        path = folder / f"book-{i:07d}{suffix}"
+        yield path, writer(path, rng, **extra, **spec)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """
+    Execute the corpus generator command line interface.
+
+    Parameters
+    ----------
+    argv : Optional[List[str]]
+        command line arguments, defaults to ``sys.argv[1:]``
+    """
+    parser = argparse.ArgumentParser(
+        prog="python -m ebookatty.synth",
+        description="generate synthetic ebooks for load testing",
+    )
+    parser.add_argument("directory", help="output directory")
+    parser.add_argument(
+        "-n", "--count", help="number of ebooks to write", type=int, default=1000
+    )
+    parser.add_argument(
+        "-p",
+        "--profile",
+        help="shape of the generated books",
+        choices=sorted(PROFILES),
+        default="typical",
+    )
+    parser.add_argument(
+        "-f",
+        "--formats",
+        help="comma separated formats to generate. Default is epub,mobi,azw3",
+        default="epub,mobi,azw3",
+    )
+    parser.add_argument("--seed", help="random seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    formats = args.formats.split(",")
+    for fmt in formats:
+        if fmt not in WRITERS:
+            parser.error(f"unknown format {fmt!r}")
+    total = 0
+    for total, _ in enumerate(
+        generate_corpus(args.directory, args.count, formats, args.profile, args.seed),
+        1,
+    ):
+        pass
+    print(f"wrote {total} ebooks to {args.directory}")
+
+
+if __name__ == "__main__":
+    main()  # pragma: nocover
@@ -0,0 +1,210 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+########################################################################
+#  Copyright (C) 2021  alexpdev
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#########################################################################
+"""
+Stage instrumentation for the parsers and writers.
+
+Code that does measurable work wraps it in ``with stage("epub.opf") as s``
+and may report the bytes it handled with ``s.nbytes = ...``.  Completed
+stages are passed as `StageEvent` to every hook registered with `add_hook`
+and appended to the active `collect` list of the current context.  When
+neither is present `stage` returns a shared no-op object, so disabled
+tracing costs one function call and a context variable lookup per stage.
+
+Hooks are process global and are not inherited by the workers of a
+process pool; per-file traces collected in workers travel back with the
+batch results instead.
+"""
+
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Generator, List, NamedTuple, Optional
+
+
+class StageEvent(NamedTuple):
+    """Duration and size of one completed stage."""
+
+    stage: str
+    seconds: float
+    nbytes: int
+
+
+Hook = Callable[[StageEvent], None]
+
+HOOKS: List[Hook] = []
+
+_collector: ContextVar[Optional[List[StageEvent]]] = ContextVar(
+    "ebookatty_trace", default=None
+)
+
+
+class NullStage:
+    """Stage returned while tracing is disabled, it records nothing."""
+
+    __slots__ = ()
+
+    nbytes = 0
+
+    def __enter__(self):
+        """Return the shared instance."""
+        return self
+
+    def __exit__(self, *_):
+        """Do nothing."""
+
+    def __setattr__(self, name, value):
+        """Discard byte counts reported to a disabled stage."""
+
+
+NULL_STAGE = NullStage()
+
+
+class Stage:
+    """
+    Timer for one stage, emitting a `StageEvent` when it exits.
+
+    Parameters
+    ----------
+    name : str
+        dotted stage name such as ``"mobi.exth"``
+    nbytes : int
+        bytes handled by the stage, may be updated inside the block
+    collector : Optional[List[StageEvent]]
+        list of the active `collect` context, if any
+    """
+
+    __slots__ = ("name", "nbytes", "collector", "start")
+
+    def __init__(self, name: str, nbytes: int, collector: Optional[List[StageEvent]]):
+        """
+        Construct the stage timer.
+        """
+        self.name = name
+        self.nbytes = nbytes
+        self.collector = collector
+        self.start = 0.0
+
+    def __enter__(self):
+        """Start timing."""
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        """Stop timing and emit the event."""
+        event = StageEvent(self.name, time.perf_counter() - self.start, self.nbytes)
+        if self.collector is not None:
+            self.collector.append(event)
+        for hook in HOOKS:
+            hook(event)
+
+
+def stage(name: str, nbytes: int = 0):
+    """
+    Time the enclosed block as the stage `name`.
+
+    Parameters
+    ----------
+    name : str
+        dotted stage name, the prefix names the component
+    nbytes : int
+        bytes handled by the stage, if known up front
+
+    Returns
+    -------
+    Union[Stage, NullStage]
+        context manager whose ``nbytes`` attribute may be set in the block
+    """
+    collector = _collector.get()
+    if collector is None and not HOOKS:
+        return NULL_STAGE
+    return Stage(name, nbytes, collector)
+
+
+def add_hook(hook: Hook) -> None:
+    """
+    Call `hook` with every `StageEvent` emitted in this process.
+
+    Parameters
+    ----------
+    hook : Callable[[StageEvent], None]
+        the callback, it runs inline and should be fast
+    """
+    HOOKS.append(hook)
+
+
+def remove_hook(hook: Hook) -> None:
+    """
+    Stop calling a hook registered with `add_hook`.
+
+    Parameters
+    ----------
+    hook : Callable[[StageEvent], None]
+        the callback to remove
+
+    Raises
+    ------
+    ValueError
+        if the hook is not registered
+    """
+    HOOKS.remove(hook)
+
+
+@contextmanager
+def collect() -> Generator:
+    """
+    Collect the events emitted in the current context.
+
+    Collections are per thread and per asyncio task, so concurrent files
+    never share a trace.  Nested collections shadow the outer one.
+
+    Yields
+    ------
+    Generator[List[StageEvent]]
+        the list the events are appended to
+    """
+    events = []
+    token = _collector.set(events)
+    try:
+        yield events
+    finally:
+        _collector.reset(token)
+
+
+def summarize(events: List[StageEvent]) -> Dict[str, Dict[str, float]]:
+    """
+    Total the events of a trace per stage.
+
+    Parameters
+    ----------
+    events : List[StageEvent]
+        the collected events
+
+    Returns
+    -------
+    Dict[str, Dict[str, float]]
+        stage names in first-seen order mapped to their total seconds and
+        bytes
+    """
+    totals = {}
+    for name, seconds, nbytes in events:
+        total = totals.setdefault(name, {"seconds": 0.0, "bytes": 0})
+        total["seconds"] += seconds
+        total["bytes"] += nbytes
+    return totals
@@ -0,0 +1,442 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+########################################################################
+#  Copyright (C) 2021  alexpdev
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#########################################################################
+"""Output writers that serialize metadata records to files."""
+
+import csv
+import json
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Union
+
+from ebookatty.standards import ALL_FIELDS, CSV_COLUMNS
+from ebookatty.trace import stage
+
+# Columns of the columnar outputs.  Keys outside `ALL_FIELDS` are kept as a
+# JSON object in the ``extra`` column so the schema never depends on input.
+# ``path`` is one of `ALL_FIELDS` and leads the schema exactly once.
+ARROW_COLUMNS = ["path", *sorted(ALL_FIELDS - {"path"}), "extra"]
+
+
+class Writer:
+    """
+    Base class for metadata output writers.
+
+    Records are handed to `write` one at a time as soon as they are ready
+    and `close` finishes the file.  Writers can be used as context managers.
+    Each write is traced as the stage named by `stage`, with the number of
+    characters or bytes it produced.  Writers that set `includes_path` have
+    a column for the ebook's file path, passed as the ``path`` key.
+
+    Parameters
+    ----------
+    path : Union[str, Path]
+        file path the output is written to.
+    """
+
+    suffixes = ()
+    stage = "write"
+    newline = None
+    supports_columns = False
+    includes_path = False
+
+    def __init__(self, path: Union[str, Path]):
+        """
+        Construct the writer and open the output file.
+        """
+        self.path = Path(path)
+        self.fd = open(self.path, "wt", encoding="utf-8", newline=self.newline)
+
+    def write(self, record: Dict[str, str]) -> None:
+        """
+        Write a single metadata record.
+
+        Parameters
+        ----------
+        record : Dict[str, str]
+            the metadata for one ebook
+        """
+        raise NotImplementedError  # pragma: nocover
+
+    def close(self) -> None:
+        """
+        Finish the output and close the file.
+        """
+        self.fd.close()
+
+    def __enter__(self):
+        """Enter the writer context."""
+        return self
+
+    def __exit__(self, *_):
+        """Close the writer when leaving the context."""
+        self.close()
+
+
+class JsonWriter(Writer):
+    """
+    Write records as a single JSON array, one element at a time.
+    """
+
+    suffixes = (".json",)
+    stage = "write.json"
+
+    def __init__(self, path: Union[str, Path]):
+        """
+        Construct the writer and start the JSON array.
+        """
+        super().__init__(path)
+        self.count = 0
+        self.fd.write("[")
+
+    def write(self, record: Dict[str, str]) -> None:
+        """
+        Append a record to the JSON array.
+
+        Parameters
+        ----------
+        record : Dict[str, str]
+            the metadata for one ebook
+        """
+        with stage(self.stage) as timer:
+            text = json.dumps(record)
+            if self.count:
+                text = ", " + text
+            self.fd.write(text)
+            self.count += 1
+            timer.nbytes = len(text)
+
+    def close(self) -> None:
+        """
+        Terminate the JSON array and close the file.
+        """
+        self.fd.write("]")
+        super().close()
+
+
+class JsonLinesWriter(Writer):
+    """
+    Write one JSON object per line, flushing after every record.
+
+    Each line is complete on disk as soon as its ebook is parsed, so the
+    file can be tailed while the run is in progress.
+    """
+
+    suffixes = (".jsonl", ".ndjson")
+    stage = "write.jsonl"
+
+    def write(self, record: Dict[str, str]) -> None:
+        """
+        Write a record as a single line and flush it.
+
+        Parameters
+        ----------
+        record : Dict[str, str]
+            the metadata for one ebook
+        """
+        with stage(self.stage) as timer:
+            text = json.dumps(record) + "\n"
+            self.fd.write(text)
+            self.fd.flush()
+            timer.nbytes = len(text)
+
+
+def csv_value(value) -> str:
+    """
+    Render a metadata value as a single CSV field.
+
+    Parameters
+    ----------
+    value : Any
+        the metadata value
+
+    Returns
+    -------
+    str
+        empty for None, list and tuple items joined with ``"; "``
+    """
+    if value is None:
+        return ""
+    if isinstance(value, (list, tuple)):
+        return "; ".join(str(item) for item in value)
+    if isinstance(value, bytes):
+        return value.decode("utf-8", "replace")
+    return str(value)
+
+
+class CsvWriter(Writer):
+    """
+    Write records as comma separated values, one row per record.
+
+    The header is fixed when the writer is created, so rows are written as
+    soon as they arrive and memory use does not grow with the number of
+    records.  Keys outside the selected columns are ignored and values are
+    quoted by the `csv` module wherever needed.
+
+    Parameters
+    ----------
+    path : Union[str, Path]
+        file path the output is written to.
+    columns : Optional[List[str]]
+        the columns in output order, defaults to `standards.CSV_COLUMNS`
+    """
+
+    suffixes = (".csv",)
+    stage = "write.csv"
+    newline = ""
+    supports_columns = True
+
+    def __init__(self, path: Union[str, Path], columns: Optional[List[str]] = None):
+        """
+        Construct the writer and write the header row.
+        """
+        super().__init__(path)
+        self.columns = list(columns or CSV_COLUMNS)
+        self.selected = frozenset(self.columns)
+        self.csv = csv.DictWriter(self.fd, self.columns, extrasaction="ignore")
+        self.csv.writeheader()
+
+    def write(self, record: Dict[str, str]) -> None:
+        """
+        Write a record as one row.
+
+        Parameters
+        ----------
+        record : Dict[str, str]
+            the metadata for one ebook
+        """
+        with stage(self.stage) as timer:
+            row = {
+                key: csv_value(value)
+                for key, value in record.items()
+                if key in self.selected
+            }
+            self.csv.writerow(row)
+            timer.nbytes = sum(map(len, row.values()))
+
+
+def import_pyarrow():
+    """
+    Import pyarrow, which is only needed for columnar output.
+
+    Returns
+    -------
+    module
+        the pyarrow package
+
+    Raises
+    ------
+    ImportError
+        if pyarrow is not installed
+    """
+    try:
+        import pyarrow
+    except ImportError as err:
+        raise ImportError(
+            "pyarrow is required for .arrow, .feather and .parquet output, "
+            "install it with 'pip install ebookatty[arrow]'"
+        ) from err
+    return pyarrow
+
+
+def arrow_schema():
+    """
+    Return the Arrow schema shared by every columnar output.
+
+    Returns
+    -------
+    pyarrow.Schema
+        one nullable string column per entry of `ARROW_COLUMNS`
+    """
+    pa = import_pyarrow()
+    return pa.schema([pa.field(name, pa.string()) for name in ARROW_COLUMNS])
+
+
+def arrow_columns(records: Iterable[Dict[str, str]]) -> Dict[str, List]:
+    """
+    Rearrange records into one list of values per output column.
+
+    Parameters
+    ----------
+    records : Iterable[Dict[str, str]]
+        metadata records
+
+    Returns
+    -------
+    Dict[str, List]
+        column names mapped to their values, None where a record lacks one
+    """
+    columns = {name: [] for name in ARROW_COLUMNS}
+    for record in records:
+        extra = {}
+        for key, value in record.items():
+            if key in columns and key != "extra":
+                columns[key].append(None if value is None else str(value))
+            else:
+                extra[key] = value
+        count = len(columns["extra"]) + 1
+        for values in columns.values():
+            if len(values) < count:
+                values.append(None)
+        if extra:
+            columns["extra"][-1] = json.dumps(extra, default=str)
+    return columns
+
+
+def to_arrow_table(records: Iterable[Dict[str, str]]):
+    """
+    Build an Arrow table with the stable columnar schema from records.
+
+    Parameters
+    ----------
+    records : Iterable[Dict[str, str]]
+        metadata records
+
+    Returns
+    -------
+    pyarrow.Table
+        one row per record
+    """
+    pa = import_pyarrow()
+    return pa.table(arrow_columns(records), schema=arrow_schema())
+
+
+class ArrowWriter(Writer):
+    """
+    Write records as an Arrow IPC (Feather v2) or Parquet file.
+
+    Records are buffered and written one row group at a time, so memory use
+    is bounded by `row_group_size` whatever the number of records.  Every
+    file has the same schema, see `ARROW_COLUMNS`.
+
+    Parameters
+    ----------
+    path : Union[str, Path]
+        file path the output is written to.
+    row_group_size : int
+        number of records per row group
+    """
+
+    suffixes = (".arrow", ".feather", ".parquet")
+    stage = "write.arrow"
+    includes_path = True
+
+    def __init__(self, path: Union[str, Path], row_group_size: int = 10_000):
+        """
+        Construct the writer and open the columnar file.
+        """
+        pa = import_pyarrow()
+        self.path = Path(path)
+        self.row_group_size = row_group_size
+        self.schema = arrow_schema()
+        self.rows = []
+        if self.path.suffix.lower() == ".parquet":
+            import pyarrow.parquet as pq
+
+            self.sink = pq.ParquetWriter(str(self.path), self.schema)
+        else:
+            self.sink = pa.ipc.new_file(str(self.path), self.schema)
+
+    def write(self, record: Dict[str, str]) -> None:
+        """
+        Buffer a record, writing a row group once enough are buffered.
+
+        Parameters
+        ----------
+        record : Dict[str, str]
+            the metadata for one ebook
+        """
+        self.rows.append(record)
+        if len(self.rows) >= self.row_group_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Write the buffered records as one row group.
+        """
+        if self.rows:
+            with stage(self.stage) as timer:
+                table = to_arrow_table(self.rows)
+                self.sink.write_table(table)
+                timer.nbytes = table.nbytes
+            self.rows = []
+
+    def close(self) -> None:
+        """
+        Write the remaining records and finish the file.
+        """
+        self.flush()
+        self.sink.close()
+
+
+WRITERS = [JsonWriter, JsonLinesWriter, CsvWriter, ArrowWriter]
+
+
+def find_writer(path: Union[str, Path]) -> type:
+    """
+    Return the writer class matching the file extension of `path`.
+
+    Parameters
+    ----------
+    path : Union[str, Path]
+        file path the output is written to
+
+    Returns
+    -------
+    type
+        the `Writer` subclass for the output format
+
+    Raises
+    ------
+    ValueError
+        if no writer supports the file extension
+    """
+    suffix = Path(path).suffix.lower()
+    for writer in WRITERS:
+        if suffix in writer.suffixes:
+            return writer
+    supported = [s for writer in WRITERS for s in writer.suffixes]
+    raise ValueError(f"unsupported output format {suffix!r}, expected one of {supported}")
+
+
+def get_writer(path: Union[str, Path], columns: Optional[List[str]] = None) -> Writer:
+    """
+    Create the writer matching the file extension of `path`.
+
+    Parameters
+    ----------
+    path : Union[str, Path]
+        file path the output is written to
+    columns : Optional[List[str]]
+        columns of tabular outputs that support choosing them, ignored by
+        the other writers
+
+    Returns
+    -------
+    Writer
+        writer instance for the output format
+
+    Raises
+    ------
+    ValueError
+        if no writer supports the file extension
+    """
+    writer = find_writer(path)
+    if columns is not None and writer.supports_columns:
+        return writer(path, columns)
+    return writer(path)
@@ -45,6 +45,7 @@ setup(
     include_package_data=True,
     python_requires=">=3.6",
     setup_requires=["setuptools"],
+    extras_require={"arrow": ["pyarrow"]},
     zip_safe=False,
     test_suite="complete",
 )
@@ -44,7 +44,7 @@ def test_metadata_fetcher(book):
 
 
 @pytest.mark.parametrize("pattern", ["*.epub", "*.azw3", "*.mobi"])
-@pytest.mark.parametrize("ext", [".csv", ".json"])
+@pytest.mark.parametrize("ext", [".csv", ".json", ".jsonl", ".ndjson"])
 @pytest.mark.parametrize("flag", ["-o", "--output", ""])
 def test_cli(testdir, flag, outdir, pattern, ext):
     """Test the cli."""
@@ -70,3 +70,1067 @@ def test_main_execute():
         result = main()
     except SystemExit:
         assert True
+
+
+@pytest.mark.parametrize(
+    "book", [i for i in get_testfiles() if not i.endswith(".epub")]
+)
+def test_kindle_header_only_read(book):
+    import io
+    from pathlib import Path
+    from ebookatty.mobi import Kindle, MetadataHeader
+    header = MetadataHeader(io.BytesIO(Path(book).read_bytes()))
+    expected = {k: sorted(str(i) for i in set(v)) for k, v in header.data.data.items()}
+    result = Kindle(book).metadata
+    for key, value in expected.items():
+        assert sorted(result[key].split("; ")) == value
+
+
+@pytest.mark.parametrize(
+    "book", [i for i in get_testfiles() if not i.endswith(".epub")]
+)
+def test_kindle_engines_match(book):
+    from ebookatty.mobi import Kindle
+    mapped = Kindle(book, engine="mmap")
+    streamed = Kindle(book, engine="stream")
+    assert mapped.engine == "mmap"
+    assert mapped.metadata == streamed.metadata
+
+
+@pytest.mark.parametrize("fmt, version", [("mobi", 6), ("azw3", 8)])
+def test_kindle_header_fields(fmt, version, tmp_path):
+    import struct
+    from ebookatty.mobi import MetadataHeader
+    from ebookatty.standards import mobi6_header, mobi8_header
+    from ebookatty.synth import generate_corpus
+    (path, _), = generate_corpus(tmp_path, 1, formats=[fmt])
+    with open(path, "rb") as stream:
+        header = MetadataHeader(stream)
+    table = mobi8_header if version >= 8 else mobi6_header
+    raw = bytes(header.raw)
+    assert header.version == header.header_fields["version"] == version
+    assert header.header_fields["magic"] == b"MOBI"
+    assert set(header.header_fields) <= set(table)
+    assert len(header.header_fields) < len(table)
+    for name, value in header.header_fields.items():
+        offset, fmt, _ = table[name]
+        assert struct.unpack_from(fmt, raw, offset)[0] == value
+    assert ("skeleton_index" in header.header_fields) == (version >= 8)
+    assert {"drm_flags", "first_resc_offset"} <= set(header.header_fields)
+
+
+def test_kindle_unknown_engine(testdir):
+    from ebookatty.mobi import Kindle
+    with pytest.raises(ValueError):
+        Kindle(os.path.join(testdir, "test_book.mobi"), engine="fast")
+
+
+@pytest.mark.parametrize("executor", ["process", "thread"])
+def test_extract_many(executor):
+    from ebookatty import extract_many
+    books = sorted(get_testfiles())
+    results = extract_many(books, workers=2, executor=executor, chunksize=2)
+    assert [r.path for r in results] == books
+    for result in results:
+        assert result.error is None
+        assert result.metadata == MetadataFetcher(result.path).get_metadata()
+
+
+def test_extract_many_unordered_reports_errors(tmp_path):
+    from ebookatty import extract_many
+    broken = tmp_path / "broken.mobi"
+    broken.write_bytes(b"not an ebook")
+    books = get_testfiles() + [str(broken)]
+    results = extract_many(books, workers=3, executor="thread", ordered=False)
+    assert sorted(r.path for r in results) == sorted(books)
+    failed = [r for r in results if r.error is not None]
+    assert [r.path for r in failed] == [str(broken)]
+    assert failed[0].metadata is None
+
+
+def test_cli_jobs(testdir, outdir):
+    import json
+    out = os.path.join(outdir, "jobs.json")
+    sys.argv = ["ebookatty", os.path.join(testdir, "*"), "-j", "2", "-o", out]
+    execute()
+    with open(out) as fd:
+        assert len(json.load(fd)) == len(get_testfiles())
+
+
+def test_iter_metadata_is_lazy(testdir, tmp_path):
+    from ebookatty import iter_metadata
+    from ebookatty.batch import ExtractionError
+    broken = tmp_path / "broken.epub"
+    broken.write_bytes(b"PK")
+    results = iter_metadata([os.path.join(testdir, "*.mobi"), str(broken)])
+    path, data = next(results)
+    assert path.endswith(".mobi") and data["identity"] == "BOOKMOBI"
+    remaining = list(results)
+    assert remaining[-1][0] == str(broken)
+    assert isinstance(remaining[-1][1], ExtractionError)
+
+
+def test_cli_unsupported_output(testdir, outdir):
+    out = os.path.join(outdir, "outfile.txt")
+    sys.argv = ["ebookatty", os.path.join(testdir, "*.mobi"), "-o", out]
+    with pytest.raises(SystemExit):
+        execute()
+
+
+def test_jsonlines_writer_flushes(outdir):
+    import json
+    from ebookatty.writers import get_writer
+    out = os.path.join(outdir, "lines.jsonl")
+    with get_writer(out) as writer:
+        for book in sorted(get_testfiles()):
+            writer.write(MetadataFetcher(book).get_metadata())
+            with open(out) as fd:
+                lines = fd.read().splitlines()
+            assert json.loads(lines[-1]) == MetadataFetcher(book).get_metadata()
+    assert len(lines) == len(get_testfiles())
+
+
+def test_metadata_cache(tmp_path, testdir):
+    from ebookatty import fetch_metadata
+    from ebookatty.cache import MetadataCache
+    book = tmp_path / "book.mobi"
+    book.write_bytes(open(os.path.join(testdir, "test_book.mobi"), "rb").read())
+    with MetadataCache(tmp_path / "cache") as cache:
+        first = fetch_metadata(book, cache=cache)
+        assert cache.misses == 1 and len(cache) == 1
+        assert fetch_metadata(book, cache=cache) == first
+        assert cache.hits == 1
+        os.utime(book, ns=(0, 0))
+        assert cache.get(book) is None
+
+
+def test_metadata_cache_rewritten_during_parse(testdir, tmp_path, monkeypatch):
+    from ebookatty import cache as cache_module
+    from ebookatty.metadata import MetadataFetcher
+    book = tmp_path / "book.mobi"
+    book.write_bytes(open(os.path.join(testdir, "test_book.mobi"), "rb").read())
+
+    class RewritingFetcher(MetadataFetcher):
+        def get_metadata(self):
+            metadata = super().get_metadata()
+            os.utime(book, ns=(0, 0))
+            return metadata
+
+    monkeypatch.setattr(cache_module, "MetadataFetcher", RewritingFetcher)
+    with cache_module.MetadataCache(tmp_path / "cache") as cache:
+        cache.fetch(book)
+        assert cache.get(book) is None
+
+
+def test_metadata_cache_stats_from_threads(tmp_path, testdir):
+    from concurrent.futures import ThreadPoolExecutor
+    from ebookatty.cache import MetadataCache
+    books = sorted(get_testfiles())
+    with MetadataCache(tmp_path) as cache:
+        for book in books[:2]:
+            cache.fetch(book)
+        with ThreadPoolExecutor(8) as pool:
+            list(pool.map(cache.get, books * 50))
+        assert cache.hits == 100
+        assert cache.misses == len(books) * 50 - 100 + 2
+
+
+def test_metadata_cache_eviction(tmp_path):
+    from ebookatty.cache import MetadataCache
+    with MetadataCache(tmp_path, max_entries=10) as cache:
+        for i in range(25):
+            path = tmp_path / f"{i}.mobi"
+            path.write_bytes(b"")
+            cache.put(path, {"title": str(i)})
+        assert len(cache) <= 10
+        assert cache.get(tmp_path / "24.mobi") == {"title": "24"}
+        assert cache.get(tmp_path / "0.mobi") is None
+
+
+@pytest.mark.parametrize("executor", ["process", "thread"])
+def test_extract_many_cached(tmp_path, executor):
+    from ebookatty import extract_many
+    from ebookatty.cache import MetadataCache
+    books = sorted(get_testfiles())
+    with MetadataCache(tmp_path) as cache:
+        first = extract_many(books, workers=2, executor=executor, cache=cache)
+        assert len(cache) == len(books)
+        second = extract_many(books, workers=2, executor=executor, cache=cache)
+    assert first == second
+
+
+def test_cli_cache(testdir, outdir, tmp_path):
+    out = os.path.join(outdir, "cached.jsonl")
+    args = ["ebookatty", os.path.join(testdir, "*"), "--cache-dir", str(tmp_path)]
+    for _ in range(2):
+        sys.argv = args + ["-o", out]
+        execute()
+    assert os.path.exists(tmp_path / "metadata.sqlite3")
+
+
+def test_cli_index(tmp_path):
+    import json
+    library = tmp_path / "library"
+    (library / "nested").mkdir(parents=True)
+    books = sorted(get_testfiles())
+    for book in books[:4]:
+        shutil.copy(book, library / "nested")
+    out = str(tmp_path / "delta.jsonl")
+    sys.argv = ["ebookatty", "index", str(library), "-o", out]
+    delta = execute()
+    assert len(delta.added) == 4 and not delta.changed and not delta.removed
+    removed = library / "nested" / os.path.basename(books[0])
+    os.remove(removed)
+    shutil.copy(books[5], library)
+    changed = library / "nested" / os.path.basename(books[1])
+    os.utime(changed, ns=(0, 0))
+    delta = execute()
+    assert delta.added == [str(library / os.path.basename(books[5]))]
+    assert delta.changed == [str(changed)]
+    assert delta.removed == [str(removed)]
+    assert delta.unchanged == 2
+    with open(out) as fd:
+        statuses = sorted(json.loads(line)["status"] for line in fd)
+    assert statuses == ["added", "changed", "removed"]
+    sys.argv = ["ebookatty", "index", str(library), "-o", out, "--merged"]
+    delta = execute()
+    assert not (delta.added or delta.changed or delta.removed)
+    with open(out) as fd:
+        assert len(fd.readlines()) == 4
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="symlinks need privileges")
+def test_index_dangling_symlink(tmp_path):
+    import json
+    from ebookatty.index import index_library
+    library = tmp_path / "library"
+    library.mkdir()
+    book = sorted(get_testfiles())[0]
+    shutil.copy(book, library)
+    broken = library / "broken.epub"
+    broken.symlink_to(tmp_path / "missing.epub")
+    manifest = tmp_path / "index.jsonl"
+    delta = index_library(library, manifest, executor="thread")
+    assert delta.added == sorted([str(broken), str(library / os.path.basename(book))])
+    with open(manifest) as fd:
+        entries = {entry["path"]: entry for entry in map(json.loads, fd)}
+    assert entries[str(broken)]["metadata"] is None
+    assert "FileNotFoundError" in entries[str(broken)]["error"]
+    assert entries[str(library / os.path.basename(book))]["error"] is None
+    delta = index_library(library, manifest, executor="thread")
+    assert not (delta.added or delta.changed or delta.removed)
+
+
+def test_fetch_metadata_async():
+    import asyncio
+    from ebookatty import fetch_metadata, fetch_metadata_async
+    book = sorted(get_testfiles())[0]
+    result = asyncio.run(fetch_metadata_async(book))
+    assert result == fetch_metadata(book)
+
+
+def test_extract_many_async(tmp_path):
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    from ebookatty import extract_many_async
+    broken = tmp_path / "broken.azw3"
+    broken.write_bytes(b"")
+    books = sorted(get_testfiles()) + [str(broken)]
+    with ThreadPoolExecutor(2) as pool:
+        results = asyncio.run(extract_many_async(books, limit=3, executor=pool))
+    assert [r.path for r in results] == books
+    assert all(r.metadata for r in results[:-1])
+    assert results[-1].error is not None
+
+
+@pytest.mark.parametrize("book", get_testfiles())
+def test_fetch_metadata_from_memory(book):
+    import io
+    from ebookatty import fetch_metadata
+    expected = MetadataFetcher(book).get_metadata()
+    expected.pop("name", None)
+    expected.pop("filetype", None)
+    with open(book, "rb") as fd:
+        data = fd.read()
+    assert fetch_metadata(data) == expected
+    assert fetch_metadata(memoryview(data)) == expected
+    assert MetadataFetcher(io.BytesIO(data)).get_metadata() == expected
+    with open(book, "rb") as fd:
+        assert MetadataFetcher(fd).get_metadata()["title"] == expected["title"]
+
+
+def test_fetch_metadata_format_hint(testdir):
+    from ebookatty import fetch_metadata
+    with open(os.path.join(testdir, "test_book.mobi"), "rb") as fd:
+        data = fd.read()
+    assert fetch_metadata(data, format="azw3")["identity"] == "BOOKMOBI"
+    assert fetch_metadata(data, format="epub") is None
+
+
+@pytest.mark.parametrize("book", get_testfiles())
+def test_sniff_misnamed_files(book, tmp_path):
+    misnamed = tmp_path / "book"
+    shutil.copy(book, misnamed)
+    expected = MetadataFetcher(book).get_metadata()
+    result = MetadataFetcher(misnamed).get_metadata()
+    assert result["title"] == expected["title"]
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        b"",
+        b"%PDF-1.7\n" + b"\0" * 100,
+        b"PK\x03\x04" + b"\0" * 26 + b"mimetypeapplication/vnd.oasis.opendocument.text",
+    ],
+)
+def test_sniff_rejects_unsupported(content, tmp_path):
+    from ebookatty import fetch_metadata
+    from ebookatty.metadata import UnsupportedFormatError
+    path = tmp_path / "book.mobi"
+    path.write_bytes(content)
+    with pytest.raises(UnsupportedFormatError):
+        MetadataFetcher(path)
+    assert fetch_metadata(content) is None
+
+
+@pytest.mark.parametrize(
+    "members", [["[Content_Types].xml", "word/document.xml"], ["001.png", "002.png"]]
+)
+def test_sniff_rejects_other_zips(members, tmp_path):
+    import zipfile
+    from ebookatty import fetch_metadata
+    from ebookatty.metadata import UnsupportedFormatError
+    path = tmp_path / "book.epub"
+    with zipfile.ZipFile(path, "w") as archive:
+        for name in members:
+            archive.writestr(name, "data")
+    with pytest.raises(UnsupportedFormatError):
+        MetadataFetcher(path)
+    assert fetch_metadata(path.read_bytes()) is None
+
+
+def test_sniff_epub_without_mimetype(testdir, tmp_path):
+    import zipfile
+    book = os.path.join(testdir, "Elements of Euclid - John Casey and Euclid.epub")
+    path = tmp_path / "book"
+    with zipfile.ZipFile(book) as source, zipfile.ZipFile(path, "w") as archive:
+        for name in source.namelist():
+            if name != "mimetype":
+                archive.writestr(name, source.read(name))
+    expected = MetadataFetcher(book).get_metadata()
+    assert MetadataFetcher(path).get_metadata()["title"] == expected["title"]
+
+
+def test_bench(tmp_path):
+    import json
+    from ebookatty import bench
+    out = tmp_path / "bench.json"
+    results = bench.main(["-n", "12", "--json", str(out)])
+    assert [r.name for r in results] == [
+        "epub.Epub", "mobi.Kindle", "fetch_metadata", "cli"
+    ]
+    assert results[2].files == 12 and results[3].files == 12
+    assert all(r.p50_ms <= r.p99_ms for r in results)
+    assert len(json.loads(out.read_text())) == 4
+    assert bench.percentile([3, 1, 2, 4], 50) == 2
+
+
+def test_bench_without_testbooks(tmp_path, monkeypatch):
+    from ebookatty import bench
+    monkeypatch.setattr(bench, "BOOKS_DIR", tmp_path / "missing")
+    results = bench.run(corpus_size=6)
+    assert [r.files for r in results] == [2, 4, 6, 6]
+
+
+@pytest.mark.parametrize("profile", ["typical", "many-exth", "cp1252"])
+def test_synthetic_corpus(profile, tmp_path):
+    from ebookatty import fetch_metadata
+    from ebookatty.synth import generate_corpus
+    corpus = list(generate_corpus(tmp_path, 6, profile=profile, per_dir=4))
+    assert len({path.parent for path, _ in corpus}) == 2
+    for path, meta in corpus:
+        data = fetch_metadata(path)
+        assert data["title"] == meta["title"]
+        assert set(data["author"].split("; ")) == set(meta["authors"])
+        assert meta["publisher"] in data["publisher"]
+        if path.suffix != ".epub":
+            assert data["isbn"] == meta["isbn"]
+            version = "8" if path.suffix == ".azw3" else "6"
+            assert version in data["version"].split("; ")
+
+
+def test_synth_cli(tmp_path):
+    from ebookatty import synth
+    synth.main([str(tmp_path), "-n", "4", "-f", "mobi", "-p", "huge-opf"])
+    assert len(list(tmp_path.glob("*/*.mobi"))) == 4
+
+
+@pytest.mark.parametrize("profile", ["deep-xml", "huge-opf"])
+def test_epub_targeted_opf_parse(profile, tmp_path):
+    import io
+    import zipfile
+    from xml.etree import ElementTree as ET
+    from ebookatty.epub import Epub
+    from ebookatty.synth import generate_corpus
+    (path, meta), = generate_corpus(
+        tmp_path, 1, formats=["epub"], profile=profile, manifest_items=2000
+    )
+    book = Epub(path)
+    assert book.metadata["title"] == meta["title"]
+    with zipfile.ZipFile(path) as archive:
+        data = archive.read(book.opf)
+    full = book.iterer(ET.fromstring(data))
+    assert book.parse_metadata(io.BytesIO(data)) == full
+
+
+@pytest.mark.parametrize("encoding", ["utf-16", "iso-8859-1"])
+def test_epub_opf_declared_encoding(encoding, tmp_path):
+    import random
+    import zipfile
+    from ebookatty.epub import Epub
+    from ebookatty.synth import build_opf, book_metadata, CONTAINER_XML
+    meta = book_metadata(random.Random(1), codepage=1252)
+    meta["uuid"] = "0"
+    opf = build_opf(meta).decode("utf-8")
+    opf = opf.replace('encoding="utf-8"', f'encoding="{encoding}"')
+    path = tmp_path / "book.epub"
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.writestr("mimetype", "application/epub+zip")
+        archive.writestr("META-INF/container.xml", CONTAINER_XML.format(opf="c.opf"))
+        archive.writestr("c.opf", opf.encode(encoding))
+    assert Epub(path).metadata["title"] == meta["title"]
+
+
+@pytest.mark.parametrize("compression", ["ZIP_STORED", "ZIP_DEFLATED", "ZIP_BZIP2"])
+def test_epub_central_directory(compression, tmp_path):
+    import zipfile
+    from ebookatty.archive import CentralDirectory
+    from ebookatty.epub import Epub
+    from ebookatty.synth import generate_corpus
+    (source, meta), = generate_corpus(tmp_path, 1, formats=["epub"])
+    path = tmp_path / "book.epub"
+    with zipfile.ZipFile(source) as original, zipfile.ZipFile(
+        path, "w", getattr(zipfile, compression)
+    ) as archive:
+        for name in original.namelist():
+            archive.writestr(name, original.read(name))
+        archive.comment = b"comment"
+    with Epub(path) as book, Epub(path, fast=False) as slow:
+        assert book.metadata == slow.metadata
+        assert book.metadata["title"] == meta["title"]
+        fast = isinstance(book.epub_zip, CentralDirectory)
+        assert fast == (compression != "ZIP_BZIP2")
+    assert book.epub_zip is None
+
+
+def test_epub_close(testdir):
+    from ebookatty.epub import Epub
+    path = next(p for p in get_testfiles() if p.endswith(".epub"))
+    book = Epub(path)
+    fd = book.epub_zip.fd
+    book.close()
+    book.close()
+    assert fd.closed
+    with open(path, "rb") as stream:
+        with Epub(stream) as book:
+            assert book.metadata
+        assert not stream.closed
+    with MetadataFetcher(path) as fetcher:
+        assert fetcher.get_metadata()
+    assert fetcher.meta.epub_zip is None
+
+
+def test_epub_opf_locator(tmp_path):
+    import zipfile
+    from ebookatty.epub import Epub, OpfLocator
+    from ebookatty.synth import CONTAINER_XML, generate_corpus
+    corpus = generate_corpus(tmp_path, 3, formats=["epub"])
+    locator = OpfLocator()
+    for path, meta in corpus:
+        with Epub(path, locator=locator) as book:
+            assert book.metadata["title"] == meta["title"]
+    assert (locator.hits, locator.misses) == (3, 0)
+    source = tmp_path / "custom.epub"
+    with zipfile.ZipFile(path) as original, zipfile.ZipFile(source, "w") as archive:
+        for name in original.namelist():
+            target = name.replace("OEBPS/content.opf", "text/book.opf")
+            if name != "META-INF/container.xml":
+                archive.writestr(target, original.read(name))
+        container = CONTAINER_XML.format(opf="text/book.opf")
+        archive.writestr("META-INF/container.xml", container)
+        archive.writestr("text/decoy.opf", b"<package/>")
+    with Epub(source, locator=locator) as book:
+        assert book.opf == "text/book.opf"
+        assert book.metadata["title"] == meta["title"]
+    assert locator.misses == 1
+    assert locator.candidates()[0] == "text/book.opf"
+    assert 0 < locator.hit_rate < 1
+
+
+def test_fetch_metadata_opf_locator(tmp_path):
+    from ebookatty import fetch_metadata
+    from ebookatty.epub import OpfLocator
+    from ebookatty.synth import generate_corpus
+    corpus = generate_corpus(tmp_path, 4, formats=["epub", "mobi"])
+    locator = OpfLocator()
+    for path, meta in corpus:
+        assert fetch_metadata(path, locator=locator)["title"] == meta["title"]
+    assert (locator.hits, locator.misses) == (2, 0)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_iter_extract_locate_opf(tmp_path, workers):
+    from ebookatty.batch import iter_extract
+    from ebookatty.synth import generate_corpus
+    corpus = list(generate_corpus(tmp_path, 6, formats=["epub", "mobi"]))
+    paths = [str(path) for path, _ in corpus]
+    results = list(iter_extract(paths, workers, trace=True, locate_opf=True))
+    checked = 0
+    for result, (path, meta) in zip(results, corpus):
+        assert result.path == str(path)
+        assert result.metadata["title"] == meta["title"]
+        located = "epub.locate.hit" in result.trace
+        assert located == result.path.endswith(".epub")
+        checked += 1
+    assert checked == len(paths) == 6
+
+
+def test_cli_locate_opf(testdir, outdir, capsys):
+    out = os.path.join(outdir, "located.jsonl")
+    books = os.path.join(testdir, "*.epub")
+    sys.argv = ["ebookatty", books, "-o", out, "--trace", "--locate-opf"]
+    execute()
+    assert "opf locator: 3 hits, 0 misses" in capsys.readouterr().err
+
+
+@pytest.mark.parametrize("fmt", ["epub", "mobi", "azw3"])
+def test_book_metadata_record(fmt, tmp_path):
+    import pickle
+    from ebookatty import BookMetadata
+    from ebookatty.synth import generate_corpus
+    (path, meta), = generate_corpus(tmp_path, 1, formats=[fmt])
+    with MetadataFetcher(path) as fetcher:
+        record = fetcher.get_record()
+        legacy = fetcher.get_metadata()
+    assert isinstance(record, BookMetadata)
+    assert record.title == meta["title"]
+    assert record.authors == tuple(meta["authors"])
+    assert record.subjects == tuple(meta["subjects"])
+    assert legacy["subject"] == "; ".join(meta["subjects"])
+    assert record.publisher == meta["publisher"]
+    assert not hasattr(record, "__dict__")
+    assert set(record.extra).isdisjoint(record.FIELDS)
+    assert pickle.loads(pickle.dumps(record)) == record
+    assert record.as_dict()["authors"] == record.authors
+
+
+def test_extract_many_records_use_less_memory():
+    import gc
+    import tracemalloc
+    from ebookatty import BookMetadata
+    from ebookatty.batch import extract_many
+    books = sorted(get_testfiles()) * 10
+    retained = {}
+    for records in (False, True):
+        extract_many(books[:1], workers=1, records=records)
+        gc.collect()
+        tracemalloc.start()
+        results = extract_many(books, workers=1, records=records)
+        gc.collect()
+        retained[records] = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        kind = BookMetadata if records else dict
+        assert all(isinstance(result.metadata, kind) for result in results)
+        del results
+    assert retained[True] < retained[False]
+
+
+def test_extract_many_records_from_workers():
+    from ebookatty.batch import extract_many
+    books = sorted(get_testfiles())
+    local = extract_many(books, workers=1, records=True)
+    remote = extract_many(books, workers=2, records=True)
+    assert [r.metadata for r in remote] == [r.metadata for r in local]
+    publishers = [r.metadata.publisher for r in remote if r.metadata.publisher]
+    assert all(p is sys.intern(p) for p in publishers)
+    assert extract_many(books[:1], workers=1)[0].metadata == MetadataFetcher(
+        books[0]
+    ).get_metadata()
+
+
+def test_book_metadata_ordered_dedupe():
+    from ebookatty.record import BookMetadata, join_values
+    values = {"creator": ["b", "a", "b"], "subject": ["x"], "type": [2, 2, 1]}
+    record = BookMetadata.from_values(values)
+    assert record.authors == ("b", "a")
+    assert record.extra == {"type": ("2", "1")}
+    assert join_values(values["creator"]) == "b; a"
+    other = BookMetadata.from_values({"type": [3]})
+    assert other.extra_keys is record.extra_keys
+
+
+@pytest.mark.parametrize("suffix", [".parquet", ".arrow", ".feather"])
+def test_arrow_writer(suffix, testdir, tmp_path):
+    pytest.importorskip("pyarrow")
+    from ebookatty.writers import ARROW_COLUMNS, ArrowWriter
+    books = sorted(get_testfiles())
+    out = tmp_path / f"books{suffix}"
+    with ArrowWriter(out, row_group_size=2) as writer:
+        for book in books:
+            writer.write(MetadataFetcher(book).get_metadata())
+    if suffix == ".parquet":
+        import pyarrow.parquet as pq
+        assert pq.ParquetFile(out).num_row_groups == (len(books) + 1) // 2
+        table = pq.read_table(out)
+    else:
+        import pyarrow.feather as feather
+        table = feather.read_table(out)
+    assert table.column_names == ARROW_COLUMNS
+    assert len(set(ARROW_COLUMNS)) == len(ARROW_COLUMNS)
+    assert table.num_rows == len(books)
+    titles = table.column("title").to_pylist()
+    assert titles == [MetadataFetcher(b).get_metadata().get("title") for b in books]
+    assert all(table.column("extra").to_pylist())
+
+
+@pytest.mark.parametrize("suffix", [".parquet", ".feather"])
+def test_cli_arrow_output(suffix, testdir, outdir):
+    pytest.importorskip("pyarrow")
+    from glob import glob
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+    from ebookatty.writers import ARROW_COLUMNS
+    out = os.path.join(outdir, f"books{suffix}")
+    pattern = os.path.join(testdir, "*")
+    sys.argv = ["ebookatty", pattern, "-o", out]
+    execute()
+    read_table = pq.read_table if suffix == ".parquet" else feather.read_table
+    table = read_table(out)
+    assert table.column_names == ARROW_COLUMNS
+    assert len(set(table.column_names)) == len(ARROW_COLUMNS)
+    assert sorted(table.column("path").to_pylist()) == sorted(glob(pattern))
+
+
+def test_arrow_writer_requires_pyarrow(monkeypatch, testdir, outdir):
+    from ebookatty.writers import get_writer
+    monkeypatch.setitem(sys.modules, "pyarrow", None)
+    with pytest.raises(ImportError, match="pip install"):
+        get_writer(os.path.join(outdir, "books.parquet"))
+    out = os.path.join(outdir, "books.feather")
+    sys.argv = ["ebookatty", os.path.join(testdir, "*.mobi"), "-o", out]
+    with pytest.raises(SystemExit):
+        execute()
+
+
+def test_csv_writer_streams_and_quotes(outdir):
+    import csv
+    from ebookatty.standards import CSV_COLUMNS
+    from ebookatty.writers import get_writer
+    out = os.path.join(outdir, "quoted.csv")
+    record = {"title": 'A, "B"\nC', "subject": ["x", "y"], "unknown": "z"}
+    with get_writer(out) as writer:
+        writer.write(record)
+        writer.fd.flush()
+        with open(out, newline="") as fd:
+            rows = list(csv.reader(fd))
+        assert rows[0] == CSV_COLUMNS and len(rows) == 2
+        writer.write({"author": "Someone"})
+    with open(out, newline="") as fd:
+        rows = list(csv.DictReader(fd))
+    assert rows[0]["title"] == record["title"]
+    assert rows[0]["subject"] == "x; y"
+    assert "unknown" not in rows[0]
+    assert rows[1]["author"] == "Someone" and rows[1]["title"] == ""
+
+
+def test_cli_csv_columns(testdir, outdir):
+    import csv
+    out = os.path.join(outdir, "columns.csv")
+    sys.argv = ["ebookatty", os.path.join(testdir, "*"), "-o", out, "--columns", "title,author"]
+    execute()
+    with open(out, newline="") as fd:
+        rows = list(csv.reader(fd))
+    assert rows[0] == ["title", "author"]
+    assert len(rows) == len(get_testfiles()) + 1
+    sys.argv = ["ebookatty", os.path.join(testdir, "*"), "-o", out + ".json", "--columns", "title"]
+    with pytest.raises(SystemExit):
+        execute()
+    assert not os.path.exists(out + ".json")
+
+
+@pytest.mark.parametrize("book", get_testfiles())
+def test_fetch_metadata_fields(book):
+    from ebookatty import fetch_metadata
+    from ebookatty.record import project
+    fields = ["title", "author", "isbn", "language", "date"]
+    full = fetch_metadata(book)
+    assert fetch_metadata(book, fields=fields) == project(full, fields)
+    with MetadataFetcher(book, fields=["creator"]) as fetcher:
+        assert list(fetcher.get_metadata()) == ["creator"]
+
+
+def projection_fields():
+    from ebookatty.standards import ALL_FIELDS, FIELD_ALIASES, SINGLE_VALUED_FIELDS
+    fields = set(ALL_FIELDS) | set(FIELD_ALIASES) | SINGLE_VALUED_FIELDS
+    for book in get_testfiles():
+        fields.update(MetadataFetcher(book).get_metadata())
+    return sorted(fields)
+
+
+@pytest.mark.parametrize("field", projection_fields())
+def test_fetch_metadata_field_matches_projection(field, tmp_path):
+    from ebookatty import fetch_metadata
+    from ebookatty.cache import MetadataCache
+    from ebookatty.record import project
+    with MetadataCache(tmp_path) as cache:
+        for book in get_testfiles():
+            expected = project(fetch_metadata(book), [field])
+            assert fetch_metadata(book, fields=[field]) == expected, book
+            assert fetch_metadata(book, cache=cache, fields=[field]) == expected
+
+
+def test_kindle_fields_skip_exth(monkeypatch, testdir):
+    from ebookatty.mobi import EXTHHeader, Kindle
+    decoded = []
+    decode = EXTHHeader.decode
+    monkeypatch.setattr(
+        EXTHHeader, "decode", lambda self, c: decoded.append(c) or decode(self, c)
+    )
+    book = os.path.join(testdir, "test_book.mobi")
+    assert Kindle(book, fields=["codec"]).metadata == {"codec": Kindle(book).metadata["codec"]}
+    decoded.clear()
+    Kindle(book, fields=["codec"])
+    assert decoded == []
+    Kindle(book, fields=["publisher"])
+    assert len(decoded) == 1
+
+
+def test_epub_fields_read_repeated_values(tmp_path):
+    import zipfile
+    from ebookatty.epub import Epub
+    from ebookatty.synth import CONTAINER_XML
+    opf = (
+        '<?xml version="1.0"?><package xmlns="http://www.idpf.org/2007/opf" '
+        'xmlns:dc="http://purl.org/dc/elements/1.1/"><metadata>'
+        "<dc:title>Early</dc:title><dc:language>en</dc:language>"
+        "<dc:date>2007</dc:date><dc:date>2022</dc:date></metadata><broken></package>"
+    )
+    path = tmp_path / "early.epub"
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.writestr("META-INF/container.xml", CONTAINER_XML.format(opf="c.opf"))
+        archive.writestr("c.opf", opf)
+    book = Epub(path, fields=["title", "language", "date"])
+    assert book.metadata == {"title": "Early", "language": "English", "date": "2007; 2022"}
+
+
+def test_cli_fields(testdir, outdir):
+    import csv
+    out = os.path.join(outdir, "fields.csv")
+    sys.argv = ["ebookatty", os.path.join(testdir, "*"), "-o", out, "--fields", "title,author"]
+    execute()
+    with open(out, newline="") as fd:
+        rows = list(csv.DictReader(fd))
+    assert list(rows[0]) == ["title", "author"]
+    assert all(row["title"] for row in rows)
+
+
+@pytest.mark.parametrize("book", get_testfiles())
+def test_trace_hook(book):
+    from ebookatty import trace
+    events = []
+    trace.add_hook(events.append)
+    try:
+        MetadataFetcher(book).get_metadata()
+    finally:
+        trace.remove_hook(events.append)
+    stages = [event.stage for event in events]
+    prefix = "epub." if book.endswith(".epub") else "mobi."
+    assert stages and all(stage.startswith(prefix) for stage in stages)
+    assert all(event.seconds >= 0 and event.nbytes >= 0 for event in events)
+    assert any(event.nbytes for event in events)
+    assert trace.stage("epub.opf") is trace.NULL_STAGE
+
+
+def test_trace_collect_is_per_context(testdir):
+    from ebookatty.batch import extract_many
+    from ebookatty.trace import NULL_STAGE, stage
+    paths = get_testfiles()
+    results = extract_many(paths, workers=2, executor="thread", trace=True)
+    for result in results:
+        prefix = "epub." if result.path.endswith(".epub") else "mobi."
+        assert result.trace and all(name.startswith(prefix) for name in result.trace)
+    assert all(result.trace is None for result in extract_many(paths, workers=1))
+    assert stage("mobi.exth") is NULL_STAGE
+
+
+def test_trace_writer_stage(outdir):
+    from ebookatty import trace
+    from ebookatty.writers import JsonLinesWriter
+    events = []
+    trace.add_hook(events.append)
+    out = os.path.join(outdir, "trace.jsonl")
+    try:
+        with JsonLinesWriter(out) as writer:
+            writer.write({"title": "a"})
+            writer.write({"title": "b"})
+    finally:
+        trace.remove_hook(events.append)
+    assert [event.stage for event in events] == ["write.jsonl"] * 2
+    assert sum(event.nbytes for event in events) == os.path.getsize(out)
+
+
+def test_cli_trace(testdir, outdir):
+    import json
+    out = os.path.join(outdir, "trace.jsonl")
+    sys.argv = ["ebookatty", os.path.join(testdir, "*.azw3"), "-o", out, "--trace"]
+    execute()
+    with open(out) as fd:
+        records = [json.loads(line) for line in fd]
+    assert records
+    for record in records:
+        assert {"mobi.read", "mobi.header", "mobi.record"} <= set(record["trace"])
+
+
+def test_cli_profile(testdir, tmp_path):
+    import pstats
+    out = tmp_path / "profile"
+    sys.argv = ["ebookatty", os.path.join(testdir, "*"), "--profile", str(out), "-j", "4"]
+    execute()
+    names = {path.name for path in out.iterdir()}
+    assert {"total.pstats", "epub.pstats", "cli.pstats"} <= names
+    assert {"stacks.collapsed", "memory.txt"} <= names
+    stats = pstats.Stats(str(out / "epub.pstats"))
+    assert any(func[2] == "read_package" for func in stats.stats)
+    total = pstats.Stats(str(out / "total.pstats"))
+    assert any(func[2] == "iter_extract" for func in total.stats)
+    for line in (out / "stacks.collapsed").read_text().splitlines():
+        stack, count = line.rsplit(" ", 1)
+        assert ";" in stack and int(count) > 0
+    assert "[epub] files: 3" in (out / "memory.txt").read_text()
+
+
+def test_profiler_buckets_by_content(testdir, tmp_path, monkeypatch):
+    import tracemalloc
+    from ebookatty.profiling import Profiler, file_format
+    misnamed = tmp_path / "book"
+    shutil.copy(os.path.join(testdir, "test_book.mobi"), misnamed)
+    unknown = tmp_path / "notes.epub"
+    unknown.write_text("not an ebook")
+    assert file_format(str(misnamed)) == "mobi"
+    assert file_format(str(unknown)) == "unknown"
+    snapshots = []
+    take_snapshot = tracemalloc.take_snapshot
+    monkeypatch.setattr(
+        tracemalloc, "take_snapshot", lambda: snapshots.append(1) or take_snapshot()
+    )
+    books = sorted(get_testfiles()) * 3
+    with Profiler(tmp_path / "profile", sampled=1) as profiler:
+        for path in profiler.track(books + [str(misnamed)]):
+            MetadataFetcher(path).get_metadata()
+    assert profiler.files == {"epub": 9, "mobi": 19}
+    assert len(snapshots) <= 2 * len(profiler.visits)
+    assert profiler.visits["mobi"] > 1
+
+
+def test_import_budgets():
+    from ebookatty import bench
+    results = bench.main(["--imports"])
+    assert [r.name for r in results] == [b.name for b in bench.IMPORT_BUDGETS]
+    assert all(r.passed for r in results), bench.format_imports(results)
+
+
+def test_lazy_package_attributes():
+    import ebookatty
+    from ebookatty.record import BookMetadata
+    assert "fetch_metadata" in dir(ebookatty)
+    assert ebookatty.BookMetadata is BookMetadata
+    with pytest.raises(AttributeError):
+        ebookatty.not_a_name
+
+
+@pytest.fixture
+def metadata_server(tmp_path):
+    import threading
+    from ebookatty.cache import MetadataCache
+    from ebookatty.server import MetadataService, make_server
+    cache = MetadataCache(tmp_path / "cache")
+    service = MetadataService(2, "thread", cache, max_requests=1, queue_timeout=0)
+    server = make_server(service, port=0, quiet=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    thread.join()
+    server.server_close()
+    service.close()
+    cache.close()
+
+
+def post(url, body, content_type):
+    import json
+    import urllib.error
+    import urllib.request
+    request = urllib.request.Request(url, body, {"Content-Type": content_type})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as err:
+        return err.code, json.loads(err.read())
+
+
+def test_server_paths_and_bytes(metadata_server, testdir):
+    import json
+    import urllib.request
+    url = metadata_server.url()
+    books = sorted(get_testfiles())
+    body = json.dumps({"paths": books + ["/missing.epub"], "fields": "title"})
+    status, payload = post(url + "/metadata", body.encode(), "application/json")
+    assert status == 200
+    results = payload["results"]
+    assert [r["path"] for r in results] == books + ["/missing.epub"]
+    assert all(set(r["metadata"]) <= {"title"} for r in results[:-1])
+    assert results[-1]["metadata"] is None and "FileNotFoundError" in results[-1]["error"]
+    status, again = post(url + "/metadata", body.encode(), "application/json")
+    assert again == payload
+    with urllib.request.urlopen(url + "/health") as response:
+        health = json.loads(response.read())
+    assert health["cache_hits"] >= len(books) and health["in_flight"] == 0
+    with open(books[0], "rb") as fd:
+        status, result = post(url + "/metadata", fd.read(), "application/octet-stream")
+    assert status == 200 and result["metadata"] == MetadataFetcher(books[0]).get_metadata()
+    assert post(url + "/metadata", b"junk", "application/octet-stream")[0] == 422
+    assert post(url + "/metadata", b"{", "application/json")[0] == 400
+    assert post(url + "/other", b"{}", "application/json")[0] == 404
+
+
+def test_server_concurrency_limit(metadata_server):
+    service = metadata_server.service
+    with service.slot():
+        status, payload = post(
+            metadata_server.url() + "/metadata", b'{"paths": []}', "application/json"
+        )
+    assert status == 503 and "in progress" in payload["error"]
+    assert post(metadata_server.url() + "/metadata", b'{"paths": []}', "application/json") == (
+        200, {"results": []}
+    )
+
+
+def raw_post(server, headers, host_header="localhost"):
+    import socket
+    host, port = server.server_address[:2]
+    lines = ["POST /metadata HTTP/1.1", f"Host: {host_header}", *headers, "", ""]
+    with socket.create_connection((host, port), timeout=10) as client:
+        client.sendall("\r\n".join(lines).encode())
+        response = b"".join(iter(lambda: client.recv(4096), b""))
+    return int(response.split(b" ", 2)[1])
+
+
+def test_server_content_length(metadata_server):
+    assert raw_post(metadata_server, ["Content-Length: abc"]) == 400
+    assert raw_post(metadata_server, ["Content-Length: -1"]) == 400
+    assert raw_post(metadata_server, ["Transfer-Encoding: chunked"]) == 400
+    assert raw_post(metadata_server, [f"Content-Length: {1 << 30}"]) == 413
+    with metadata_server.service.slot():
+        # The body is never sent, the busy service must not wait for it.
+        assert raw_post(metadata_server, ["Content-Length: 10"]) == 503
+
+
+def test_server_checks_host(metadata_server):
+    port = metadata_server.server_address[1]
+    # Accepted requests reach the handler and fail on their empty body.
+    headers = ["Content-Type: application/json", "Content-Length: 0", "Connection: close"]
+    for host in ("localhost", f"LOCALHOST:{port}", f"127.0.0.1:{port}", f"[::1]:{port}"):
+        assert raw_post(metadata_server, headers, host) == 400
+    for host in ("attacker.example", f"attacker.example:{port}", "", "[bad"):
+        assert raw_post(metadata_server, headers, host) == 421
+
+
+def test_server_closes_idle_connections():
+    import http.client
+    import threading
+    import time
+    from ebookatty.server import MetadataService, make_server
+    service = MetadataService(1, "thread")
+    server = make_server(service, port=0, quiet=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    client = http.client.HTTPConnection(*server.server_address[:2], timeout=10)
+    try:
+        client.request("GET", "/health")
+        response = client.getresponse()
+        assert response.status == 200 and not response.will_close
+        response.read()
+        server.shutdown()
+        thread.join()
+        closer = threading.Thread(target=server.server_close)
+        start = time.monotonic()
+        closer.start()
+        closer.join(5)
+        assert not closer.is_alive() and time.monotonic() - start < 5
+        assert client.sock.recv(1) == b""
+    finally:
+        client.close()
+        service.close()
+
+
+def test_server_refuses_public_interfaces():
+    from ebookatty.server import MetadataService, is_loopback, make_server
+    assert is_loopback("127.0.0.1") and is_loopback("::1") and is_loopback("localhost")
+    assert not is_loopback("0.0.0.0") and not is_loopback("example.com")
+    service = MetadataService(1, "thread")
+    try:
+        with pytest.raises(ValueError, match="loopback"):
+            make_server(service, host="0.0.0.0", port=0)
+    finally:
+        service.close()
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="no unix sockets")
+def test_server_unix_socket(tmp_path):
+    import json
+    import socket
+    import threading
+    from ebookatty.server import MetadataService, make_server
+    path = tmp_path / "ebookatty.sock"
+    service = MetadataService(1, "thread")
+    server = make_server(service, socket_path=path, quiet=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(str(path))
+            client.sendall(b"GET /health HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n")
+            response = b"".join(iter(lambda: client.recv(4096), b""))
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+        service.close()
+    head, body = response.split(b"\r\n\r\n", 1)
+    assert head.startswith(b"HTTP/1.1 200")
+    assert json.loads(body)["workers"] == 1
+    assert not path.exists()
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="no SIGTERM")
+def test_cli_serve_graceful_shutdown(tmp_path):
+    import json
+    import signal
+    import subprocess
+    import urllib.request
+    root = os.path.dirname(os.path.dirname(__file__))
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "ebookatty", "serve", "-p", "0", "-j", "1", "-q",
+         "--cache-dir", str(tmp_path)],
+        cwd=root, stderr=subprocess.PIPE, text=True,
+    )
+    try:
+        url = proc.stderr.readline().split()[-1]
+        with urllib.request.urlopen(url + "/health") as response:
+            assert json.loads(response.read())["status"] == "ok"
+        proc.send_signal(signal.SIGTERM)
+        assert proc.wait(timeout=30) == 0
+    finally:
+        proc.kill()
+        proc.stderr.close()